@@ -1,5 +1,4 @@
-from django.contrib import admin
-from django.db.models import Q
+from django.contrib import admin, messages
 from .models import (Account, Analytic, Entry, BankStatement, Transaction,
                      ThirdParty, Purchase, Sale, Journal, Year,
                      Income, Expenditure, Cashing)
@@ -17,8 +16,7 @@ class HasScanListFilter(admin.SimpleListFilter):
     def queryset(self, request, queryset):
         if self.value() == '0':
             return queryset.filter(
-                Q(transaction__account__number__startswith='6') |
-                Q(transaction__account__number__startswith='7'),
+                transaction__account__category__in=(6, 7),
                 scan=''
             )
 
@@ -38,7 +36,8 @@ class JournalAdmin(admin.ModelAdmin):
 
 @admin.register(Account)
 class AccountAdmin(admin.ModelAdmin):
-    list_display = ('number', 'title')
+    list_display = ('number', 'title', 'role')
+    list_filter = ('category', 'role')
     search_fields = ('=number', 'title')
 
 
@@ -114,6 +113,20 @@ class BankStatementAdmin(admin.ModelAdmin):
     list_display = ('date', 'year', 'number', 'scan', 'balance')
     list_filter = ('year', )
     date_hierarchy = 'date'
+    actions = ('reconcile', )
+
+    def reconcile(self, request, queryset):
+        for statement in queryset.exclude(data='').order_by('date'):
+            try:
+                unmatched = statement.reconcile()
+            except ValueError as e:
+                self.message_user(request, str(e), messages.ERROR)
+                continue
+            for line in unmatched:
+                self.message_user(request, "Relevé {} : ligne non rapprochée {:%d/%m/%Y} {} {}".format(
+                    statement.number or statement.date, line.date, line.amount, line.title
+                ), messages.WARNING)
+    reconcile.short_description = "Rapprocher les fichiers des relevés"
 
 
 @admin.register(Transaction)
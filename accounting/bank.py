@@ -0,0 +1,142 @@
+import csv
+import datetime
+import io
+import re
+from bisect import bisect_left
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from xml.etree import ElementTree
+
+# A line of a bank statement, amount being positive when crediting the bank account
+StatementLine = namedtuple('StatementLine', ('date', 'amount', 'title'))
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def child(element, *path):
+    "Descendant of element following path of namespace-free tag names"
+    for name in path:
+        if element is None:
+            return None
+        element = next((sub for sub in element if local_name(sub.tag) == name), None)
+    return element
+
+
+def text(element, *path):
+    element = child(element, *path)
+    return element.text.strip() if element is not None and element.text else ''
+
+
+def invalid_line(line, error):
+    "ValueError reporting an unparsable statement line, its whitespace collapsed"
+    return ValueError("Ligne de relevé invalide ({}) : {}".format(error, ' '.join(line.split())))
+
+
+def parse_amount(value, line):
+    try:
+        return Decimal(value.replace(',', '.'))
+    except InvalidOperation:
+        raise invalid_line(line, "montant {!r}".format(value))
+
+
+def parse_date(value, format, line):
+    try:
+        return datetime.datetime.strptime(value, format).date()
+    except ValueError:
+        raise invalid_line(line, "date {!r}".format(value))
+
+
+def parse_camt053(data):
+    "Lines of an ISO 20022 CAMT.053 statement, raising ValueError on the first unparsable entry"
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as e:
+        raise ValueError("Relevé CAMT.053 illisible : {}".format(e))
+    lines = []
+    for element in root.iter():
+        if local_name(element.tag) != 'Ntry':
+            continue
+        line = ' '.join(element.itertext())
+        amount = parse_amount(text(element, 'Amt'), line)
+        if text(element, 'CdtDbtInd') == 'DBIT':
+            amount = -amount
+        day = text(element, 'BookgDt', 'Dt') or text(element, 'BookgDt', 'DtTm')[:10]
+        title = text(element, 'AddtlNtryInf') or \
+            text(element, 'NtryDtls', 'TxDtls', 'RmtInf', 'Ustrd')
+        lines.append(StatementLine(parse_date(day, '%Y-%m-%d', line), amount, title))
+    return lines
+
+
+def parse_ofx(data):
+    "Lines of an OFX statement, SGML or XML flavoured, raising ValueError on the first unparsable transaction"
+    lines = []
+    for block in re.findall(r'<STMTTRN>(.*?)</STMTTRN>', data.decode('latin-1'), re.S | re.I):
+        tags = {name.upper(): value.strip() for name, value in re.findall(r'<(\w+)>([^<\r\n]*)', block)}
+        lines.append(StatementLine(
+            parse_date(tags.get('DTPOSTED', '')[:8], '%Y%m%d', block),
+            parse_amount(tags.get('TRNAMT', ''), block),
+            tags.get('NAME') or tags.get('MEMO', '')
+        ))
+    return lines
+
+
+def parse_csv(data):
+    "Lines of a date;title;amount csv export, french formatted, unparsable rows being skipped"
+    lines = []
+    for row in csv.reader(io.StringIO(data.decode('utf-8-sig')), delimiter=';'):
+        try:
+            day = datetime.datetime.strptime(row[0].strip(), '%d/%m/%Y').date()
+            amount = Decimal(row[-1].strip().replace(' ', '').replace(',', '.'))
+        except (IndexError, ValueError, InvalidOperation):
+            continue
+        lines.append(StatementLine(day, amount, row[1].strip() if len(row) > 2 else ''))
+    return lines
+
+
+PARSERS = {
+    '.xml': parse_camt053,
+    '.ofx': parse_ofx,
+    '.csv': parse_csv,
+}
+
+
+def parse_statement(name, data):
+    "Lines of a statement file, the format being guessed from its name"
+    for extension, parser in PARSERS.items():
+        if name.lower().endswith(extension):
+            return parser(data)
+    raise ValueError("Format de relevé inconnu : {}".format(name))
+
+
+def match_lines(lines, transactions, window=5):
+    """
+    Match statement lines to transactions.
+
+    transactions is a sequence of (pk, date, amount). Each line is matched to
+    the transaction of same amount with the nearest date, at most window days
+    away. Return the list of (pk, line) matches and the unmatched lines.
+    """
+    # Transactions by amount, sorted by date
+    index = {}
+    for pk, day, amount in transactions:
+        index.setdefault(amount, []).append((day, pk))
+    for candidates in index.values():
+        candidates.sort()
+    delta = datetime.timedelta(days=window)
+    matches = []
+    unmatched = []
+    for line in sorted(lines, key=lambda line: line.date):
+        candidates = index.get(line.amount, [])
+        best = None
+        for i in range(bisect_left(candidates, (line.date - delta, )), len(candidates)):
+            if candidates[i][0] > line.date + delta:
+                break
+            if best is None or abs(candidates[i][0] - line.date) < abs(candidates[best][0] - line.date):
+                best = i
+        if best is None:
+            unmatched.append(line)
+        else:
+            matches.append((candidates.pop(best)[1], line))
+    return matches, unmatched
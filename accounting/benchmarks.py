@@ -0,0 +1,257 @@
+"""
+Query count and latency benchmark of the accounting views.
+
+It is not collected by the default test run, launch it with:
+
+    ./manage.py test accounting.benchmarks
+
+A year of 50k transactions, 2k third parties and 200 accounts is generated, then
+every url of accounting.urls is fetched and compared to the baselines of
+benchmarks.json: the test fails when a view answers a server error, issues more
+queries than its baseline or gets slower than BENCHMARK_TOLERANCE times its baseline.
+
+BENCHMARK_SCALE scales the generated year (default 1).
+BENCHMARK_UPDATE=1 rewrites the baselines instead of comparing to them, server
+errors excepted. A change altering the queries of a view updates its baseline.
+"""
+import datetime
+import json
+import os
+import random
+import time
+from decimal import Decimal
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Max
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from members.factories import PersonFactory
+from .factories import (AccountFactory, AnalyticFactory, EntryFactory, PurchaseFactory, ThirdPartyFactory,
+                        TransactionFactory, YearFactory)
+from .models import (Account, Analytic, BankStatement, Cashing, Entry, Expenditure, Income, Journal, Sale,
+                     ThirdParty, Transaction)
+from .urls import urlpatterns
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'benchmarks.json')
+SCALE = float(os.environ.get('BENCHMARK_SCALE', 1))
+UPDATE = bool(os.environ.get('BENCHMARK_UPDATE'))
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 2))
+# Absolute slack in seconds, so that the fastest views do not fail on noise
+SLACK = 0.1
+
+# Url names with the attribute of the benchmark giving their pk, if any.
+# Views converting entries come last as they alter the data.
+URLS = (
+    ('year_list', None),
+    ('entry_list', None),
+    ('entry', 'entry'),
+    ('entry-csv', None),
+    ('fec', None),
+    ('projection', None),
+    ('balance', None),
+    ('analytic-balance', None),
+    ('account', None),
+    ('thirdparty_list', None),
+    ('thirdparty_detail', 'thirdparty'),
+    ('thirdparty_create', None),
+    ('thirdparty_update', 'thirdparty'),
+    ('thirdparty_delete', 'thirdparty'),
+    ('thirdparty-csv', None),
+    ('thirdparty_autocomplete', None),
+    ('bank-statement', None),
+    ('next_reconciliation', None),
+    ('reconciliation', 'statement'),
+    ('cash-flow', None),
+    ('cash_flow_data', None),
+    ('transfer_order_download', 'expenditure'),
+    ('transfer_order_batch', None),
+    ('checks', None),
+    ('purchase_list', None),
+    ('purchase_detail', 'purchase'),
+    ('purchase_create', None),
+    ('purchase_update', 'purchase'),
+    ('purchase_delete', 'purchase'),
+    ('sale_list', None),
+    ('sale_detail', 'sale'),
+    ('sale_create', None),
+    ('sale_update', 'sale'),
+    ('sale_delete', 'sale'),
+    ('income_list', None),
+    ('income_detail', 'income'),
+    ('income_create', None),
+    ('income_update', 'income'),
+    ('income_delete', 'income'),
+    ('expenditure_list', None),
+    ('expenditure_detail', 'expenditure'),
+    ('expenditure_create', None),
+    ('expenditure_update', 'expenditure'),
+    ('expenditure_delete', 'expenditure'),
+    ('cashing_list', None),
+    ('cashing_detail', 'cashing'),
+    ('cashing_create', None),
+    ('cashing_update', 'cashing'),
+    ('cashing_delete', 'cashing'),
+    ('entry_to_purchase', 'purchase_entry'),
+    ('entry_to_sale', 'sale_entry'),
+    ('entry_to_income', 'income_entry'),
+    ('entry_to_expenditure', 'expenditure_entry'),
+)
+
+
+class QueryCounter:
+    "Execute wrapper counting the queries, without the cap of the debug query log"
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def amount(rand):
+    return Decimal(rand.randint(100, 200000)) / 100
+
+
+def generate_year(scale=1, seed=0):
+    "Generate an opened year of about 50k transactions, return it"
+    rand = random.Random(seed)
+    YearFactory.create(start=datetime.date(2013, 1, 1), end=datetime.date(2013, 12, 31))
+    year = YearFactory.create(start=datetime.date(2014, 1, 1), end=datetime.date(2014, 12, 31), opened=True)
+
+    # 200 accounts, including the ones the views and forms expect
+    # (numbers are kept clear of the ones AccountFactory generates)
+    numbers = ['1200000', '1290000', '4190000', '5112000', '5115000', '5120000', '5170000', '5300000']
+    numbers += ['4018{:03d}'.format(i) for i in range(30)] + ['4118{:03d}'.format(i) for i in range(30)]
+    numbers += ['618{:04d}'.format(i) for i in range(60)] + ['718{:04d}'.format(i) for i in range(40)]
+    numbers += ['218{:04d}'.format(i) for i in range(200 - len(numbers))]
+    accounts = [AccountFactory.build(number=number) for number in numbers]
+    for account in accounts:
+        account.classify()
+    Account.objects.bulk_create(accounts)
+    accounts = Account.objects.in_bulk(field_name='number')
+    suppliers = [account for number, account in accounts.items() if number.startswith('401')]
+    clients = [account for number, account in accounts.items() if number.startswith('411')]
+    expenses = [account for number, account in accounts.items() if number.startswith('6')]
+    revenues = [account for number, account in accounts.items() if number.startswith('7')]
+    bank = accounts['5120000']
+
+    ThirdParty.objects.bulk_create([
+        ThirdPartyFactory.build(number='{:04d}'.format(i), account=rand.choice(suppliers + clients),
+                                iban='FR7630006000011234567890189')
+        for i in range(int(2000 * scale))
+    ])
+    thirdparties = list(ThirdParty.objects.select_related('account'))
+    Analytic.objects.bulk_create([AnalyticFactory.build() for i in range(20)])
+    analytics = list(Analytic.objects.all())
+
+    # Pure entries of two transactions each, bulk created
+    journal = Journal.objects.get(number='OD')
+    last = Entry.objects.aggregate(last=Max('pk'))['last'] or 0
+    Entry.objects.bulk_create([
+        EntryFactory.build(year=year, journal=journal, date=year.start + datetime.timedelta(rand.randrange(365)))
+        for i in range(int(25000 * scale))
+    ])
+    transactions = []
+    for entry in Entry.objects.filter(pk__gt=last).order_by('pk'):
+        thirdparty = rand.choice(thirdparties)
+        value = amount(rand)
+        kind = rand.random()
+        if kind < 0.4:
+            account, analytic = rand.choice(expenses), rand.choice(analytics)
+        elif kind < 0.7:
+            account, analytic = rand.choice(revenues), rand.choice(analytics)
+        else:
+            account, analytic = bank, None
+        reconciliation = entry.date + datetime.timedelta(days=3) if account == bank and kind < 0.95 else None
+        debit = account.number[0] != '7'
+        transactions += [
+            TransactionFactory.build(entry=entry, account=account, analytic=analytic, reconciliation=reconciliation,
+                                     expense=value if debit else 0, revenue=0 if debit else value),
+            TransactionFactory.build(entry=entry, account=thirdparty.account, thirdparty=thirdparty,
+                                     expense=0 if debit else value, revenue=value if debit else 0),
+        ]
+    Transaction.objects.bulk_create(transactions)
+    call_command('rebuild_balances', year.pk, stdout=open(os.devnull, 'w'))
+    Transaction.objects.filter(entry__year=year).auto_letter()
+    return year
+
+
+@override_settings(IBAN='FR7630006000011234567890189', HOLDER="Becours")
+class ViewsBenchmark(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.year = generate_year(SCALE)
+        cls.thirdparty = ThirdParty.objects.first()
+        cls.entry, cls.purchase_entry, cls.sale_entry, cls.income_entry, cls.expenditure_entry = \
+            Entry.objects.filter(year=cls.year).order_by('pk')[:5]
+        cls.purchase = PurchaseFactory.create(year=cls.year)
+        cls.sale = Sale.objects.create(year=cls.year, journal=Journal.objects.get(number='VT'))
+        cls.income = Income.objects.create(year=cls.year, journal=Journal.objects.get(number='BQ'))
+        cls.expenditure = Expenditure.objects.create(year=cls.year, journal=Journal.objects.get(number='BQ'),
+                                                     method=5)
+        cls.cashing = Cashing.objects.create(year=cls.year, journal=Journal.objects.get(number='BQ'))
+        for entry, number in ((cls.income, '5120000'), (cls.cashing, '5112000')):
+            TransactionFactory.create(entry=entry, account=Account.objects.get(number=number), expense=1)
+        # A transfer to a third party with a valid iban, so that the transfer orders are generated
+        TransactionFactory.create(entry=cls.expenditure, account=Account.objects.get(number='5120000'), revenue=1)
+        TransactionFactory.create(entry=cls.expenditure, account=cls.thirdparty.account, thirdparty=cls.thirdparty,
+                                  expense=1)
+        TransactionFactory.create(entry=cls.income, account=cls.thirdparty.account, thirdparty=cls.thirdparty,
+                                  revenue=1)
+        TransactionFactory.create(entry=cls.cashing, account=Account.objects.get(number='5120000'), revenue=1)
+        TransactionFactory.create(entry=cls.sale, account=cls.thirdparty.account, thirdparty=cls.thirdparty,
+                                  expense=1)
+        TransactionFactory.create(entry=cls.sale, account=Account.objects.get(number='7180000'),
+                                  analytic=Analytic.objects.first(), revenue=1)
+        cls.statement = BankStatement.objects.create(year=cls.year, date=datetime.date(2014, 6, 30), balance=0,
+                                                     scan='releves/benchmark.pdf')
+
+    def setUp(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+
+    def measure(self, name, attribute):
+        kwargs = {}
+        if name != 'thirdparty_autocomplete':
+            kwargs['year_pk'] = self.year.pk
+        if attribute:
+            kwargs['pk'] = getattr(self, attribute).pk
+        queries = QueryCounter()
+        with connection.execute_wrapper(queries):
+            start = time.perf_counter()
+            response = self.client.get(reverse('accounting:' + name, kwargs=kwargs))
+            if response.streaming:
+                for chunk in response.streaming_content:
+                    pass
+            duration = time.perf_counter() - start
+        return {'status': response.status_code, 'queries': queries.count, 'time': round(duration, 3)}
+
+    def test_urls(self):
+        "Every url is benchmarked"
+        self.assertEqual({pattern.name for pattern in urlpatterns}, {name for name, attribute in URLS})
+
+    def test_baselines(self):
+        "Every url has a baseline, none of them a server error"
+        with open(BASELINES) as f:
+            baselines = json.load(f)['views']
+        self.assertEqual(set(baselines), {name for name, attribute in URLS})
+        self.assertEqual({name: baseline for name, baseline in baselines.items() if baseline['status'] >= 500}, {})
+
+    def test_views(self):
+        results = {name: self.measure(name, attribute) for name, attribute in URLS}
+        errors = {name: result['status'] for name, result in results.items() if result['status'] >= 500}
+        self.assertEqual(errors, {}, "Server errors are never a baseline")
+        if UPDATE:
+            with open(BASELINES, 'w') as f:
+                json.dump({'scale': SCALE, 'views': results}, f, indent=4, sort_keys=True)
+                f.write('\n')
+            return
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+        if baselines['scale'] != SCALE:
+            self.skipTest("Baselines were measured at scale {}".format(baselines['scale']))
+        for name, result in results.items():
+            with self.subTest(view=name):
+                baseline = baselines['views'][name]
+                self.assertEqual(result['status'], baseline['status'])
+                self.assertLessEqual(result['queries'], baseline['queries'])
+                self.assertLessEqual(result['time'], baseline['time'] * TOLERANCE + SLACK)
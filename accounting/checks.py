@@ -0,0 +1,165 @@
+"""
+Consistency checks of the accounting.
+
+Checks are registered in CHECKS and their results stored as CheckResult rows.
+run_checks only recomputes them for the entries modified since the last run:
+transaction checks test each row of a single pass over the transactions of
+these entries, entry checks filter these entries and letter checks, which do
+not depend on entry modifications, filter the letters of the year. This relies
+on every write to the transactions marking their entry as modified, which
+Transaction.save() and TransactionQuerySet.update() do.
+"""
+from django.db.models import F, Max, Min, Sum
+from django.db.models.functions import Coalesce
+from django.db.transaction import atomic
+from django.utils.timezone import now
+from .models import CheckResult, Entry, Letter, Transaction, Year
+
+CHECKS = []
+
+
+def register(check_class):
+    "Class decorator adding a check to CHECKS"
+    CHECKS.append(check_class())
+    return check_class
+
+
+class Check:
+    "Check flagging objects of a year"
+    kind = None
+    code = None
+    title = None
+    ok_title = None
+
+
+class TransactionCheck(Check):
+    "Check of a transaction row, having the fields of TRANSACTION_FIELDS"
+    kind = 'transaction'
+
+    def test(self, row):
+        raise NotImplementedError
+
+
+class EntryCheck(Check):
+    "Check filtering an entry queryset"
+    kind = 'entry'
+
+    def flagged(self, entries):
+        raise NotImplementedError
+
+
+class LetterCheck(Check):
+    "Check filtering the letters of a year"
+    kind = 'letter'
+
+    def flagged(self, letters):
+        raise NotImplementedError
+
+
+TRANSACTION_FIELDS = ('pk', 'entry_id', 'account__category', 'analytic_id', 'thirdparty_id')
+
+
+@register
+class MissingAnalytic(TransactionCheck):
+    code = 'missing_analytic'
+    title = "Analytique manquant"
+    ok_title = "Pas d'analytique manquant"
+
+    def test(self, row):
+        return row.account__category in (6, 7) and row.analytic_id is None
+
+
+@register
+class ExtraAnalytic(TransactionCheck):
+    code = 'extra_analytic'
+    title = "Analytique superflu"
+    ok_title = "Pas d'analytique superflu"
+
+    def test(self, row):
+        return row.account__category not in (6, 7) and row.analytic_id is not None
+
+
+@register
+class MissingThirdParty(TransactionCheck):
+    code = 'missing_thirdparty'
+    title = "Tiers manquant"
+    ok_title = "Pas de tiers manquant"
+
+    def test(self, row):
+        return row.account__category == 4 and row.thirdparty_id is None
+
+
+@register
+class ExtraThirdParty(TransactionCheck):
+    code = 'extra_thirdparty'
+    title = "Tiers superflu"
+    ok_title = "Pas de tiers superflu"
+
+    def test(self, row):
+        return row.account__category != 4 and row.thirdparty_id is not None
+
+
+@register
+class UnbalancedLetters(LetterCheck):
+    code = 'unbalanced_letters'
+    title = "Lettrage non équilibré"
+    ok_title = "Pas de lettrage non équilibré"
+
+    def flagged(self, letters):
+        return letters.annotate(
+            balance=Sum('transaction__revenue') - Sum('transaction__expense'),
+            account_min=Min(Coalesce('transaction__account_id', 0)),
+            account_max=Max(Coalesce('transaction__account_id', 0)),
+            thirdparty_min=Min(Coalesce('transaction__thirdparty_id', 0)),
+            thirdparty_max=Max(Coalesce('transaction__thirdparty_id', 0)),
+        ).exclude(
+            balance=0,
+            account_min=F('account_max'),
+            thirdparty_min=F('thirdparty_max')
+        )
+
+
+@register
+class PureEntries(EntryCheck):
+    code = 'pure_entries'
+    title = "Écritures pures"
+    ok_title = "Pas d'écritures pures"
+
+    def flagged(self, entries):
+        return entries.filter(purchase__id=None, sale__id=None, income__id=None, expenditure__id=None,
+                              cashing__id=None)
+
+
+def run_checks(year, full=False):
+    "Refresh the check results of the entries of year modified since the last run, or of all of them if full"
+    started = now()
+    entries = Entry.objects.filter(year=year)
+    if year.checked and not full:
+        entries = entries.filter(modified__gte=year.checked)
+    letters = Letter.objects.filter(pk__in=Transaction.objects.filter(entry__year=year).values('letter'))
+    with atomic():
+        results = CheckResult.objects.filter(year=year)
+        if full:
+            results.delete()
+        else:
+            results.filter(entry__in=entries).delete()
+            results.filter(letter__isnull=False).delete()
+        created = []
+        transaction_checks = [check for check in CHECKS if isinstance(check, TransactionCheck)]
+        rows = Transaction.objects.filter(entry__in=entries)
+        for row in rows.values_list(*TRANSACTION_FIELDS, named=True).iterator():
+            created += [
+                CheckResult(year=year, check=check.code, entry_id=row.entry_id, transaction_id=row.pk)
+                for check in transaction_checks if check.test(row)
+            ]
+        for check in CHECKS:
+            if isinstance(check, EntryCheck):
+                created += [CheckResult(year=year, check=check.code, entry_id=pk)
+                            for pk in check.flagged(entries).values_list('pk', flat=True)]
+            elif isinstance(check, LetterCheck):
+                created += [CheckResult(year=year, check=check.code, letter_id=pk)
+                            for pk in check.flagged(letters).values_list('pk', flat=True)]
+        CheckResult.objects.bulk_create(created)
+        Year.objects.filter(pk=year.pk).update(checked=started)
+    year.checked = started
+    return created
@@ -1,9 +1,9 @@
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout
 from django import forms
-from django.db.models import Sum, Q
+from django.db.models import Q
 import django_filters
-from .models import Analytic, Account, ThirdParty, Transaction
+from .models import AccountBalance, Analytic, Account, ThirdParty, Transaction
 
 
 class BaseFilterForm(forms.Form):
@@ -29,22 +29,10 @@ class BalanceFilter(django_filters.FilterSet):
                                           method='filter_balance')
 
     class Meta:
-        model = Transaction
+        model = AccountBalance
         fields = ('balance', )
         form = BalanceFilterForm
 
-    def __init__(self, aggregate, data, *args, **kwargs):
-        self.aggregate = aggregate
-        super().__init__(data, *args, **kwargs)
-        self.queryset = self.queryset.exclude(**{self.aggregate: None})
-        self.queryset = self.queryset.values(
-            *(self.aggregate + '__id', self.aggregate + '__number', self.aggregate + '__title')
-        )
-        self.queryset = self.queryset.annotate(
-            revenues=Sum('revenue'), expenses=Sum('expense'), balance=Sum('revenue') - Sum('expense')
-        )
-        self.queryset = self.queryset.order_by(*(self.aggregate + '__number', ))
-
     def filter_balance(self, qs, name, value):
         if value == 'D':
             return qs.filter(balance__lt=0)
@@ -108,6 +96,7 @@ class AccountFilterForm(BaseFilterForm):
             'thirdparty',
             'analytic',
             'lettered',
+            'letter',
         )
 
 
@@ -116,15 +105,16 @@ class AccountFilter(django_filters.FilterSet):
     thirdparty = django_filters.ModelChoiceFilter(label="Tiers", queryset=ThirdParty.objects)
     analytic = django_filters.ModelChoiceFilter(label="Compte analytique", queryset=Analytic.objects)
     lettered = django_filters.BooleanFilter(label="Lettré", method='filter_lettered')
+    letter = django_filters.CharFilter(label="Lettrage", field_name='letter__code', lookup_expr='iexact')
 
     class Meta:
         model = Transaction
-        fields = ('account', 'thirdparty', 'analytic', 'lettered')
+        fields = ('account', 'thirdparty', 'analytic', 'lettered', 'letter')
         form = AccountFilterForm
 
     @property
     def qs(self):
-        qs = super().qs.order_by('entry__date')
+        qs = super().qs.order_by('entry__date', 'pk')
         qs = qs.select_related('entry', 'account', 'thirdparty', 'analytic')
         return qs
 
@@ -1,12 +1,76 @@
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, HTML
 from django import forms
-from django.db.models import Q
-from .models import Account, Journal, Purchase, ThirdParty, Transaction, Sale, Income, Expenditure, Cashing
+from django.forms.utils import flatatt
+from django.urls import reverse
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+from .models import Account, Purchase, ThirdParty, Transaction, Sale, Income, Expenditure, Cashing
+from .reference import ReferenceChoices, accounts, analytics, journals
+
+
+class ReferenceSelect(forms.Select):
+    "Select joining the option tags rendered once by its ReferenceChoices, only the selected one being rendered again"
+    reference_choices = None
+
+    def render(self, name, value, attrs=None, renderer=None):
+        value = '' if value is None else str(value)
+        options = [format_html('<option value=""{}>{}</option>', mark_safe(' selected' if not value else ''),
+                               '---------')]
+        for key, option in self.reference_choices.load().options:
+            if key == value:
+                option = option.replace('<option ', '<option selected ', 1)
+            options.append(option)
+        return format_html('<select{}>{}</select>', flatatt(self.build_attrs(self.attrs, dict(attrs or {}, name=name))),
+                           mark_safe(''.join(options)))
+
+
+class ReferenceChoiceField(forms.ModelChoiceField):
+    "Choice of reference rows rendered and validated from the reference cache, without any query"
+    widget = ReferenceSelect
+
+    def __init__(self, choices, **kwargs):
+        super().__init__(queryset=choices.reference.model.objects.all(), **kwargs)
+        self.reference_choices = choices
+        self.widget.reference_choices = choices
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.reference_choices.get(value)
+        except (KeyError, ValueError, TypeError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+
+class ThirdPartyAutocomplete(forms.TextInput):
+    "Input turned into a type-ahead on the third parties by accounting/js/autocomplete.js"
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        try:
+            thirdparty = value and ThirdParty.objects.filter(pk=value).first()
+        except (ValueError, TypeError):
+            thirdparty = None
+        context['widget']['attrs'].update({
+            'class': 'autocomplete',
+            'data-url': reverse('accounting:thirdparty_autocomplete'),
+            'data-text': str(thirdparty or ''),
+        })
+        return context
+
+
+class ThirdPartyChoiceField(forms.ModelChoiceField):
+    widget = ThirdPartyAutocomplete
+
+    def __init__(self, **kwargs):
+        super().__init__(queryset=ThirdParty.objects.all(), **kwargs)
+
+
+ANALYTIC_CHOICES = ReferenceChoices(analytics)
 
 
 class PurchaseForm(forms.ModelForm):
-    thirdparty = forms.ModelChoiceField(label="Fournisseur", queryset=ThirdParty.objects.all())
+    thirdparty = ThirdPartyChoiceField(label="Fournisseur")
     amount = forms.DecimalField(label="Montant total", max_digits=8, decimal_places=2)
 
     class Meta:
@@ -20,7 +84,7 @@ class PurchaseForm(forms.ModelForm):
         if purchase:
             assert purchase.year == year
             assert purchase.journal.number == 'HA'
-            self.provider_transaction = purchase.transaction_set.get(account__number__startswith='4')
+            self.provider_transaction = purchase.transaction_set.of_class(4).get()
             self.fields['thirdparty'].initial = self.provider_transaction.thirdparty
             self.fields['amount'].initial = self.provider_transaction.revenue
         else:
@@ -53,7 +117,7 @@ class PurchaseForm(forms.ModelForm):
         # Save purchase entry
         purchase = super().save(commit=False)
         purchase.year = self.year
-        purchase.journal = Journal.objects.get(number="HA")
+        purchase.journal = journals.HA
         purchase.save()
 
         # Save provider transaction
@@ -68,24 +132,25 @@ class PurchaseForm(forms.ModelForm):
 
 
 class PurchaseTransactionForm(forms.ModelForm):
+    account = ReferenceChoiceField(
+        ReferenceChoices(accounts, lambda account: account.category == 6 or account.group == 21), label="Compte"
+    )
+    analytic = ReferenceChoiceField(ANALYTIC_CHOICES, label="Analytique", required=False)
+
     class Meta:
         model = Transaction
         fields = ('account', 'analytic', 'title', 'expense')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['account'].queryset = Account.objects.filter(
-            Q(number__startswith='6') |
-            Q(number__startswith='21')
-        )
         self.fields['expense'].required = True
 
     def clean(self):
         account = self.cleaned_data.get('account')
         analytic = self.cleaned_data.get('analytic')
-        if account and account.number.startswith('6') and not analytic:
+        if account and account.category == 6 and not analytic:
             raise forms.ValidationError("Le compte analytique doit être précisé pour les charges")
-        if account and account.number.startswith('21') and analytic:
+        if account and account.group == 21 and analytic:
             raise forms.ValidationError("Le compte analytique ne doit pas être précisé pour les investissements")
 
 
@@ -100,10 +165,7 @@ class PurchaseFormSet(forms.BaseInlineFormSet):
         )
         formset = formset_class(
             *args,
-            queryset=Transaction.objects.filter(
-                Q(account__number__startswith='6') |
-                Q(account__number__startswith='21')
-            ),
+            queryset=Transaction.objects.of_class(6, 21),
             **kwargs
         )
         formset.helper = FormHelper()
@@ -124,7 +186,7 @@ class PurchaseFormSet(forms.BaseInlineFormSet):
 
 
 class SaleForm(forms.ModelForm):
-    thirdparty = forms.ModelChoiceField(label="Client", queryset=ThirdParty.objects.all())
+    thirdparty = ThirdPartyChoiceField(label="Client")
     amount = forms.DecimalField(label="Montant total", max_digits=8, decimal_places=2)
     deposit = forms.DecimalField(label="Avance versée", max_digits=8, decimal_places=2, initial=0)
 
@@ -144,7 +206,7 @@ class SaleForm(forms.ModelForm):
                 self.fields['deposit'].initial = self.deposit_transaction.expense
             except Transaction.DoesNotExist:
                 self.deposit_transaction = None
-            self.client_transaction = sale.transaction_set.get(account__number__startswith='4')
+            self.client_transaction = sale.transaction_set.of_class(4).get()
             self.fields['thirdparty'].initial = self.client_transaction.thirdparty
             self.fields['amount'].initial = self.client_transaction.expense
             if self.deposit_transaction:
@@ -181,7 +243,7 @@ class SaleForm(forms.ModelForm):
         # Save sale entry
         sale = super().save(commit=False)
         sale.year = self.year
-        sale.journal = Journal.objects.get(number="VT")
+        sale.journal = journals.VT
         sale.save()
 
         # Save client transaction
@@ -200,7 +262,7 @@ class SaleForm(forms.ModelForm):
         # Save deposit transaction
         if deposit != 0:
             if not self.deposit_transaction:
-                account = Account.objects.get(number='4190000')
+                account = accounts.CLIENT_ADVANCE
                 self.deposit_transaction = Transaction(entry=self.instance, account=account)
             self.deposit_transaction.thirdparty = thirdparty
             self.deposit_transaction.expense = deposit
@@ -213,14 +275,15 @@ class SaleForm(forms.ModelForm):
 
 
 class SaleTransactionForm(forms.ModelForm):
+    account = ReferenceChoiceField(ReferenceChoices(accounts, lambda account: account.category == 7), label="Compte")
+    analytic = ReferenceChoiceField(ANALYTIC_CHOICES, label="Analytique")
+
     class Meta:
         model = Transaction
         fields = ('account', 'analytic', 'title', 'revenue')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['account'].queryset = Account.objects.filter(number__startswith='7')
-        self.fields['analytic'].required = True
         self.fields['revenue'].required = True
 
 
@@ -235,7 +298,7 @@ class SaleFormSet(forms.BaseInlineFormSet):
         )
         formset = formset_class(
             *args,
-            queryset=Transaction.objects.filter(account__number__startswith='7'),
+            queryset=Transaction.objects.of_class(7),
             **kwargs
         )
         formset.helper = FormHelper()
@@ -256,7 +319,7 @@ class SaleFormSet(forms.BaseInlineFormSet):
 
 
 class IncomeForm(forms.ModelForm):
-    thirdparty = forms.ModelChoiceField(label="Client", queryset=ThirdParty.objects.all())
+    thirdparty = ThirdPartyChoiceField(label="Client")
     amount = forms.DecimalField(label="Montant", max_digits=8, decimal_places=2)
     method = forms.ChoiceField(label="Moyen de paiement", choices=Income.METHOD_CHOICES)
     deposit = forms.BooleanField(label="Avance", required=False)
@@ -308,19 +371,19 @@ class IncomeForm(forms.ModelForm):
         # Save income entry
         income = super().save(commit=False)
         income.year = self.year
-        income.journal = Journal.objects.get(number="CA" if method == '5300000' else 'BQ')
+        income.journal = journals.CA if method == '5300000' else journals.BQ
         income.save()
 
         # Save client transaction
         client_transaction = self.instance.client_transaction or Transaction(entry=self.instance)
-        client_transaction.account = Account.objects.get(number='4190000') if deposit else thirdparty.account
+        client_transaction.account = accounts.CLIENT_ADVANCE if deposit else thirdparty.account
         client_transaction.thirdparty = thirdparty
         client_transaction.revenue = amount
         client_transaction.save()
 
         # Save cash transaction
         cash_transaction = self.instance.cash_transaction or Transaction(entry=self.instance)
-        cash_transaction.account = Account.objects.get(number=method)
+        cash_transaction.account = accounts.get(method)
         cash_transaction.expense = amount
         cash_transaction.save()
 
@@ -358,18 +421,17 @@ class ExpenditureForm(forms.ModelForm):
         # Save expenditure entry
         expenditure = super().save(commit=False)
         expenditure.year = self.year
-        expenditure.journal = Journal.objects.get(number="CA" if expenditure.method == 3 else 'BQ')
+        expenditure.journal = journals.CA if expenditure.method == 3 else journals.BQ
         expenditure.save()
 
         # Save cash transaction
         cash_transaction = self.instance.cash_transaction or Transaction(entry=self.instance)
         if expenditure.method == 3:
-            number = '5300000'
+            cash_transaction.account = accounts.CASH
         elif expenditure.method == 6:
-            number = '5170000'
+            cash_transaction.account = accounts.CARD
         else:
-            number = '5120000'
-        cash_transaction.account = Account.objects.get(number=number)
+            cash_transaction.account = accounts.BANK
         cash_transaction.revenue = sum([form.cleaned_data['expense'] for form in formset if form.cleaned_data])
         cash_transaction.save()
 
@@ -377,7 +439,7 @@ class ExpenditureForm(forms.ModelForm):
 
 
 class ExpenditureTransactionForm(forms.ModelForm):
-    thirdparty = forms.ModelChoiceField(label="Fournisseur", queryset=ThirdParty.objects.all())
+    thirdparty = ThirdPartyChoiceField(label="Fournisseur")
     deposit = forms.BooleanField(label="Avance", required=False)
 
     class Meta:
@@ -387,14 +449,14 @@ class ExpenditureTransactionForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         try:
-            self.fields['deposit'].initial = self.instance.account.number == '4090000'
+            self.fields['deposit'].initial = self.instance.account_id == accounts.PROVIDER_ADVANCE.pk
         except Account.DoesNotExist:
             self.fields['deposit'].initial = False
 
     def save(self, commit=True):
         transaction = super().save(commit=False)
         if self.cleaned_data['deposit']:
-            transaction.account = Account.objects.get(number='4090000')
+            transaction.account = accounts.PROVIDER_ADVANCE
         else:
             transaction.account = transaction.thirdparty.account
         if commit:
@@ -413,7 +475,7 @@ class ExpenditureFormSet(forms.BaseInlineFormSet):
         )
         formset = formset_class(
             *args,
-            queryset=Transaction.objects.filter(account__number__startswith='4'),
+            queryset=Transaction.objects.of_class(4),
             **kwargs
         )
         formset.helper = FormHelper()
@@ -475,18 +537,18 @@ class CashingForm(forms.ModelForm):
         # Save cashing entry
         cashing = super().save(commit=False)
         cashing.year = self.year
-        cashing.journal = Journal.objects.get(number='BQ')
+        cashing.journal = journals.BQ
         cashing.save()
 
         # Save cashing transaction
         cashing_transaction = self.instance.cashing_transaction or Transaction(entry=self.instance)
-        cashing_transaction.account = Account.objects.get(number=method)
+        cashing_transaction.account = accounts.get(method)
         cashing_transaction.revenue = amount
         cashing_transaction.save()
 
         # Save bank transaction
         bank_transaction = self.instance.bank_transaction or Transaction(entry=self.instance)
-        bank_transaction.account = Account.objects.get(number='5120000')
+        bank_transaction.account = accounts.BANK
         bank_transaction.expense = amount
         bank_transaction.save()
 
@@ -500,7 +562,7 @@ class ThirdPartyForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['account'].queryset = Account.objects.filter(number__startswith='4')
+        self.fields['account'].queryset = Account.objects.of_class(4)
         self.helper = FormHelper()
         self.helper.form_tag = False
         self.helper.layout = Layout(
@@ -0,0 +1,256 @@
+"""
+Import of accounting entries from FEC files or csv exports of the entries.
+
+Rows are grouped by entry, identified by its journal and number, wherever they
+sit in the file, and rows of an entry with different dates reject it. Journals,
+accounts and third parties are resolved through lookup maps loaded once,
+missing accounts and third parties being created. Entries, with their totals,
+and transactions are bulk created by batches, each batch in its own transaction
+along with the refresh of the balance store rows it touches. An invalid row,
+including values exceeding the model limits, rejects its entry only, and the
+error is reported with the line numbers.
+Entries already imported in the year, identified by their journal and number
+in the file, are skipped.
+"""
+import csv
+import datetime
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from django.db.transaction import atomic
+from .models import Account, Entry, Journal, ThirdParty, Transaction, refresh_balances
+
+# A transaction of the imported file, number identifying its entry within the journal
+ImportRow = namedtuple('ImportRow', (
+    'line', 'journal', 'number', 'date', 'account', 'account_title', 'thirdparty', 'thirdparty_title', 'title',
+    'expense', 'revenue',
+))
+
+
+def parse_amount(value):
+    try:
+        return Decimal((value or '').strip().replace(' ', '').replace(',', '.') or 0)
+    except InvalidOperation:
+        raise ValueError("Montant invalide : {}".format(value))
+
+
+def parse_date(value, format):
+    try:
+        return datetime.datetime.strptime((value or '').strip(), format).date()
+    except ValueError:
+        raise ValueError("Date invalide : {}".format(value))
+
+
+def read_fec(reader):
+    "Rows of a FEC file"
+    for line, row in enumerate(reader, 2):
+        yield ImportRow(
+            line, row['JournalCode'], row['EcritureNum'], row['EcritureDate'], row['CompteNum'], row['CompteLib'],
+            row['CompAuxNum'], row['CompAuxLib'], row['EcritureLib'], row['Debit'], row['Credit'],
+        )
+
+
+def read_csv(reader):
+    "Rows of the csv export of the entries"
+    for line, row in enumerate(reader, 2):
+        yield ImportRow(
+            line, row['journal_number'], row['entry_id'], row['date_dmy'], row['account_number'], '',
+            row['thirdparty_number'], '', row['__str__'], row['expense'], row['revenue'],
+        )
+
+
+# Reader and date format of each format, by the first column of its header
+READERS = {
+    'JournalCode': (read_fec, '%Y%m%d'),
+    'journal_number': (read_csv, '%d%m%y'),
+}
+
+
+def read_rows(f):
+    """
+    Rows of an opened FEC or csv file, the format and separator being guessed from its header.
+
+    The ImportRow fields are left as read, parse_row() converts them.
+    """
+    header = f.readline()
+    delimiter = max(('\t', '|', ';'), key=header.count)
+    fields = next(csv.reader([header], delimiter=delimiter), [])
+    if not fields or fields[0] not in READERS:
+        raise ValueError("Format de fichier inconnu")
+    reader, date_format = READERS[fields[0]]
+    for row in reader(csv.DictReader(f, fieldnames=fields, delimiter=delimiter)):
+        yield row._replace(date=(row.date, date_format))
+
+
+def fits(value, field):
+    "Whether the decimal value fits the max_digits and decimal_places of the model field"
+    return value == round(value, field.decimal_places) and abs(value) < 10 ** (field.max_digits - field.decimal_places)
+
+
+def parse_row(row):
+    "ImportRow with its date and amounts converted, raise ValueError if they are invalid"
+    value, date_format = row.date
+    return row._replace(
+        date=parse_date(value, date_format),
+        account=(row.account or '').strip(),
+        thirdparty=(row.thirdparty or '').strip(),
+        title=(row.title or '').strip()[:100],
+        expense=parse_amount(row.expense),
+        revenue=parse_amount(row.revenue),
+    )
+
+
+class Importer:
+    "Import rows into year, see the module docstring"
+    def __init__(self, year, batch_size=1000):
+        self.year = year
+        self.batch_size = batch_size
+        self.journals = dict(Journal.objects.values_list('number', 'pk'))
+        self.accounts = dict(Account.objects.values_list('number', 'pk'))
+        self.thirdparties = dict(ThirdParty.objects.values_list('number', 'pk'))
+        self.imported = set(Entry.objects.filter(year=year).exclude(import_ref='')
+                            .values_list('journal_id', 'import_ref'))
+        self.errors = []
+        self.created = 0
+        self.skipped = 0
+
+    def run(self, rows):
+        "Import the rows of read_rows(), return the number of created entries"
+        groups = {}
+        for row in rows:
+            groups.setdefault((row.journal, row.number), []).append(row)
+        batch = []
+        for group in groups.values():
+            entry = self.validate(group)
+            if entry is not None:
+                batch.append(entry)
+            if len(batch) >= self.batch_size:
+                self.flush(batch)
+                batch = []
+        self.flush(batch)
+        return self.created
+
+    def validate(self, rows):
+        "((journal pk, number), parsed rows) if the rows make a valid new entry, None otherwise"
+        numbers = [row.line for row in rows]
+        if numbers[-1] - numbers[0] == len(numbers) - 1:
+            lines = '-'.join(sorted({str(numbers[0]), str(numbers[-1])}, key=int))
+        else:
+            # Rows of the entry scattered through the file
+            lines = ', '.join(str(number) for number in numbers)
+        journal = self.journals.get(rows[0].journal)
+        if journal is None:
+            self.errors.append((lines, "Journal inconnu : {}".format(rows[0].journal)))
+            return None
+        number = (rows[0].number or '').strip()
+        if not number or len(number) > 20:
+            self.errors.append((lines, "Numéro d'écriture invalide : {}".format(number)))
+            return None
+        if (journal, number) in self.imported:
+            self.skipped += 1
+            return None
+        try:
+            rows = [parse_row(row) for row in rows]
+        except ValueError as e:
+            self.errors.append((lines, str(e)))
+            return None
+        for row in rows:
+            if not row.account.isdigit() or len(row.account) > 7:
+                self.errors.append((str(row.line), "Compte invalide : {}".format(row.account)))
+                return None
+            if len(row.thirdparty) > 4:
+                self.errors.append((str(row.line), "Tiers invalide : {}".format(row.thirdparty)))
+                return None
+            if not self.year.start <= row.date <= self.year.end:
+                self.errors.append((str(row.line), "Date hors de l'exercice : {}".format(row.date)))
+                return None
+            for amount in (row.expense, row.revenue):
+                if not fits(amount, Transaction._meta.get_field('expense')):
+                    self.errors.append((str(row.line), "Montant invalide : {}".format(amount)))
+                    return None
+            # Titles of the accounts and third parties to be created
+            if row.account not in self.accounts and \
+                    len(row.account_title or '') > Account._meta.get_field('title').max_length:
+                self.errors.append((str(row.line), "Intitulé de compte trop long : {}".format(row.account_title)))
+                return None
+            if row.thirdparty and row.thirdparty not in self.thirdparties and \
+                    len(row.thirdparty_title or '') > ThirdParty._meta.get_field('title').max_length:
+                self.errors.append((str(row.line), "Intitulé de tiers trop long : {}".format(row.thirdparty_title)))
+                return None
+        dates = sorted({row.date for row in rows})
+        if len(dates) > 1:
+            self.errors.append((lines, "Dates différentes dans l'écriture : {}".format(
+                ', '.join(str(date) for date in dates)
+            )))
+            return None
+        total = sum(row.revenue for row in rows)
+        if sum(row.expense for row in rows) != total:
+            self.errors.append((lines, "Écriture non équilibrée"))
+            return None
+        if not fits(total, Entry._meta.get_field('revenue')):
+            self.errors.append((lines, "Total de l'écriture trop grand : {}".format(total)))
+            return None
+        self.imported.add((journal, number))
+        return (journal, number), rows
+
+    def flush(self, batch):
+        "Create the accounts, third parties, entries and transactions of the batch, refresh the balances they touch"
+        if not batch:
+            return
+        with atomic():
+            self.create_references(batch)
+            Entry.objects.bulk_create([
+                Entry(year=self.year, journal_id=journal, import_ref=number, date=rows[0].date, title=rows[0].title,
+                      revenue=sum(row.revenue for row in rows), expense=sum(row.expense for row in rows), balance=0)
+                for (journal, number), rows in batch
+            ])
+            # Bulk created entries have no pk on most databases, fetch them by natural key
+            entries = {
+                (journal, number): pk for journal, number, pk in Entry.objects
+                .filter(year=self.year, import_ref__in=[number for (journal, number), rows in batch])
+                .values_list('journal_id', 'import_ref', 'pk')
+            }
+            Transaction.objects.bulk_create([
+                Transaction(
+                    entry_id=entries[key],
+                    title=row.title if row.title != rows[0].title else '',
+                    account_id=self.accounts[row.account],
+                    thirdparty_id=self.thirdparties[row.thirdparty] if row.thirdparty else None,
+                    expense=row.expense,
+                    revenue=row.revenue,
+                )
+                for key, rows in batch for row in rows
+            ])
+            refresh_balances([
+                {
+                    'entry__year': self.year.pk,
+                    'entry__date': row.date,
+                    'account': self.accounts[row.account],
+                    'thirdparty': self.thirdparties[row.thirdparty] if row.thirdparty else None,
+                    'analytic': None,
+                    'reconciliation': None,
+                }
+                for key, rows in batch for row in rows
+            ])
+        self.created += len(batch)
+
+    def create_references(self, batch):
+        "Bulk create the accounts and third parties of the batch missing from the lookup maps"
+        accounts = {}
+        thirdparties = {}
+        for key, rows in batch:
+            for row in rows:
+                if row.account not in self.accounts and row.account not in accounts:
+                    accounts[row.account] = Account(number=row.account, title=row.account_title or row.account)
+                    accounts[row.account].classify()
+                if row.thirdparty and row.thirdparty not in self.thirdparties:
+                    thirdparties.setdefault(row.thirdparty, (row.thirdparty_title or row.thirdparty, row.account))
+        if accounts:
+            Account.objects.bulk_create(accounts.values())
+            self.accounts.update(Account.objects.filter(number__in=accounts).values_list('number', 'pk'))
+        if thirdparties:
+            ThirdParty.objects.bulk_create([
+                ThirdParty(number=number, title=title, account_id=self.accounts[account],
+                           type=ThirdParty.OTHER)
+                for number, (title, account) in thirdparties.items()
+            ])
+            self.thirdparties.update(ThirdParty.objects.filter(number__in=thirdparties).values_list('number', 'pk'))
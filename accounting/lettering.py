@@ -0,0 +1,115 @@
+from bisect import bisect_right
+
+# Maximum number of candidate lines tried when searching a subset summing to a target
+SUBSET_STEPS = 10000
+
+
+def find_subset(amounts, target, size, skip=()):
+    """
+    Indexes of at most size amounts summing to target, None if there are none.
+
+    amounts are positive and sorted, the indexes of skip are left out. Pairs
+    are found with two pointers when size allows them, single amounts and
+    larger subsets by a depth first search bounded by SUBSET_STEPS.
+    """
+    if size >= 2:
+        i, j = 0, bisect_right(amounts, target) - 1
+        while i < j:
+            if i in skip:
+                i += 1
+                continue
+            if j in skip:
+                j -= 1
+                continue
+            total = amounts[i] + amounts[j]
+            if total == target:
+                return [i, j]
+            if total < target:
+                i += 1
+            else:
+                j -= 1
+        if size == 2:
+            return None
+    steps = SUBSET_STEPS
+
+    def search(start, target, size):
+        nonlocal steps
+        for k in range(start, len(amounts)):
+            if amounts[k] > target or steps <= 0:
+                return None
+            if k in skip:
+                continue
+            steps -= 1
+            if amounts[k] == target:
+                return [k]
+            if size > 1:
+                found = search(k + 1, target - amounts[k], size - 1)
+                if found is not None:
+                    return [k] + found
+        return None
+
+    return search(0, target, size)
+
+
+def match_zero_sum(lines, size=4):
+    """
+    Groups of lines summing to zero.
+
+    lines is a sequence of (pk, amount) with integer amounts, in the order to
+    match them. Opposite amounts are paired first, then the largest remaining
+    lines are matched against up to size - 1 lines of opposite sign. What is
+    left is grouped altogether if it is balanced.
+    """
+    groups = []
+    pending = {}
+    for pk, amount in lines:
+        if not amount:
+            continue
+        opposites = pending.get(-amount)
+        if opposites:
+            groups.append([opposites.pop(0), pk])
+        else:
+            pending.setdefault(amount, []).append(pk)
+    rest = sorted(
+        ((pk, amount) for amount, pks in pending.items() for pk in pks),
+        key=lambda line: -abs(line[1])
+    )
+    # Sorted (magnitude, pk) of the lines by sign, the matched ones being dropped once they are the majority
+    unmatched = {
+        True: sorted((amount, pk) for pk, amount in rest if amount > 0),
+        False: sorted((-amount, pk) for pk, amount in rest if amount < 0),
+    }
+    magnitudes = {}
+    indexes = {}
+    # Indexes of the matched lines still in unmatched, by sign
+    dropped = {}
+    grouped = set()
+
+    def compact(sign):
+        unmatched[sign] = [line for line in unmatched[sign] if line[1] not in grouped]
+        magnitudes[sign] = [magnitude for magnitude, _ in unmatched[sign]]
+        indexes.update((pk, index) for index, (_, pk) in enumerate(unmatched[sign]))
+        dropped[sign] = set()
+
+    compact(True)
+    compact(False)
+    for pk, amount in rest:
+        if pk in grouped:
+            continue
+        own, opposite = amount > 0, amount < 0
+        found = find_subset(magnitudes[opposite], abs(amount), size - 1, dropped[opposite])
+        if found is None:
+            continue
+        groups.append([pk] + [unmatched[opposite][index][1] for index in found])
+        grouped.update(groups[-1])
+        dropped[own].add(indexes[pk])
+        dropped[opposite].update(found)
+        for sign in (own, opposite):
+            if len(dropped[sign]) * 2 > len(unmatched[sign]):
+                compact(sign)
+    compact(True)
+    compact(False)
+    left = unmatched[True] + unmatched[False]
+    if len(left) > 1 and sum(m for m, _ in unmatched[True]) == sum(m for m, _ in unmatched[False]):
+        groups.append([pk for _, pk in left])
+    return groups
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from ...models import Year, Transaction
+
+
+class Command(BaseCommand):
+    help = "Letter the third party transactions summing to zero"
+
+    def add_arguments(self, parser):
+        parser.add_argument('year_pk')
+        parser.add_argument('--account', help="Only letter the account with this number")
+        parser.add_argument('--size', type=int, default=4, help="Maximum number of transactions per letter")
+        parser.add_argument('--dry-run', action='store_true', help="Count the letters without saving them")
+
+    def handle(self, *args, **options):
+        year = Year.objects.get(pk=options['year_pk'])
+        transactions = Transaction.objects.filter(entry__year=year)
+        if options['account']:
+            transactions = transactions.filter(account__number=options['account'])
+        if options['dry_run']:
+            count = len(transactions.letterings(options['size']))
+        else:
+            count = transactions.auto_letter(options['size'])
+        self.stdout.write("{} letters {}in {}".format(count, "found " if options['dry_run'] else "created ", year))
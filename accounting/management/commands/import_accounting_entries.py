@@ -1,21 +1,30 @@
-import csv
-import datetime
-from django.core.management.base import BaseCommand
-from ...models import Account, Entry
+from django.core.management.base import BaseCommand, CommandError
+from ...importer import Importer, read_rows
+from ...models import Year
 
 
 class Command(BaseCommand):
+    help = "Import the entries of a FEC file or of a csv export of the entries, skipping the ones already imported"
+
     def add_arguments(self, parser):
+        parser.add_argument('year_pk')
         parser.add_argument('file')
+        parser.add_argument('--encoding', default='utf-8-sig', help="Encoding of the file, often latin-1 for FEC")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of entries created per transaction")
 
     def handle(self, *args, **options):
-        with open(options['file'], 'r') as f:
-            reader = csv.reader(f, delimiter=";")
-            for row in reader:
-                if row[8] != 'G':
-                    continue
-                if row[2][0] not in ('6', '7'):
-                    continue
-                date = datetime.date(int(row[1][4:6]), int(row[1][2:4]), int(row[1][0:2]))
-                account, created = Account.objects.get_or_create(number=row[2], defaults={'title': row[3]})
-                Entry.objects.create(date=date, account=account, title=row[6], amount=row[7])
+        try:
+            year = Year.objects.get(pk=options['year_pk'])
+        except Year.DoesNotExist:
+            raise CommandError("Unknown year {}".format(options['year_pk']))
+        importer = Importer(year, batch_size=options['batch_size'])
+        with open(options['file'], encoding=options['encoding'], newline='') as f:
+            try:
+                importer.run(read_rows(f))
+            except ValueError as e:
+                raise CommandError(e)
+        for line, message in importer.errors:
+            self.stderr.write("Line {}: {}".format(line, message))
+        self.stdout.write("{} entries imported, {} already imported, {} errors".format(
+            importer.created, importer.skipped, len(importer.errors)
+        ))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...models import BALANCE_STORES, Entry, Year
+
+
+class Command(BaseCommand):
+    help = "Rebuild the balance stores and the entry totals from the transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('year_pk', nargs='*')
+
+    def handle(self, *args, **options):
+        years = Year.objects.all()
+        if options['year_pk']:
+            years = years.filter(pk__in=options['year_pk'])
+        for year in years:
+            with transaction.atomic():
+                for store in BALANCE_STORES:
+                    store.rebuild(year)
+                Entry.objects.filter(year=year).refresh_totals()
+            self.stdout.write("Rebuilt balances of {}".format(year))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...models import BankStatement
+
+
+class Command(BaseCommand):
+    help = "Reconcile the bank transactions with the lines of a statement file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('bankstatement_pk')
+        parser.add_argument('--window', type=int, default=5, help="Maximum distance in days between matched dates")
+
+    def handle(self, *args, **options):
+        statement = BankStatement.objects.get(pk=options['bankstatement_pk'])
+        try:
+            unmatched = statement.reconcile(options['window'])
+        except ValueError as e:
+            raise CommandError(e)
+        for line in unmatched:
+            self.stdout.write("Unmatched line: {:%d/%m/%Y} {} {}".format(line.date, line.amount, line.title))
+        self.stdout.write("{} unmatched lines".format(len(unmatched)))
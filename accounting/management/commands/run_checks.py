@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from ...checks import run_checks
+from ...models import Year
+
+
+class Command(BaseCommand):
+    help = "Refresh the consistency check results of the entries modified since the last run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('year_pk', nargs='*')
+        parser.add_argument('--full', action='store_true', help="Check all the entries")
+
+    def handle(self, *args, **options):
+        years = Year.objects.all()
+        if options['year_pk']:
+            years = years.filter(pk__in=options['year_pk'])
+        for year in years:
+            results = run_checks(year, full=options['full'])
+            self.stdout.write("Checked {}: {} results refreshed".format(year, len(results)))
@@ -0,0 +1,54 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_ledger_balances(apps, schema_editor):
+    Transaction = apps.get_model('accounting', 'Transaction')
+    LedgerBalance = apps.get_model('accounting', 'LedgerBalance')
+    rows = Transaction.objects \
+        .values('entry__year', 'entry__date', 'account', 'thirdparty', 'analytic') \
+        .order_by() \
+        .annotate(total_revenue=models.Sum('revenue'), total_expense=models.Sum('expense'))
+    LedgerBalance.objects.bulk_create([
+        LedgerBalance(
+            year_id=row['entry__year'],
+            date=row['entry__date'],
+            account_id=row['account'],
+            thirdparty_id=row['thirdparty'],
+            analytic_id=row['analytic'],
+            revenue=row['total_revenue'],
+            expense=row['total_expense'],
+        ) for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0061_auto_20201221_2019'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Crédit')),
+                ('expense', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Débit')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Account', verbose_name='Compte')),
+                ('analytic', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='accounting.Analytic', verbose_name='Analytique')),
+                ('thirdparty', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='accounting.ThirdParty', verbose_name='Tiers')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Year', verbose_name='Exercice')),
+            ],
+            options={
+                'verbose_name': 'Solde journalier',
+                'verbose_name_plural': 'Soldes journaliers',
+                'unique_together': {('year', 'date', 'account', 'thirdparty', 'analytic')},
+                'index_together': {('year', 'account', 'date'), ('year', 'analytic', 'date'), ('year', 'thirdparty', 'date')},
+            },
+        ),
+        migrations.RunPython(fill_ledger_balances, migrations.RunPython.noop),
+    ]
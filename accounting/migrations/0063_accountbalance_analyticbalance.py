@@ -0,0 +1,69 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_year_balances(apps, schema_editor):
+    Transaction = apps.get_model('accounting', 'Transaction')
+    for model_name, key in (('AccountBalance', 'account'), ('AnalyticBalance', 'analytic')):
+        Balance = apps.get_model('accounting', model_name)
+        rows = Transaction.objects \
+            .exclude(**{key: None}) \
+            .values('entry__year', key) \
+            .order_by() \
+            .annotate(total_revenue=models.Sum('revenue'), total_expense=models.Sum('expense'))
+        Balance.objects.bulk_create([
+            Balance(**{
+                'year_id': row['entry__year'],
+                key + '_id': row[key],
+                'revenue': row['total_revenue'],
+                'expense': row['total_expense'],
+                'balance': row['total_revenue'] - row['total_expense'],
+            }) for row in rows
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0062_ledgerbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Crédit')),
+                ('expense', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Débit')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Solde')),
+                ('analytic', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Analytic', verbose_name='Analytique')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Year', verbose_name='Exercice')),
+            ],
+            options={
+                'verbose_name': 'Balance analytique',
+                'verbose_name_plural': 'Balances analytiques',
+                'unique_together': {('year', 'analytic')},
+                'index_together': {('year', 'balance')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Crédit')),
+                ('expense', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Débit')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Solde')),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Account', verbose_name='Compte')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Year', verbose_name='Exercice')),
+            ],
+            options={
+                'verbose_name': 'Balance générale',
+                'verbose_name_plural': 'Balances générales',
+                'unique_together': {('year', 'account')},
+                'index_together': {('year', 'balance')},
+            },
+        ),
+        migrations.RunPython(fill_year_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0063_accountbalance_analyticbalance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bankstatement',
+            name='data',
+            field=models.FileField(blank=True, upload_to='releves', verbose_name='Fichier CAMT.053, OFX ou CSV'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.13 on 2026-10-18 10:50
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def fill_entry_totals(apps, schema_editor):
+    Entry = apps.get_model('accounting', 'Entry')
+    Transaction = apps.get_model('accounting', 'Transaction')
+    transactions = Transaction.objects.filter(entry=models.OuterRef('pk')).order_by().values('entry')
+    revenue = Coalesce(models.Subquery(transactions.annotate(sum=models.Sum('revenue')).values('sum')), 0)
+    expense = Coalesce(models.Subquery(transactions.annotate(sum=models.Sum('expense')).values('sum')), 0)
+    Entry.objects.update(revenue=revenue, expense=expense, balance=revenue - expense)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0064_bankstatement_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='balance',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='Solde'),
+        ),
+        migrations.AddField(
+            model_name='entry',
+            name='expense',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='Débit'),
+        ),
+        migrations.AddField(
+            model_name='entry',
+            name='revenue',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10, verbose_name='Crédit'),
+        ),
+        migrations.RunPython(fill_entry_totals, migrations.RunPython.noop),
+    ]
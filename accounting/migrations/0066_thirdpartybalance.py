@@ -0,0 +1,63 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_thirdparty_balances(apps, schema_editor):
+    Transaction = apps.get_model('accounting', 'Transaction')
+    ThirdPartyBalance = apps.get_model('accounting', 'ThirdPartyBalance')
+    rows = Transaction.objects \
+        .exclude(thirdparty=None) \
+        .values('entry__year', 'thirdparty') \
+        .order_by() \
+        .annotate(
+            total_revenue=models.Sum('revenue'),
+            total_expense=models.Sum('expense'),
+            total_balancex=models.Sum(
+                models.F('revenue') - models.F('expense'),
+                filter=~models.Q(account__number__in=('4090000', '4190000'))
+            ),
+            total_not_lettered=models.Count('id', filter=models.Q(letter=None)),
+        )
+    ThirdPartyBalance.objects.bulk_create([
+        ThirdPartyBalance(
+            year_id=row['entry__year'],
+            thirdparty_id=row['thirdparty'],
+            revenue=row['total_revenue'],
+            expense=row['total_expense'],
+            balance=row['total_revenue'] - row['total_expense'],
+            balancex=row['total_balancex'] or 0,
+            not_lettered=row['total_not_lettered'],
+        ) for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0065_entry_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThirdPartyBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Crédit')),
+                ('expense', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Débit')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Solde')),
+                ('balancex', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Solde hors avances')),
+                ('not_lettered', models.PositiveIntegerField(default=0, verbose_name='Non lettrées')),
+                ('thirdparty', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.ThirdParty', verbose_name='Tiers')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Year', verbose_name='Exercice')),
+            ],
+            options={
+                'verbose_name': 'Balance tiers',
+                'verbose_name_plural': 'Balances tiers',
+                'unique_together': {('year', 'thirdparty')},
+                'index_together': {('year', 'balancex'), ('year', 'balance')},
+            },
+        ),
+        migrations.RunPython(fill_thirdparty_balances, migrations.RunPython.noop),
+    ]
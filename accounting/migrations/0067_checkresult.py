@@ -0,0 +1,41 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0066_thirdpartybalance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Modifié le'),
+        ),
+        migrations.AddField(
+            model_name='year',
+            name='checked',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Contrôlé le'),
+        ),
+        migrations.CreateModel(
+            name='CheckResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('check', models.CharField(max_length=30, verbose_name='Contrôle')),
+                ('date', models.DateTimeField(auto_now_add=True, verbose_name='Date')),
+                ('entry', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='accounting.Entry', verbose_name='Écriture')),
+                ('letter', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='accounting.Letter', verbose_name='Lettrage')),
+                ('transaction', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='accounting.Transaction', verbose_name='Transaction')),
+                ('year', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.Year', verbose_name='Exercice')),
+            ],
+            options={
+                'verbose_name': 'Résultat de contrôle',
+                'verbose_name_plural': 'Résultats de contrôle',
+                'index_together': {('year', 'check')},
+            },
+        ),
+    ]
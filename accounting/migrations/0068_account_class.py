@@ -0,0 +1,49 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+# Copy of Account.ROLE_PREFIXES at the time of the migration
+ROLE_PREFIXES = (
+    ('512', 1),
+    ('53', 2),
+    ('411', 3),
+    ('401', 4),
+)
+
+
+def classify_accounts(apps, schema_editor):
+    Account = apps.get_model('accounting', 'Account')
+    accounts = list(Account.objects.all())
+    for account in accounts:
+        account.category = int(account.number[:1])
+        account.group = int(account.number[:2])
+        account.role = next((role for prefix, role in ROLE_PREFIXES if account.number.startswith(prefix)), None)
+    Account.objects.bulk_update(accounts, ('category', 'group', 'role'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0067_checkresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='category',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, editable=False, verbose_name='Classe'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='group',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, editable=False, verbose_name='Groupe'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='account',
+            name='role',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Banque'), (2, 'Caisse'), (3, 'Client'), (4, 'Fournisseur')], db_index=True, editable=False, null=True, verbose_name='Rôle'),
+        ),
+        migrations.RunPython(classify_accounts, migrations.RunPython.noop),
+    ]
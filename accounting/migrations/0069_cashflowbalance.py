@@ -0,0 +1,46 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:25
+
+from django.db import migrations, models
+
+
+def fill_cash_flow_balances(apps, schema_editor):
+    Transaction = apps.get_model('accounting', 'Transaction')
+    CashFlowBalance = apps.get_model('accounting', 'CashFlowBalance')
+    rows = Transaction.objects \
+        .filter(account__role__in=(1, 2), reconciliation__isnull=False) \
+        .values('reconciliation') \
+        .order_by() \
+        .annotate(total_revenue=models.Sum('revenue'), total_expense=models.Sum('expense'))
+    CashFlowBalance.objects.bulk_create([
+        CashFlowBalance(
+            date=row['reconciliation'],
+            revenue=row['total_revenue'],
+            expense=row['total_expense'],
+            balance=row['total_revenue'] - row['total_expense'],
+        ) for row in rows
+    ])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0068_account_class'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CashFlowBalance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Crédit')),
+                ('expense', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Débit')),
+                ('date', models.DateField(unique=True, verbose_name='Date')),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Solde')),
+                ('modified', models.DateTimeField(auto_now=True, verbose_name='Modifié le')),
+            ],
+            options={
+                'verbose_name': 'Trésorerie journalière',
+                'verbose_name_plural': 'Trésorerie journalière',
+            },
+        ),
+        migrations.RunPython(fill_cash_flow_balances, migrations.RunPython.noop),
+    ]
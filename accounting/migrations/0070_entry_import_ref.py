@@ -0,0 +1,22 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0069_cashflowbalance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='import_ref',
+            field=models.CharField(blank=True, editable=False, max_length=20, verbose_name="Référence d'import"),
+        ),
+        migrations.AlterIndexTogether(
+            name='entry',
+            index_together={('year', 'journal', 'import_ref')},
+        ),
+    ]
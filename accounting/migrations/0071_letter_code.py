@@ -0,0 +1,75 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Copy of models.letter_code at the time of the migration
+def letter_code(number):
+    length = 2
+    while number >= 26 ** length:
+        number -= 26 ** length
+        length += 1
+    code = ''
+    for i in range(length):
+        code = chr(number % 26 + 65) + code
+        number //= 26
+    return code
+
+
+def code_letters(apps, schema_editor):
+    "Number the letters per account and third party of their transactions, in creation order"
+    Letter = apps.get_model('accounting', 'Letter')
+    Transaction = apps.get_model('accounting', 'Transaction')
+    scopes = {}
+    for letter, account, thirdparty in Transaction.objects.filter(letter__isnull=False).order_by('pk') \
+            .values_list('letter', 'account', 'thirdparty'):
+        scopes.setdefault(letter, (account, thirdparty))
+    letters = list(Letter.objects.order_by('pk'))
+    last = {}
+    for letter in letters:
+        scope = scopes.get(letter.pk, (None, None))
+        last[scope] = last.get(scope, -1) + 1
+        letter.account_id, letter.thirdparty_id = scope
+        letter.number = last[scope]
+        letter.code = letter_code(letter.number)
+    Letter.objects.bulk_update(letters, ('account', 'thirdparty', 'number', 'code'), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0070_entry_import_ref'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='letter',
+            options={'verbose_name': 'Lettrage', 'verbose_name_plural': 'Lettrages'},
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='account',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='accounting.Account', verbose_name='Compte'),
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='code',
+            field=models.CharField(blank=True, db_index=True, max_length=10, verbose_name='Code'),
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='number',
+            field=models.PositiveIntegerField(default=0, verbose_name='Numéro'),
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='thirdparty',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='accounting.ThirdParty', verbose_name='Tiers'),
+        ),
+        migrations.RunPython(code_letters, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='letter',
+            unique_together={('account', 'thirdparty', 'number')},
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:44
+
+import datetime
+from django.db import migrations, models
+
+
+def date_letters(apps, schema_editor):
+    "Date the existing letters from the last entry of their transactions, when they could be lettered at the earliest"
+    Letter = apps.get_model('accounting', 'Letter')
+    letters = list(Letter.objects.annotate(last=models.Max('transaction__entry__date')).filter(last__isnull=False))
+    for letter in letters:
+        letter.date = letter.last
+    Letter.objects.bulk_update(letters, ('date', ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0071_letter_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='letter',
+            name='date',
+            field=models.DateField(default=datetime.date.today, verbose_name='Date'),
+        ),
+        migrations.RunPython(date_letters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.2.13 on 2026-10-18 13:02
+
+from django.db import migrations
+
+
+def declassify_accounts(apps, schema_editor):
+    "Drop the bank and cash roles of the accounts other than 5120000 and 5300000"
+    Account = apps.get_model('accounting', 'Account')
+    Account.objects.filter(role__in=(1, 2)).exclude(number__in=('5120000', '5300000')).update(role=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0072_letter_date'),
+    ]
+
+    operations = [
+        migrations.RunPython(declassify_accounts, migrations.RunPython.noop),
+    ]
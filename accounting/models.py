@@ -1,12 +1,23 @@
 import datetime
+from functools import lru_cache, reduce
+from operator import or_
+from hashlib import sha256
 import fintech
 fintech.register()  # noqa
 from fintech import sepa
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import connections, models
+from django.db.transaction import atomic
 from django.db.models.functions import Coalesce
 from django.urls import reverse
+from django.utils.timezone import now
 from localflavor.generic.models import IBANField, BICField
+from .bank import match_lines, parse_statement
+from .lettering import match_zero_sum
+
+# Seconds a generated transfer order stays cached
+SEPA_CACHE_TIMEOUT = 7 * 24 * 3600
 
 
 class Year(models.Model):
@@ -14,6 +25,7 @@ class Year(models.Model):
     start = models.DateField(verbose_name="Début")
     end = models.DateField(verbose_name="Fin")
     opened = models.BooleanField(verbose_name="Ouvert", default=False)
+    checked = models.DateTimeField(verbose_name="Contrôlé le", null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = "Exercice"
@@ -22,6 +34,71 @@ class Year(models.Model):
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        "Freeze the balance snapshots when the year is closed"
+        closing = self.pk and not self.opened and Year.objects.filter(pk=self.pk, opened=True).exists()
+        result = super().save(*args, **kwargs)
+        if closing:
+            for store in (AccountBalance, AnalyticBalance):
+                store.rebuild(self)
+        return result
+
+    def carry_forward_transactions(self, entry):
+        "Unsaved transactions of the opening entry carrying forward the balances of the year"
+        unlettered = Transaction.objects.filter(entry__year=self, letter=None)
+        transactions = []
+        balances = unlettered.of_class(1, 2, 5).values('account') \
+            .annotate(balance=models.Sum('revenue') - models.Sum('expense')).order_by('account__number')
+        for row in balances:
+            transactions.append(Transaction(
+                entry=entry,
+                account_id=row['account'],
+                expense=max(-row['balance'], 0),
+                revenue=max(row['balance'], 0)
+            ))
+        for row in unlettered.of_class(4).order_by('account__number', 'entry__date', 'pk') \
+                .values('title', 'account', 'thirdparty', 'expense', 'revenue'):
+            transactions.append(Transaction(
+                entry=entry,
+                title=row['title'],
+                account_id=row['account'],
+                thirdparty_id=row['thirdparty'],
+                expense=row['expense'],
+                revenue=row['revenue']
+            ))
+        balance = Transaction.objects.filter(entry__year=self).of_class(6, 7) \
+            .aggregate(balance=Coalesce(models.Sum('revenue') - models.Sum('expense'), 0))['balance']
+        transactions.append(Transaction(
+            entry=entry,
+            title="Résultat de l'exercice {}".format(self),
+            account=Account.objects.get(number='1290000' if balance < 0 else '1200000'),
+            expense=max(-balance, 0),
+            revenue=max(balance, 0)
+        ))
+        return transactions
+
+    def carry_forward(self, year, commit=True):
+        """
+        Build the "A nouveaux" entry of year from the balances of self.
+
+        An existing opening entry of year is replaced, so that closing can be run again.
+        Return the transactions of the entry, only saved if commit is true.
+        """
+        journal = Journal.objects.get(number='OD')
+        entry = Entry(year=year, date=year.start, title="A nouveaux", journal=journal)
+        transactions = self.carry_forward_transactions(entry)
+        if not commit:
+            return transactions
+        with atomic():
+            for old in Entry.objects.filter(year=year, journal=journal, date=year.start, title=entry.title):
+                old.delete()
+            entry.save()
+            for obj in transactions:
+                obj.entry = entry
+            Transaction.objects.bulk_create(transactions)
+            entry.transaction_set.refresh_balances()
+        return transactions
+
 
 class Journal(models.Model):
     number = models.CharField(verbose_name="Numéro", max_length=2, unique=True)
@@ -35,9 +112,49 @@ class Journal(models.Model):
         return "{} : {}".format(self.number, self.title)
 
 
+def class_filter(classes, lookup=''):
+    "Q of the accounts of one digit classes or two digits groups, lookup leading to the account"
+    return models.Q(**{lookup + 'category__in': [number for number in classes if number < 10]}) | \
+        models.Q(**{lookup + 'group__in': [number for number in classes if number >= 10]})
+
+
+class AccountQuerySet(models.QuerySet):
+    def of_class(self, *classes):
+        "Accounts of the given classes (6) or groups (21)"
+        return self.filter(class_filter(classes))
+
+    def of_role(self, *roles):
+        return self.filter(role__in=roles)
+
+
 class Account(models.Model):
+    BANK = 1
+    CASH = 2
+    CLIENT = 3
+    PROVIDER = 4
+    ROLE_CHOICES = (
+        (BANK, "Banque"),
+        (CASH, "Caisse"),
+        (CLIENT, "Client"),
+        (PROVIDER, "Fournisseur"),
+    )
+    # The bank and cash roles belong to these single accounts only, other 512x and 53x accounts having none
+    ROLE_PREFIXES = (
+        ('5120000', BANK),
+        ('5300000', CASH),
+        ('411', CLIENT),
+        ('401', PROVIDER),
+    )
+
     number = models.CharField(verbose_name="Numéro", max_length=7, unique=True)
     title = models.CharField(verbose_name="Intitulé", max_length=100)
+    # Derived from the number by classify()
+    category = models.PositiveSmallIntegerField(verbose_name="Classe", db_index=True, editable=False)
+    group = models.PositiveSmallIntegerField(verbose_name="Groupe", db_index=True, editable=False)
+    role = models.PositiveSmallIntegerField(verbose_name="Rôle", choices=ROLE_CHOICES, null=True, db_index=True,
+                                            editable=False)
+
+    objects = AccountQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Compte"
@@ -46,13 +163,27 @@ class Account(models.Model):
     def __str__(self):
         return "{} : {}".format(self.number, self.title)
 
+    def classify(self):
+        "Set the class, group and role from the number"
+        self.category = int(self.number[:1])
+        self.group = int(self.number[:2])
+        self.role = next((role for prefix, role in self.ROLE_PREFIXES if self.number.startswith(prefix)), None)
+
+    def save(self, *args, **kwargs):
+        self.classify()
+        return super().save(*args, **kwargs)
+
 
 class ThirdParty(models.Model):
+    CLIENT = 0
+    PROVIDER = 1
+    EMPLOYEE = 2
+    OTHER = 3
     TYPE_CHOICES = (
-        (0, "Client"),
-        (1, "Fournisseur"),
-        (2, "Salarié"),
-        (3, "Autre"),
+        (CLIENT, "Client"),
+        (PROVIDER, "Fournisseur"),
+        (EMPLOYEE, "Salarié"),
+        (OTHER, "Autre"),
     )
 
     number = models.CharField(verbose_name="Numéro", max_length=4, unique=True)
@@ -88,15 +219,44 @@ class Analytic(models.Model):
         return "{} : {}".format(self.number, self.title)
 
 
-class EntryManager(models.Manager):
-    def get_queryset(self):
-        qs = super().get_queryset()
-        qs = qs.annotate(
-            revenue=Coalesce(models.Sum('transaction__revenue'), 0),
-            expense=Coalesce(models.Sum('transaction__expense'), 0),
-            balance=Coalesce(models.Sum('transaction__revenue') - models.Sum('transaction__expense'), 0)
+class BalanceQuerySet(models.QuerySet):
+    def totals(self):
+        "Sum of revenues, expenses and balance of the queryset"
+        totals = self.aggregate(
+            revenue=Coalesce(models.Sum('revenue'), 0),
+            expense=Coalesce(models.Sum('expense'), 0),
+        )
+        totals['balance'] = totals['revenue'] - totals['expense']
+        return totals
+
+
+class EntryQuerySet(BalanceQuerySet):
+    def with_live_totals(self):
+        "Annotate the totals computed from the transactions, as live_revenue, live_expense and live_balance"
+        return self.annotate(
+            live_revenue=Coalesce(models.Sum('transaction__revenue'), 0),
+            live_expense=Coalesce(models.Sum('transaction__expense'), 0),
+            live_balance=Coalesce(models.Sum('transaction__revenue') - models.Sum('transaction__expense'), 0)
+        )
+
+    def with_roles(self):
+        "Prefetch the transactions with their accounts and third parties, to resolve role properties in memory"
+        return self.prefetch_related(models.Prefetch(
+            'transaction_set',
+            queryset=Transaction.objects.select_related('account', 'thirdparty').order_by('pk')
+        ))
+
+    def refresh_totals(self):
+        "Recompute the stored totals of the entries from their transactions"
+        transactions = Transaction.objects.filter(entry=models.OuterRef('pk')).order_by().values('entry')
+        revenue = Coalesce(models.Subquery(transactions.annotate(sum=models.Sum('revenue')).values('sum')), 0)
+        expense = Coalesce(models.Subquery(transactions.annotate(sum=models.Sum('expense')).values('sum')), 0)
+        return Entry.objects.filter(pk__in=self.values('pk')).update(
+            revenue=revenue,
+            expense=expense,
+            balance=revenue - expense,
+            modified=now(),
         )
-        return qs
 
 
 class Entry(models.Model):
@@ -106,11 +266,23 @@ class Entry(models.Model):
     title = models.CharField(verbose_name="Intitulé", max_length=100)
     scan = models.FileField(verbose_name="Justificatif", upload_to='justificatif', blank=True)
     exported = models.BooleanField(verbose_name="Exporté", default=False)
+    # Totals of the transactions, maintained by Transaction saves
+    revenue = models.DecimalField(verbose_name="Crédit", max_digits=10, decimal_places=2, default=0, editable=False)
+    expense = models.DecimalField(verbose_name="Débit", max_digits=10, decimal_places=2, default=0, editable=False)
+    balance = models.DecimalField(verbose_name="Solde", max_digits=10, decimal_places=2, default=0, editable=False)
+    # Last change of the entry or its transactions, for incremental checks
+    modified = models.DateTimeField(verbose_name="Modifié le", auto_now=True, db_index=True)
+    # Number of the entry in the imported file, see accounting.importer
+    import_ref = models.CharField(verbose_name="Référence d'import", max_length=20, blank=True, editable=False)
 
-    objects = EntryManager()
+    # Stored totals of the transactions, see EntryQuerySet.refresh_totals()
+    TOTAL_FIELDS = ('revenue', 'expense', 'balance')
+
+    objects = EntryQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Écriture"
+        index_together = ('year', 'journal', 'import_ref')
 
     def __str__(self):
         return self.title
@@ -123,17 +295,66 @@ class Entry(models.Model):
     balanced.short_description = "Équilibré"
     balanced.boolean = True
 
+    def role_transaction(self, test):
+        "The transaction whose account passes test, from the with_roles() cache if any"
+        if 'transaction_set' in getattr(self, '_prefetched_objects_cache', {}):
+            transactions = self.transaction_set.all()
+        else:
+            transactions = self.transaction_set.select_related('account', 'thirdparty')
+        transactions = [transaction for transaction in transactions if test(transaction.account)]
+        if len(transactions) > 1:
+            raise Transaction.MultipleObjectsReturned(
+                "{} transactions of {} match the role".format(len(transactions), self)
+            )
+        return transactions[0] if transactions else None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        "Snapshot the loaded year and date, so that save() knows without a query whether the balances move"
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = (instance.__dict__.get('year_id'), instance.__dict__.get('date'))
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded = (self.__dict__.get('year_id'), self.__dict__.get('date'))
+
+    def save(self, *args, **kwargs):
+        """
+        Save the entry without its totals, written by refresh_totals() only, and refresh balances if the date or
+        the year changed.
+
+        The totals may have been loaded before a change of the transactions, and must not be written back.
+        """
+        adding = self._state.adding
+        if not adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.TOTAL_FIELDS
+            ]
+        moving = not adding and self.pk and getattr(self, '_loaded', None) != (self.year_id, self.date)
+        keys = list(self.transaction_set.balance_keys()) if moving else []
+        result = super().save(*args, **kwargs)
+        self._loaded = (self.year_id, self.date)
+        moved = [dict(key, entry__year=self.year_id, entry__date=self.date) for key in keys]
+        if moved != keys:
+            refresh_balances(keys + moved, ('entry', ))
+        return result
+
     def delete(self, *args, **kwargs):
-        "Delete lettering if need be"
+        "Delete lettering and refresh balances if need be"
+        keys = list(self.transaction_set.balance_keys())
         Letter.objects.filter(transaction__entry=self).delete()
-        return super().delete(*args, **kwargs)
+        result = super().delete(*args, **kwargs)
+        refresh_balances(keys)
+        return result
 
 
 class Purchase(Entry):
     deadline = models.DateField(verbose_name="Date limite", null=True, blank=True)
     number = models.CharField(verbose_name="Numéro", max_length=100, blank=True)
 
-    objects = EntryManager()
+    objects = EntryQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Facture fournisseur"
@@ -143,7 +364,7 @@ class Purchase(Entry):
 class Sale(Entry):
     number = models.CharField(verbose_name="Numéro", max_length=100, blank=True)
 
-    objects = EntryManager()
+    objects = EntryQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Facture client"
@@ -151,7 +372,7 @@ class Sale(Entry):
 
 
 class Income(Entry):
-    objects = EntryManager()
+    objects = EntryQuerySet.as_manager()
     METHOD_CHOICES = (
         ('5112000', "Chèque"),
         ('5115000', "ANCV"),
@@ -166,29 +387,76 @@ class Income(Entry):
 
     @property
     def client_transaction(self):
-        try:
-            return self.transaction_set.get(account__number__startswith='4')
-        except Transaction.DoesNotExist:
-            return None
+        return self.role_transaction(lambda account: account.category == 4)
 
     @property
     def cash_transaction(self):
-        try:
-            return self.transaction_set.get(account__number__startswith='5')
-        except Transaction.DoesNotExist:
-            return None
+        return self.role_transaction(lambda account: account.category == 5)
 
     @property
     def deposit(self):
-        if not self.client_transaction:
+        client_transaction = self.client_transaction
+        if not client_transaction:
             return None
-        return self.client_transaction.account.number == '4190000'
+        return client_transaction.account.number == '4190000'
 
     @property
     def method(self):
-        if not self.cash_transaction:
+        cash_transaction = self.cash_transaction
+        if not cash_transaction:
             return None
-        return dict(self.METHOD_CHOICES)[self.cash_transaction.account.number]
+        return dict(self.METHOD_CHOICES)[cash_transaction.account.number]
+
+
+@lru_cache(maxsize=None)
+def debtor_account(iban, holder):
+    return sepa.Account(iban, holder)
+
+
+class ExpenditureQuerySet(EntryQuerySet):
+    def unpaid_transfers(self):
+        "Expenditures by transfer whose bank transaction is not reconciled yet"
+        return self.filter(method=5, transaction__account__role=Account.BANK, transaction__reconciliation=None)
+
+    def sepa(self):
+        """
+        pain.001 file of the transfers of the expenditures, in a single payment block.
+
+        All the creditor accounts are validated before raising a ValueError
+        listing the errors. Files are cached by a hash of their content.
+        """
+        transactions = Transaction.objects.filter(entry__in=self.values('pk'), expense__gt=0) \
+            .select_related('thirdparty').order_by('entry__date', 'pk')
+        rows = [(
+            transaction.pk, transaction.title, transaction.expense,
+            transaction.thirdparty and (transaction.thirdparty.iban, transaction.thirdparty.bic,
+                                        transaction.thirdparty.title)
+        ) for transaction in transactions]
+        if not rows:
+            raise ValueError("Aucun virement à ordonner")
+        key = 'sepa-' + sha256(repr((settings.IBAN, settings.HOLDER, rows)).encode()).hexdigest()
+        content = cache.get(key)
+        if content is not None:
+            return content
+        sct = sepa.SEPACreditTransfer(debtor_account(settings.IBAN, settings.HOLDER), batch=True)
+        errors = []
+        for transaction in transactions:
+            thirdparty = transaction.thirdparty
+            if not thirdparty:
+                errors.append("Pas de tiers pour {}".format(transaction))
+                continue
+            try:
+                creditor = sepa.Account((thirdparty.iban, thirdparty.bic) if thirdparty.bic else thirdparty.iban,
+                                        thirdparty.title)
+            except ValueError as e:
+                errors.append("{} pour le tiers {}".format(e, thirdparty))
+                continue
+            sct.add_transaction(creditor, sepa.Amount(transaction.expense, 'EUR'), transaction.title)
+        if errors:
+            raise ValueError("\n".join(errors))
+        content = sct.render().decode('ascii')
+        cache.set(key, content, SEPA_CACHE_TIMEOUT)
+        return content
 
 
 class Expenditure(Entry):
@@ -203,7 +471,7 @@ class Expenditure(Entry):
 
     method = models.IntegerField(choices=METHOD_CHOICES)
 
-    objects = EntryManager()
+    objects = ExpenditureQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Dépense"
@@ -211,36 +479,14 @@ class Expenditure(Entry):
 
     @property
     def provider_transactions(self):
-        return self.transaction_set.filter(account__number__startswith='4')
+        return self.transaction_set.of_class(4)
 
     @property
     def cash_transaction(self):
-        try:
-            return self.transaction_set.get(account__number__startswith='5')
-        except Transaction.DoesNotExist:
-            return None
+        return self.role_transaction(lambda account: account.category == 5)
 
     def sepa(self):
-        # Create the debtor account from an IBAN
-        debtor = sepa.Account(settings.IBAN, settings.HOLDER)
-        # Create a SEPACreditTransfer instance
-        sct = sepa.SEPACreditTransfer(debtor)
-        for transaction in self.transaction_set.filter(expense__gt=0):
-            thirdparty = transaction.thirdparty
-            if not thirdparty:
-                raise Exception("No third party for {}".format(transaction))
-            # Create the creditor account from a tuple (IBAN, BIC)
-            try:
-                creditor = sepa.Account(thirdparty.iban, thirdparty.title)
-            except ValueError as e:
-                raise Exception("{} for thirdparty {}".format(e, thirdparty))
-            # Add the transaction
-            sct.add_transaction(
-                creditor,
-                sepa.Amount(transaction.expense, 'EUR'),
-                transaction.title
-            )
-        return sct.render().decode('ascii')
+        return Expenditure.objects.filter(pk=self.pk).sepa()
 
 
 class Cashing(Entry):
@@ -251,7 +497,7 @@ class Cashing(Entry):
         ('5300000', "Espèces"),
     )
 
-    objects = EntryManager()
+    objects = EntryQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Remise"
@@ -259,34 +505,198 @@ class Cashing(Entry):
 
     @property
     def bank_transaction(self):
-        try:
-            return self.transaction_set.get(account__number='5120000')
-        except Transaction.DoesNotExist:
-            return None
+        return self.role_transaction(lambda account: account.role == Account.BANK)
 
     @property
     def cashing_transaction(self):
-        try:
-            return self.transaction_set.exclude(account__number='5120000').get()
-        except Transaction.DoesNotExist:
-            return None
+        return self.role_transaction(lambda account: account.role != Account.BANK)
 
     @property
     def method(self):
         return dict(self.METHOD_CHOICES)[self.cashing_transaction.account.number]
 
 
+def letter_code(number):
+    "Code of the letter numbered number in its account and third party: AA, AB, ..., ZZ, AAA, ..."
+    length = 2
+    while number >= 26 ** length:
+        number -= 26 ** length
+        length += 1
+    code = ''
+    for i in range(length):
+        code = chr(number % 26 + 65) + code
+        number //= 26
+    return code
+
+
+class LetterQuerySet(models.QuerySet):
+    def allocate(self, scopes):
+        "Create a letter for each (account pk, third party pk) of scopes, numbered after the last one of its scope"
+        scopes = list(scopes)
+        last = {
+            (row['account'], row['thirdparty']): row['last'] for row in self.filter(
+                account__in={account for account, thirdparty in scopes}
+            ).order_by().values('account', 'thirdparty').annotate(last=models.Max('number'))
+        }
+        letters = []
+        for scope in scopes:
+            last[scope] = last.get(scope, -1) + 1
+            account, thirdparty = scope
+            letters.append(Letter(account_id=account, thirdparty_id=thirdparty, number=last[scope],
+                                  code=letter_code(last[scope])))
+        if connections[self.db].features.can_return_ids_from_bulk_insert:
+            return self.bulk_create(letters)
+        for letter in letters:
+            letter.save()
+        return letters
+
+    def delete(self):
+        "Delete the letters, refreshing the third party balances of their unlettered transactions"
+        keys = list(Transaction.objects.filter(letter__in=self.values('pk')).order_by()
+                    .values('entry__year', 'thirdparty').distinct())
+        result = super().delete()
+        ThirdPartyBalance.refresh(keys)
+        return result
+
+
 class Letter(models.Model):
+    """
+    Lettering of transactions of an account and a third party summing to zero.
+
+    Letters are numbered per account and third party, and coded from their number.
+    """
+    account = models.ForeignKey(Account, verbose_name="Compte", null=True, on_delete=models.CASCADE)
+    thirdparty = models.ForeignKey(ThirdParty, verbose_name="Tiers", null=True, on_delete=models.CASCADE)
+    number = models.PositiveIntegerField(verbose_name="Numéro", default=0)
+    code = models.CharField(verbose_name="Code", max_length=10, blank=True, db_index=True)
+    date = models.DateField(verbose_name="Date", default=datetime.date.today)
+
+    objects = LetterQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "Lettrage"
+        verbose_name_plural = "Lettrages"
+        unique_together = ('account', 'thirdparty', 'number')
+
+    def save(self, *args, **kwargs):
+        "Number and code a new letter after the last one of its account and third party"
+        if not self.code:
+            last = Letter.objects.filter(account=self.account_id, thirdparty=self.thirdparty_id) \
+                .aggregate(last=models.Max('number'))['last']
+            self.number = 0 if last is None else last + 1
+            self.code = letter_code(self.number)
+        return super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        "Refresh the third party balances of the unlettered transactions"
+        keys = list(self.transaction_set.order_by().values('entry__year', 'thirdparty').distinct())
+        result = super().delete(*args, **kwargs)
+        ThirdPartyBalance.refresh(keys)
+        return result
+
     def __str__(self):
-        i = self.id - 1
-        s = ''
-        while i:
-            s = chr((i % 26) + 65) + s
-            i //= 26
-        return s
+        return self.code
+
+
+class TransactionQuerySet(BalanceQuerySet):
+    def of_class(self, *classes):
+        "Transactions on accounts of the given classes (6) or groups (21)"
+        return self.filter(class_filter(classes, 'account__'))
+
+    def of_role(self, *roles):
+        return self.filter(account__role__in=roles)
+
+    def balance_keys(self):
+        "Values identifying the balance store rows of the transactions"
+        return self.values(*Transaction.BALANCE_LOOKUPS)
+
+    def refresh_balances(self):
+        "Refresh balance stores and entry totals after a bulk operation on the transactions"
+        refresh_balances(self.balance_keys())
+        Entry.objects.filter(pk__in=self.values('entry')).refresh_totals()
+
+    def update(self, **kwargs):
+        """
+        Update the transactions, deleting the letters of the ones whose amounts change.
+
+        The balance stores depending on the updated fields and the entry totals are refreshed, and the entries are
+        marked as modified for the checks, bulk_update() included as it goes through update(). BALANCE_FIELDS
+        covers the Transaction.TRACKED_FIELDS.
+        """
+        if 'letter' not in kwargs and 'letter_id' not in kwargs:
+            changes = [~models.Q(**{name: kwargs[name]}) for name in ('expense', 'revenue') if name in kwargs]
+            if changes:
+                Letter.objects.filter(pk__in=self.filter(reduce(or_, changes)).values('letter')).delete()
+        fields = {name[:-3] if name.endswith('_id') else name for name in kwargs} & BALANCE_FIELDS
+        if not fields:
+            return super().update(**kwargs)
+        before = list(self.order_by().values('pk', 'entry', *Transaction.BALANCE_LOOKUPS))
+        result = super().update(**kwargs)
+        after = list(Transaction.objects.filter(pk__in=[key['pk'] for key in before])
+                     .values('entry', *Transaction.BALANCE_LOOKUPS))
+        refresh_balances(before + after, fields)
+        entries = Entry.objects.filter(pk__in={key['entry'] for key in before + after})
+        if fields & {'entry', 'expense', 'revenue'}:
+            entries.refresh_totals()
+        else:
+            entries.update(modified=now())
+        return result
+
+    def letterings(self, size=4):
+        "((account pk, third party pk), group) of the unlettered transaction pks summing to zero"
+        lines = {}
+        transactions = self.filter(letter=None, thirdparty__isnull=False).order_by('entry__date', 'pk') \
+            .values_list('pk', 'account', 'thirdparty', 'revenue', 'expense')
+        for pk, account, thirdparty, revenue, expense in transactions.iterator():
+            lines.setdefault((account, thirdparty), []).append((pk, int((revenue - expense) * 100)))
+        return [(key, group) for key in lines for group in match_zero_sum(lines[key], size)]
+
+    def auto_letter(self, size=4):
+        "Letter the transactions of each account and third party summing to zero, return the letter count"
+        groups = self.letterings(size)
+        with atomic():
+            letters = Letter.objects.allocate(key for key, group in groups)
+            Transaction.objects.bulk_update([
+                Transaction(pk=pk, letter=letter) for (key, group), letter in zip(groups, letters) for pk in group
+            ], ['letter'], batch_size=1000)
+        return len(groups)
+
+    def running_balance(self, *fields, order=('entry__date', 'pk'), opening=0, limit=None):
+        """
+        Iterate over values() rows with their cumulative balance `solde`.
+
+        The balance is computed by a window function when the database supports
+        it, and accumulated while iterating otherwise.
+        """
+        qs = self.order_by(*order)
+        window = connections[self.db].features.supports_over_clause
+        if window:
+            qs = qs.annotate(solde=models.Window(
+                expression=models.Sum(models.F('revenue') - models.F('expense')),
+                order_by=[models.F(field).asc() for field in order],
+            ))
+            qs = qs.values(*fields, 'solde')
+        else:
+            qs = qs.values(*fields, 'revenue', 'expense')
+        if limit is not None:
+            qs = qs[:limit]
+        solde = opening
+        for row in qs.iterator():
+            if window:
+                row['solde'] += opening
+            else:
+                solde += row['revenue'] - row['expense']
+                row['solde'] = solde
+            yield row
 
 
 class Transaction(models.Model):
+    # Lookups identifying the balance store rows a transaction contributes to
+    BALANCE_LOOKUPS = ('entry__year', 'entry__date', 'account', 'thirdparty', 'analytic', 'reconciliation')
+    # Fields snapshotted at load to detect changes on save
+    TRACKED_FIELDS = ('entry_id', 'account_id', 'thirdparty_id', 'analytic_id', 'expense', 'revenue',
+                      'reconciliation', 'letter_id')
+
     entry = models.ForeignKey(Entry, on_delete=models.CASCADE)
     title = models.CharField(verbose_name="Intitulé", max_length=100, blank=True)
     account = models.ForeignKey(Account, verbose_name="Compte", on_delete=models.PROTECT)
@@ -298,6 +708,8 @@ class Transaction(models.Model):
     reconciliation = models.DateField(verbose_name="Rapprochement", blank=True, null=True)
     letter = models.ForeignKey(Letter, verbose_name="Lettrage", blank=True, null=True, on_delete=models.SET_NULL)
 
+    objects = TransactionQuerySet.as_manager()
+
     def __str__(self):
         return self.title or self.entry.title
 
@@ -330,23 +742,397 @@ class Transaction(models.Model):
     def full_title(self):
         return str(self)
 
+    def balance_keys(self):
+        "Values identifying the balance store rows of the transaction"
+        return {
+            'entry__year': self.entry.year_id,
+            'entry__date': self.entry.date,
+            'account': self.account_id,
+            'thirdparty': self.thirdparty_id,
+            'analytic': self.analytic_id,
+            'reconciliation': self.reconciliation,
+        }
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        "Snapshot the loaded values of TRACKED_FIELDS, so that save() knows what changed without a query"
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = instance.tracked_values()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded = self.tracked_values()
+
+    def tracked_values(self, deferred=False):
+        "Values of the TRACKED_FIELDS converted to their python type, loading the deferred ones if asked to"
+        return {
+            name: self._meta.get_field(name).to_python(getattr(self, name))
+            for name in self.TRACKED_FIELDS if deferred or name in self.__dict__
+        }
+
+    def stored_values(self):
+        "Values of TRACKED_FIELDS in the database, from the load snapshot if complete, None if not saved yet"
+        if not self.id:
+            return None
+        loaded = getattr(self, '_loaded', {})
+        if len(loaded) == len(self.TRACKED_FIELDS):
+            return loaded
+        return Transaction.objects.filter(id=self.id).values(*self.TRACKED_FIELDS).first()
+
+    def stored_balance_keys(self, stored):
+        "balance_keys() of the stored values"
+        if stored['entry_id'] == self.entry_id:
+            year, date = self.entry.year_id, self.entry.date
+        else:
+            year, date = Entry.objects.values_list('year', 'date').get(pk=stored['entry_id'])
+        return {
+            'entry__year': year,
+            'entry__date': date,
+            'account': stored['account_id'],
+            'thirdparty': stored['thirdparty_id'],
+            'analytic': stored['analytic_id'],
+            'reconciliation': stored['reconciliation'],
+        }
+
     def save(self, *args, **kwargs):
-        "Delete lettering if need be"
-        if self.id and self.letter:
-            try:
-                old = Transaction.objects.get(id=self.id)
-            except Transaction.DoesNotExist:
-                old = None
-            if old and self.expense != old.expense or self.revenue != old.revenue:
-                self.letter.delete()
-                self.letter = None
-        return super().save(*args, **kwargs)
+        "Delete lettering, refresh balances and entry totals if need be, mark the entry as modified if anything changed"
+        old = self.stored_values()
+        new = self.tracked_values(deferred=True)
+        if old and self.letter_id and (new['expense'], new['revenue']) != (old['expense'], old['revenue']):
+            Letter.objects.filter(pk=self.letter_id).delete()
+            self.letter = None
+            new['letter_id'] = None
+        result = super().save(*args, **kwargs)
+        self._loaded = new
+        changed = {name[:-3] if name.endswith('_id') else name
+                   for name in self.TRACKED_FIELDS if not old or old[name] != new[name]}
+        if not changed:
+            return result
+        refresh_balances([old and self.stored_balance_keys(old), self.balance_keys()], changed)
+        if not old or (old['entry_id'], old['expense'], old['revenue']) != \
+                (new['entry_id'], new['expense'], new['revenue']):
+            Entry.objects.filter(pk__in={old and old['entry_id'], self.entry_id}).refresh_totals()
+        else:
+            Entry.objects.filter(pk=self.entry_id).update(modified=now())
+        return result
 
     def delete(self, *args, **kwargs):
-        "Delete lettering if need be"
-        if self.letter:
-            self.letter.delete()
-        return super().delete(*args, **kwargs)
+        "Delete lettering, refresh balances and entry totals if need be"
+        if self.letter_id:
+            Letter.objects.filter(pk=self.letter_id).delete()
+        keys = self.balance_keys()
+        result = super().delete(*args, **kwargs)
+        refresh_balances([keys])
+        Entry.objects.filter(pk=self.entry_id).refresh_totals()
+        return result
+
+
+def key_filter(names, rows):
+    "Q matching at least the rows, tuples of values of the names, rows of None values included"
+    q = models.Q()
+    for i, name in enumerate(names):
+        values = {row[i] for row in rows}
+        condition = models.Q(**{name + '__in': values - {None}})
+        if None in values:
+            condition |= models.Q(**{name + '__isnull': True})
+        q &= condition
+    return q
+
+
+class BalanceStore(models.Model):
+    """
+    Abstract store of transaction sums, maintained by Transaction and Entry saves.
+
+    KEYS maps each key field of the store to the matching transaction lookup,
+    FIELDS lists the transaction fields its rows depend on.
+    """
+    KEYS = ()
+    FIELDS = ('entry', 'account', 'thirdparty', 'analytic', 'expense', 'revenue')
+
+    revenue = models.DecimalField(verbose_name="Crédit", max_digits=10, decimal_places=2, default=0)
+    expense = models.DecimalField(verbose_name="Débit", max_digits=10, decimal_places=2, default=0)
+
+    objects = BalanceQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def aggregates(cls):
+        return {
+            'revenue': Coalesce(models.Sum('revenue'), 0),
+            'expense': Coalesce(models.Sum('expense'), 0),
+        }
+
+    @classmethod
+    def transactions(cls):
+        return Transaction.objects.all()
+
+    @classmethod
+    def year_rows(cls, year):
+        return cls.objects.filter(year=year)
+
+    @classmethod
+    def year_transactions(cls, year):
+        return cls.transactions().filter(entry__year=year)
+
+    @classmethod
+    def refresh(cls, keys):
+        "Recompute the rows matching the given transaction keys, with a fixed number of queries whatever their count"
+        fields = [field for field, lookup in cls.KEYS]
+        lookups = [lookup for field, lookup in cls.KEYS]
+        rows = {
+            row for row in (tuple(key[lookup] for lookup in lookups) for key in keys)
+            if not any(value is None and not cls._meta.get_field(field).null for field, value in zip(fields, row))
+        }
+        if not rows:
+            return
+        totals = cls.transactions().filter(key_filter(lookups, rows)).values(*lookups).order_by()
+        totals = {
+            tuple(total[lookup] for lookup in lookups): total
+            for total in totals.annotate(**{'total_' + name: aggregate for name, aggregate in cls.aggregates().items()})
+        }
+        stored = {
+            tuple(getattr(obj, field) for field in fields): obj
+            for obj in cls.objects.filter(key_filter(fields, rows))
+        }
+        created, updated = [], []
+        for row in rows & set(totals):
+            obj = stored.get(row) or cls(**dict(zip(fields, row)))
+            for name in cls.aggregates():
+                setattr(obj, name, totals[row]['total_' + name])
+            if obj.pk:
+                updated.append(obj)
+            else:
+                created.append(obj)
+        deleted = [obj.pk for row, obj in stored.items() if row in rows and row not in totals]
+        if deleted:
+            cls.objects.filter(pk__in=deleted).delete()
+        if created:
+            cls.objects.bulk_create(created)
+        if updated:
+            # bulk_update() does not set the auto_now fields
+            auto_now = [field for field in cls._meta.concrete_fields if getattr(field, 'auto_now', False)]
+            for obj in updated:
+                for field in auto_now:
+                    field.pre_save(obj, False)
+            cls.objects.bulk_update(updated, list(cls.aggregates()) + [field.name for field in auto_now])
+
+    @classmethod
+    def rebuild(cls, year):
+        "Recompute all the rows of a year"
+        cls.year_rows(year).delete()
+        transactions = cls.year_transactions(year)
+        transactions = transactions.values(*(lookup for field, lookup in cls.KEYS)).order_by()
+        transactions = transactions.annotate(**{
+            'total_' + name: aggregate for name, aggregate in cls.aggregates().items()
+        })
+        cls.objects.bulk_create([
+            cls(
+                **{field: row[lookup] for field, lookup in cls.KEYS},
+                **{name: row['total_' + name] for name in cls.aggregates()}
+            ) for row in transactions
+        ])
+
+
+class LedgerBalance(BalanceStore):
+    """
+    Daily movements per account, third party and analytic.
+
+    Summing the rows before a date gives the opening balance of a ledger page.
+    """
+    KEYS = (
+        ('year_id', 'entry__year'),
+        ('date', 'entry__date'),
+        ('account_id', 'account'),
+        ('thirdparty_id', 'thirdparty'),
+        ('analytic_id', 'analytic'),
+    )
+
+    year = models.ForeignKey(Year, verbose_name="Exercice", on_delete=models.CASCADE)
+    date = models.DateField(verbose_name="Date")
+    account = models.ForeignKey(Account, verbose_name="Compte", on_delete=models.CASCADE)
+    thirdparty = models.ForeignKey(ThirdParty, verbose_name="Tiers", null=True, blank=True, on_delete=models.CASCADE)
+    analytic = models.ForeignKey(Analytic, verbose_name="Analytique", null=True, blank=True, on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = "Solde journalier"
+        verbose_name_plural = "Soldes journaliers"
+        unique_together = ('year', 'date', 'account', 'thirdparty', 'analytic')
+        index_together = (('year', 'account', 'date'), ('year', 'thirdparty', 'date'), ('year', 'analytic', 'date'))
+
+
+class YearBalance(BalanceStore):
+    """
+    Abstract yearly snapshot of the balances.
+
+    Snapshots of closed years are frozen: they are computed one last time when
+    the year is closed and are not refreshed by later transaction changes.
+    """
+    balance = models.DecimalField(verbose_name="Solde", max_digits=10, decimal_places=2, default=0)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def aggregates(cls):
+        aggregates = super().aggregates()
+        aggregates['balance'] = Coalesce(models.Sum(models.F('revenue') - models.F('expense')), 0)
+        return aggregates
+
+    @classmethod
+    def refresh(cls, keys):
+        keys = list(keys)
+        opened = Year.objects.filter(opened=True, pk__in=set(key['entry__year'] for key in keys))
+        opened = set(opened.values_list('pk', flat=True))
+        super().refresh([key for key in keys if key['entry__year'] in opened])
+
+
+class AccountBalance(YearBalance):
+    KEYS = (
+        ('year_id', 'entry__year'),
+        ('account_id', 'account'),
+    )
+    FIELDS = ('entry', 'account', 'expense', 'revenue')
+
+    year = models.ForeignKey(Year, verbose_name="Exercice", on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, verbose_name="Compte", on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = "Balance générale"
+        verbose_name_plural = "Balances générales"
+        unique_together = ('year', 'account')
+        index_together = ('year', 'balance')
+
+
+class AnalyticBalance(YearBalance):
+    KEYS = (
+        ('year_id', 'entry__year'),
+        ('analytic_id', 'analytic'),
+    )
+    FIELDS = ('entry', 'analytic', 'expense', 'revenue')
+
+    year = models.ForeignKey(Year, verbose_name="Exercice", on_delete=models.CASCADE)
+    analytic = models.ForeignKey(Analytic, verbose_name="Analytique", on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = "Balance analytique"
+        verbose_name_plural = "Balances analytiques"
+        unique_together = ('year', 'analytic')
+        index_together = ('year', 'balance')
+
+    @classmethod
+    def transactions(cls):
+        return Transaction.objects.filter(analytic__isnull=False)
+
+
+class ThirdPartyBalance(BalanceStore):
+    """
+    Balances of the third parties per year, also without advances (balancex).
+
+    Unlike the yearly snapshots, they follow lettering changes of closed years.
+    """
+    KEYS = (
+        ('year_id', 'entry__year'),
+        ('thirdparty_id', 'thirdparty'),
+    )
+    FIELDS = ('entry', 'account', 'thirdparty', 'expense', 'revenue', 'letter')
+    ADVANCE_ACCOUNTS = ('4090000', '4190000')
+
+    year = models.ForeignKey(Year, verbose_name="Exercice", on_delete=models.CASCADE)
+    thirdparty = models.ForeignKey(ThirdParty, verbose_name="Tiers", on_delete=models.CASCADE)
+    balance = models.DecimalField(verbose_name="Solde", max_digits=10, decimal_places=2, default=0)
+    balancex = models.DecimalField(verbose_name="Solde hors avances", max_digits=10, decimal_places=2, default=0)
+    not_lettered = models.PositiveIntegerField(verbose_name="Non lettrées", default=0)
+
+    class Meta:
+        verbose_name = "Balance tiers"
+        verbose_name_plural = "Balances tiers"
+        unique_together = ('year', 'thirdparty')
+        index_together = (('year', 'balance'), ('year', 'balancex'))
+
+    @classmethod
+    def aggregates(cls):
+        aggregates = super().aggregates()
+        aggregates['balance'] = Coalesce(models.Sum(models.F('revenue') - models.F('expense')), 0)
+        aggregates['balancex'] = Coalesce(models.Sum(
+            models.F('revenue') - models.F('expense'),
+            filter=~models.Q(account__number__in=cls.ADVANCE_ACCOUNTS)
+        ), 0)
+        aggregates['not_lettered'] = models.Count('id', filter=models.Q(letter__isnull=True))
+        return aggregates
+
+    @classmethod
+    def transactions(cls):
+        return Transaction.objects.filter(thirdparty__isnull=False)
+
+
+class CashFlowBalance(BalanceStore):
+    """
+    Daily movements of the bank and cash accounts by reconciliation date.
+
+    Summing the rows of a year gives the cash flow chart, modified dating
+    the last change for the http validators of the chart data.
+    """
+    KEYS = (
+        ('date', 'reconciliation'),
+    )
+    FIELDS = ('account', 'expense', 'revenue', 'reconciliation')
+
+    date = models.DateField(verbose_name="Date", unique=True)
+    balance = models.DecimalField(verbose_name="Solde", max_digits=10, decimal_places=2, default=0)
+    modified = models.DateTimeField(verbose_name="Modifié le", auto_now=True)
+
+    class Meta:
+        verbose_name = "Trésorerie journalière"
+        verbose_name_plural = "Trésorerie journalière"
+
+    @classmethod
+    def aggregates(cls):
+        aggregates = super().aggregates()
+        aggregates['balance'] = Coalesce(models.Sum(models.F('revenue') - models.F('expense')), 0)
+        return aggregates
+
+    @classmethod
+    def transactions(cls):
+        return Transaction.objects.of_role(Account.BANK, Account.CASH).filter(reconciliation__isnull=False)
+
+    @classmethod
+    def year_rows(cls, year):
+        return cls.objects.filter(date__range=(year.start, year.end))
+
+    @classmethod
+    def year_transactions(cls, year):
+        return cls.transactions().filter(reconciliation__range=(year.start, year.end))
+
+
+BALANCE_STORES = (LedgerBalance, AccountBalance, AnalyticBalance, ThirdPartyBalance, CashFlowBalance)
+# Transaction fields some balance store depends on
+BALANCE_FIELDS = frozenset(field for store in BALANCE_STORES for field in store.FIELDS)
+
+
+def refresh_balances(keys, fields=BALANCE_FIELDS):
+    "Refresh the balance stores depending on the changed transaction fields for the given transaction keys"
+    keys = [key for key in keys if key]
+    for store in BALANCE_STORES:
+        if set(store.FIELDS) & set(fields):
+            store.refresh(keys)
+
+
+class CheckResult(models.Model):
+    "Object flagged by a consistency check, see accounting.checks"
+    year = models.ForeignKey(Year, verbose_name="Exercice", on_delete=models.CASCADE)
+    check = models.CharField(verbose_name="Contrôle", max_length=30)
+    date = models.DateTimeField(verbose_name="Date", auto_now_add=True)
+    entry = models.ForeignKey(Entry, verbose_name="Écriture", null=True, on_delete=models.CASCADE)
+    transaction = models.ForeignKey(Transaction, verbose_name="Transaction", null=True, on_delete=models.CASCADE)
+    letter = models.ForeignKey(Letter, verbose_name="Lettrage", null=True, on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = "Résultat de contrôle"
+        verbose_name_plural = "Résultats de contrôle"
+        index_together = ('year', 'check')
 
 
 class BankStatement(models.Model):
@@ -354,6 +1140,7 @@ class BankStatement(models.Model):
     date = models.DateField()
     number = models.PositiveIntegerField(verbose_name="Numéro", blank=True, null=True)
     scan = models.FileField(upload_to='releves')
+    data = models.FileField(verbose_name="Fichier CAMT.053, OFX ou CSV", upload_to='releves', blank=True)
     balance = models.DecimalField(verbose_name="Solde", max_digits=8, decimal_places=2)
 
     class Meta:
@@ -363,12 +1150,26 @@ class BankStatement(models.Model):
 
     @property
     def entries_balance(self):
-        transactions = Transaction.objects \
-            .filter(account__number='5120000') \
-            .filter(reconciliation__lte=self.date)
+        transactions = Transaction.objects.of_role(Account.BANK).filter(reconciliation__lte=self.date)
         sums = transactions.aggregate(expense=models.Sum('expense'), revenue=models.Sum('revenue'))
         return sums['expense'] - sums['revenue']
 
     @property
     def reconciliation(self):
         return self.balance - self.entries_balance
+
+    def reconcile(self, window=5):
+        "Reconcile the bank transactions matching the lines of the data file at once, return the unmatched lines"
+        with self.data.open('rb') as f:
+            lines = parse_statement(self.data.name, f.read())
+        transactions = Transaction.objects.of_role(Account.BANK).filter(reconciliation=None) \
+            .values_list('pk', 'entry__date', 'expense', 'revenue')
+        matches, unmatched = match_lines(lines, [
+            (pk, day, expense - revenue) for pk, day, expense, revenue in transactions.iterator()
+        ], window)
+        # The cash flow is refreshed by the update, in the same transaction
+        with atomic():
+            Transaction.objects.bulk_update([
+                Transaction(pk=pk, reconciliation=line.date) for pk, line in matches
+            ], ['reconciliation'], batch_size=1000)
+        return unmatched
@@ -0,0 +1,87 @@
+"""
+Cache of the reference data: journals, accounts and analytics by number.
+
+All the rows of a model are loaded on first access, then kept until the end
+of the request or until one of them is saved or deleted. Clearing on every
+request keeps the processes of a multi-process server up to date.
+"""
+from django.core.signals import request_started
+from django.db.models.signals import post_delete, post_save
+from django.utils.html import format_html
+from .models import Account, Analytic, Journal
+
+
+class Reference:
+    "Instances of model by number, names giving the number of the well-known ones"
+    def __init__(self, model, **names):
+        self.model = model
+        self.names = names
+        self.rows = None
+        post_save.connect(self.clear, sender=model, weak=False)
+        post_delete.connect(self.clear, sender=model, weak=False)
+        request_started.connect(self.clear, weak=False)
+
+    def clear(self, **kwargs):
+        self.rows = None
+
+    def all(self):
+        "Instances by number, the local reference surviving a clear from another thread"
+        rows = self.rows
+        if rows is None:
+            rows = self.rows = {instance.number: instance for instance in self.model.objects.all()}
+        return rows
+
+    def get(self, number):
+        try:
+            return self.all()[number]
+        except KeyError:
+            raise self.model.DoesNotExist("No {} numbered {}".format(self.model._meta.verbose_name, number))
+
+    def __getattr__(self, name):
+        "Instance of a well-known name (accounts.BANK) or of an upper case number (journals.BQ)"
+        if not name.isupper():
+            raise AttributeError(name)
+        return self.get(self.names.get(name, name))
+
+
+class ReferenceChoices:
+    """
+    Reference rows passing test, as choices and rendered option tags.
+
+    They are built again only when the reference is reloaded, so that the
+    selects of all the rows of a formset share them.
+    """
+    def __init__(self, reference, test=None):
+        self.reference = reference
+        self.test = test
+        self.rows = None
+
+    def load(self):
+        rows = self.reference.all()
+        if rows is not self.rows:
+            self.instances = {
+                instance.pk: instance for instance in rows.values() if self.test is None or self.test(instance)
+            }
+            self.options = [
+                (str(pk), format_html('<option value="{}">{}</option>', pk, instance))
+                for pk, instance in self.instances.items()
+            ]
+            self.rows = rows
+        return self
+
+    def get(self, pk):
+        return self.load().instances[int(pk)]
+
+
+journals = Reference(Journal)
+accounts = Reference(
+    Account,
+    BANK='5120000',
+    CASH='5300000',
+    CHEQUES='5112000',
+    ANCV='5115000',
+    CARD='5170000',
+    CLIENT_ADVANCE='4190000',
+    PROVIDER_ADVANCE='4090000',
+)
+analytics = Reference(Analytic)
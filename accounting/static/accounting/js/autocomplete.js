@@ -0,0 +1,19 @@
+// Type-ahead on the inputs rendered by accounting.forms.ThirdPartyAutocomplete
+$('input.autocomplete').each(function() {
+    var input = $(this);
+    input.select2({
+        minimumInputLength: 1,
+        allowClear: !input.prop('required'),
+        placeholder: '---------',
+        ajax: {
+            url: input.data('url'),
+            dataType: 'json',
+            quietMillis: 250,
+            data: function(term) { return {q: term}; },
+            results: function(data) { return {results: data.results}; }
+        },
+        initSelection: function(element, callback) {
+            callback({id: element.val(), text: input.data('text')});
+        }
+    });
+});
@@ -1,7 +1,30 @@
-from django.test import TestCase
-from members.factories import NominationFactory
-from .factories import AccountFactory, AnalyticFactory, PurchaseFactory, ThirdPartyFactory, YearFactory
-from .models import Purchase, Transaction
+import datetime
+import re
+from decimal import Decimal
+from io import StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from members.factories import NominationFactory, PersonFactory
+from .factories import (AccountFactory, AnalyticFactory, EntryFactory, PurchaseFactory, ThirdPartyFactory,
+                        TransactionFactory, YearFactory)
+from .bank import StatementLine, match_lines, parse_statement
+from .checks import run_checks
+from .forms import PurchaseTransactionForm
+from .importer import Importer, read_rows
+from .models import (Account, AccountBalance, AnalyticBalance, BankStatement, CashFlowBalance, CheckResult, Entry,
+                     Expenditure, Income, Journal, LedgerBalance, Letter, Purchase, ThirdParty, ThirdPartyBalance,
+                     Transaction, letter_code)
+from .lettering import find_subset, match_zero_sum
+from .reference import accounts, journals
+from .views import AccountView
 
 
 class LoggedOutViewsTests(TestCase):
@@ -176,3 +199,811 @@ class LoggedInViewsTests(TestCase):
         }
         response = self.client.post('/accounting/{}/purchase/create/'.format(year.pk), data)
         self.assertContains(response, "Ce champ est obligatoire")
+
+
+class LedgerBalanceTests(TestCase):
+    def test_save(self):
+        purchase = PurchaseFactory.create(transactions__amount=1.11)
+        transaction = purchase.transaction_set.get(account__number__startswith='6')
+        balance = LedgerBalance.objects.get(account=transaction.account)
+        self.assertEqual(balance.expense, Decimal('1.11'))
+        self.assertEqual(balance.date, purchase.date)
+        transaction.expense = 2.22
+        transaction.save()
+        balance.refresh_from_db()
+        self.assertEqual(balance.expense, Decimal('2.22'))
+
+    def test_entry_date(self):
+        purchase = PurchaseFactory.create()
+        purchase.date = datetime.date(2010, 6, 18)
+        purchase.save()
+        self.assertQuerysetEqual(LedgerBalance.objects.values_list('date', flat=True).distinct(),
+                                 [repr(datetime.date(2010, 6, 18))])
+
+    def test_delete(self):
+        purchase = PurchaseFactory.create()
+        self.assertEqual(LedgerBalance.objects.count(), 2)
+        purchase.delete()
+        self.assertEqual(LedgerBalance.objects.count(), 0)
+
+    def test_refresh(self):
+        year = YearFactory.create()
+        purchases = [PurchaseFactory.create(year=year, date=datetime.date(2014, 1, 1 + i)) for i in range(5)]
+        rows = list(LedgerBalance.objects.order_by('pk').values_list('date', 'account', 'expense', 'revenue'))
+        LedgerBalance.objects.filter(date=purchases[0].date).delete()
+        LedgerBalance.objects.update(expense=0, revenue=0)
+        keys = list(Transaction.objects.balance_keys())
+        # Select the totals and the rows, create the missing ones and update the others
+        with self.assertNumQueries(4):
+            LedgerBalance.refresh(keys)
+        self.assertEqual(sorted(LedgerBalance.objects.values_list('date', 'account', 'expense', 'revenue')),
+                         sorted(rows))
+        Transaction.objects.filter(entry=purchases[1]).delete()
+        # Select the totals and the rows, delete the emptied ones and update the others
+        with self.assertNumQueries(4):
+            LedgerBalance.refresh(keys)
+        self.assertEqual(LedgerBalance.objects.count(), 8)
+
+    def test_rebuild(self):
+        purchase = PurchaseFactory.create(transactions__amount=1.11)
+        LedgerBalance.objects.all().delete()
+        LedgerBalance.rebuild(purchase.year)
+        totals = LedgerBalance.objects.totals()
+        self.assertEqual(totals, {'revenue': Decimal('1.11'), 'expense': Decimal('1.11'), 'balance': 0})
+
+
+class EntryTotalsTests(TestCase):
+    def test_hooks(self):
+        purchase = PurchaseFactory.create(transactions__amount=Decimal('1.11'))
+        self.assertEqual(Purchase.objects.values_list('revenue', 'expense', 'balance').get(),
+                         (Decimal('1.11'), Decimal('1.11'), 0))
+        transaction = purchase.transaction_set.get(account__number__startswith='6')
+        transaction.expense = 2
+        transaction.save()
+        self.assertEqual(Entry.objects.get().balance, Decimal('-0.89'))
+        transaction.delete()
+        self.assertEqual(Entry.objects.get().expense, 0)
+
+    def test_save(self):
+        purchase = PurchaseFactory.create(transactions__amount=Decimal('1.11'))
+        entry = Entry.objects.get()
+        purchase.transaction_set.filter(account__number__startswith='6').get().delete()
+        # The stale totals loaded above are not written back, and the balances do not move
+        with self.assertNumQueries(1):
+            entry.title = "Autre intitulé"
+            entry.save()
+        self.assertEqual(Entry.objects.values_list('title', 'expense').get(), ("Autre intitulé", 0))
+        with self.assertNumQueries(1):
+            entry.save()
+        entry.date = datetime.date(2010, 6, 18)
+        entry.save()
+        self.assertEqual(LedgerBalance.objects.get().date, datetime.date(2010, 6, 18))
+
+    def test_convert(self):
+        entry = EntryFactory.create(year__opened=True)
+        TransactionFactory.create(entry=entry, expense='1.11')
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        response = self.client.get('/accounting/{}/entry/{}/to_purchase/'.format(entry.year_id, entry.pk))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Purchase.objects.values_list('pk', 'expense').get(), (entry.pk, Decimal('1.11')))
+
+    def test_repair(self):
+        purchase = PurchaseFactory.create(transactions__amount=Decimal('1.11'))
+        Entry.objects.update(revenue=0, expense=0, balance=0)
+        self.assertEqual(Entry.objects.with_live_totals().get().live_revenue, Decimal('1.11'))
+        call_command('rebuild_balances', purchase.year_id, stdout=StringIO())
+        self.assertEqual(Entry.objects.get().revenue, Decimal('1.11'))
+
+
+class RolesTests(TestCase):
+    def test_with_roles(self):
+        for i in range(3):
+            income = Income.objects.create(year=YearFactory.create(), journal=Journal.objects.get(number='OD'))
+            TransactionFactory.create(entry=income, account__number='41100{:02d}'.format(i), revenue=1)
+            TransactionFactory.create(entry=income, account__number='51200{:02d}'.format(i), expense=1)
+        with self.assertNumQueries(2):
+            clients = [income.client_transaction.account.number for income in Income.objects.with_roles()]
+        self.assertEqual(clients, ['4110000', '4110001', '4110002'])
+        with self.assertNumQueries(2):
+            self.assertFalse(Income.objects.with_roles().get(pk=income.pk).deposit)
+
+
+def balance_tables(queries):
+    "Balance store tables used by the captured queries"
+    return {table for query in queries for table in re.findall(r'"(accounting_\w+balance)"', query['sql'])}
+
+
+class YearBalanceTests(TestCase):
+    def test_save(self):
+        year = YearFactory.create(opened=True)
+        purchase = PurchaseFactory.create(year=year, transactions__amount=1.11)
+        transaction = purchase.transaction_set.get(account__number__startswith='6')
+        transaction.analytic = AnalyticFactory.create()
+        transaction.save()
+        self.assertEqual(AccountBalance.objects.get(account=transaction.account).balance, Decimal('-1.11'))
+        self.assertEqual(AnalyticBalance.objects.get().balance, Decimal('-1.11'))
+        self.assertEqual(AccountBalance.objects.filter(year=year).totals()['balance'], 0)
+
+    def test_frozen(self):
+        year = YearFactory.create(opened=True)
+        purchase = PurchaseFactory.create(year=year, transactions__amount=1.11)
+        year.opened = False
+        year.save()
+        transaction = purchase.transaction_set.get(account__number__startswith='6')
+        transaction.expense = 2.22
+        transaction.save()
+        self.assertEqual(AccountBalance.objects.get(account=transaction.account).balance, Decimal('-1.11'))
+
+    def test_unchanged(self):
+        year = YearFactory.create(opened=True)
+        purchase = PurchaseFactory.create(year=year, transactions__amount=1.11)
+        transaction = purchase.transaction_set.get(account__number__startswith='6')
+        with CaptureQueriesContext(connection) as queries:
+            transaction.title = "Autre intitulé"
+            transaction.save()
+        self.assertEqual(balance_tables(queries), set())
+        with CaptureQueriesContext(connection) as queries:
+            transaction.reconciliation = datetime.date.today()
+            transaction.save()
+        # Only the cash flow depends on the reconciliation
+        self.assertEqual(balance_tables(queries), {'accounting_cashflowbalance'})
+
+    def test_update(self):
+        year = YearFactory.create(opened=True)
+        purchase = PurchaseFactory.create(year=year, transactions__amount=1.11)
+        transaction = purchase.transaction_set.get(account__number__startswith='6')
+        Transaction.objects.filter(pk=transaction.pk).update(expense=Decimal('2.22'))
+        self.assertEqual(AccountBalance.objects.get(account=transaction.account).balance, Decimal('-2.22'))
+        self.assertEqual(LedgerBalance.objects.get(account=transaction.account).expense, Decimal('2.22'))
+        self.assertEqual(Entry.objects.get().balance, Decimal('-1.11'))
+        Transaction.objects.bulk_update([Transaction(pk=transaction.pk, expense=Decimal('1.11'))], ['expense'])
+        self.assertEqual(AccountBalance.objects.get(account=transaction.account).balance, Decimal('-1.11'))
+        self.assertEqual(Entry.objects.get().balance, 0)
+        account = AccountFactory.create(prefix=6000000)
+        Transaction.objects.filter(pk=transaction.pk).update(account=account)
+        self.assertFalse(AccountBalance.objects.filter(account=transaction.account).exists())
+        self.assertEqual(AccountBalance.objects.get(account=account).balance, Decimal('-1.11'))
+
+
+class ThirdPartyBalanceTests(TestCase):
+    def setUp(self):
+        self.year = YearFactory.create()
+        self.thirdparty = ThirdPartyFactory.create()
+        self.advance = AccountFactory.create(number='4090000')
+        self.transactions = [
+            TransactionFactory.create(entry__year=self.year, account=self.thirdparty.account,
+                                      thirdparty=self.thirdparty, revenue='2.00'),
+            TransactionFactory.create(entry__year=self.year, account=self.advance, thirdparty=self.thirdparty,
+                                      expense='3.00'),
+        ]
+
+    def get_balance(self):
+        return ThirdPartyBalance.objects.values_list('balance', 'balancex', 'not_lettered').get()
+
+    def test_lettering(self):
+        self.assertEqual(self.get_balance(), (Decimal('-1.00'), Decimal('2.00'), 2))
+        Transaction.objects.all().update(letter=Letter.objects.create())
+        self.assertEqual(self.get_balance()[2], 0)
+        Letter.objects.get().delete()
+        self.assertEqual(self.get_balance()[2], 2)
+
+    def test_list_view(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        url = '/accounting/{}/thirdparty/?balance={}'
+        response = self.client.get(url.format(self.year.pk, 'CX'))
+        self.assertEqual([thirdparty.balance for thirdparty in response.context['object_list']], [Decimal('-1.00')])
+        response = self.client.get(url.format(self.year.pk, 'C'))
+        self.assertEqual(list(response.context['object_list']), [])
+
+
+class AccountClassTests(TestCase):
+    def test_of_class(self):
+        bank = AccountFactory.create(number='5120000')
+        self.assertEqual((bank.category, bank.group, bank.role), (5, 51, Account.BANK))
+        expense = TransactionFactory.create(account=AccountFactory.create(number='6000000'))
+        investment = TransactionFactory.create(account=AccountFactory.create(number='2150000'))
+        TransactionFactory.create(account=AccountFactory.create(number='2800000'))
+        self.assertEqual(set(Transaction.objects.of_class(6, 21)), {expense, investment})
+        self.assertEqual(list(Account.objects.of_role(Account.BANK)), [bank])
+
+    def test_roles(self):
+        # Only the main bank and cash accounts get these roles, as the reconciliation and the cash flow expect
+        for number, role in (('5120000', Account.BANK), ('5121000', None), ('5300000', Account.CASH),
+                             ('5310000', None), ('4110000', Account.CLIENT), ('4010000', Account.PROVIDER)):
+            self.assertEqual(AccountFactory.create(number=number).role, role)
+
+
+class ReferenceTests(TestCase):
+    def setUp(self):
+        accounts.clear()
+        self.bank = AccountFactory.create(number='5120000')
+
+    def test_cache(self):
+        self.assertEqual(accounts.BANK, self.bank)
+        self.assertEqual(journals.BQ.number, 'BQ')
+        with self.assertNumQueries(0):
+            self.assertEqual(accounts.get('5120000'), self.bank)
+            self.assertEqual(journals.get('BQ').number, 'BQ')
+        self.bank.title = "Banque"
+        self.bank.save()
+        self.assertEqual(accounts.BANK.title, "Banque")
+        with self.assertRaises(Account.DoesNotExist):
+            accounts.CASH
+
+
+class ReferenceChoiceFieldTests(TestCase):
+    def setUp(self):
+        accounts.clear()
+        self.expense = AccountFactory.create(number='6060000')
+        self.bank = AccountFactory.create(number='5120000')
+
+    def test_render(self):
+        PurchaseTransactionForm().as_p()
+        with self.assertNumQueries(0):
+            forms = [PurchaseTransactionForm(prefix=str(i), initial={'account': self.expense.pk}) for i in range(5)]
+            html = str(forms[0]['account'])
+            for form in forms[1:]:
+                str(form['account'])
+        self.assertIn('<option selected value="{}">'.format(self.expense.pk), html)
+        self.assertNotIn(self.bank.number, html)
+
+    def test_validate(self):
+        field = PurchaseTransactionForm().fields['account']
+        accounts.all()
+        with self.assertNumQueries(0):
+            self.assertEqual(field.clean(str(self.expense.pk)), self.expense)
+            with self.assertRaises(ValidationError):
+                field.clean(str(self.bank.pk))
+            with self.assertRaises(ValidationError):
+                field.clean('foo')
+
+
+class ThirdPartyAutocompleteViewTests(TestCase):
+    def test_search(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        foo = ThirdPartyFactory.create(number='F001', title="Foo")
+        ThirdPartyFactory.create(number='B001', title="Bar")
+        response = self.client.get('/accounting/thirdparty/autocomplete/', {'q': 'fo'})
+        self.assertEqual(response.json(), {'results': [{'id': foo.pk, 'text': "F001 : Foo"}]})
+
+
+class ChecksTests(TestCase):
+    def setUp(self):
+        self.year = YearFactory.create()
+        self.expense = TransactionFactory.create(entry__year=self.year, account=AccountFactory.create(number='6000000'),
+                                                 expense='1.00')
+
+    def get_results(self):
+        return set(CheckResult.objects.values_list('check', 'transaction_id', 'entry_id'))
+
+    def test_incremental(self):
+        run_checks(self.year)
+        self.assertEqual(self.get_results(), {
+            ('missing_analytic', self.expense.pk, self.expense.entry_id),
+            ('pure_entries', None, self.expense.entry_id),
+        })
+        self.expense.analytic = AnalyticFactory.create()
+        self.expense.save()
+        run_checks(self.year)
+        self.assertEqual(self.get_results(), {('pure_entries', None, self.expense.entry_id)})
+        # Queryset updates mark the entry as modified too
+        Transaction.objects.update(analytic=None)
+        run_checks(self.year)
+        self.assertEqual(len(self.get_results()), 2)
+        run_checks(self.year, full=True)
+        self.assertEqual(len(self.get_results()), 2)
+
+    def test_unchanged_save(self):
+        modified = Entry.objects.get(pk=self.expense.entry_id).modified
+        # Untracked fields are saved, but the entry is not marked for the next run
+        self.expense.title = "Autre intitulé"
+        with self.assertNumQueries(1):
+            self.expense.save()
+        self.assertEqual(Entry.objects.get(pk=self.expense.entry_id).modified, modified)
+
+    def test_queryset_update(self):
+        run_checks(self.year)
+        Transaction.objects.filter(pk=self.expense.pk).update(account=AccountFactory.create(number='5120000'))
+        run_checks(self.year)
+        self.assertEqual(self.get_results(), {('pure_entries', None, self.expense.entry_id)})
+        Transaction.objects.bulk_update([Transaction(pk=self.expense.pk, account=self.expense.account)], ['account'])
+        run_checks(self.year)
+        self.assertEqual(self.get_results(), {
+            ('missing_analytic', self.expense.pk, self.expense.entry_id),
+            ('pure_entries', None, self.expense.entry_id),
+        })
+
+    def test_unbalanced_letters(self):
+        run_checks(self.year)
+        # Letters are checked again on every run
+        letter = Letter.objects.create()
+        Transaction.objects.update(letter=letter)
+        run_checks(self.year)
+        self.assertEqual(CheckResult.objects.get(check='unbalanced_letters').letter, letter)
+
+    def test_view(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        url = '/accounting/{}/checks/'.format(self.year.pk)
+        # Loading the page does not run the checks
+        response = self.client.get(url)
+        self.assertContains(response, "Jamais contrôlé")
+        self.assertFalse(CheckResult.objects.exists())
+        self.assertRedirects(self.client.post(url), url)
+        response = self.client.get(url)
+        checks = {check.code: results for check, results in response.context['checks']}
+        self.assertEqual([result.transaction for result in checks['missing_analytic']], [self.expense])
+        self.assertEqual(checks['extra_thirdparty'], [])
+        self.assertContains(response, "Pas de tiers superflu")
+
+
+class RunningBalanceTests(TestCase):
+    def setUp(self):
+        entry = EntryFactory.create()
+        for day, revenue, expense in ((3, '1.00', '0'), (1, '0', '4.00'), (3, '2.50', '0')):
+            TransactionFactory.create(entry__date=datetime.date(2010, 6, day), entry__year=entry.year,
+                                      revenue=revenue, expense=expense)
+
+    def test_window(self):
+        rows = Transaction.objects.running_balance('entry__date', opening=10)
+        self.assertEqual([row['solde'] for row in rows], [6, 7, Decimal('9.5')])
+
+    def test_fallback(self):
+        with mock.patch('django.db.backends.sqlite3.features.DatabaseFeatures.supports_over_clause', False):
+            rows = list(Transaction.objects.running_balance('entry__date', opening=10))
+        self.assertEqual([row['solde'] for row in rows], [6, 7, Decimal('9.5')])
+
+
+class AccountViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+
+    @mock.patch.object(AccountView, 'page_size', 2)
+    def test_pages(self):
+        year = YearFactory.create()
+        account = AccountFactory.create()
+        for day, amount in ((1, '1.00'), (2, '2.00'), (3, '4.00')):
+            entry = EntryFactory.create(year=year, date=datetime.date(2010, 6, day))
+            TransactionFactory.create(entry=entry, account=account, revenue=amount)
+        url = '/accounting/{}/account/?account={}'.format(year.pk, account.pk)
+        response = self.client.get(url)
+        self.assertEqual([row['solde'] for row in response.context['object_list']], [1, 3])
+        self.assertEqual(response.context['solde'], 7)
+        response = self.client.get(url + '&' + response.context['next_query'])
+        self.assertEqual(response.context['opening'], 3)
+        self.assertEqual([row['solde'] for row in response.context['object_list']], [7])
+        self.assertNotIn('next_query', response.context)
+
+
+class ThirdPartyDetailViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+
+    def test_accumulator(self):
+        year = YearFactory.create()
+        thirdparty = ThirdPartyFactory.create()
+        for day, amount in ((2, '2.00'), (1, '1.00')):
+            entry = EntryFactory.create(year=year, date=datetime.date(2010, 6, day))
+            TransactionFactory.create(entry=entry, account=thirdparty.account, thirdparty=thirdparty, revenue=amount)
+        response = self.client.get('/accounting/{}/thirdparty/{}/'.format(year.pk, thirdparty.pk))
+        self.assertContains(response, "3,00", count=3)
+        self.assertContains(response, "1,00", count=2)
+
+
+class CashFlowJsonViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+
+    def test_serie(self):
+        bank = AccountFactory.create(number='5120000')
+        YearFactory.create(start=datetime.date(2013, 1, 1), end=datetime.date(2013, 12, 31))
+        year = YearFactory.create(start=datetime.date(2014, 1, 1), end=datetime.date(2014, 12, 31))
+        for day, amount in ((datetime.date(2013, 3, 1), '5.00'), (datetime.date(2014, 2, 1), '1.00'),
+                            (datetime.date(2014, 3, 1), '2.00')):
+            TransactionFactory.create(entry__year=year, account=bank, expense=amount, reconciliation=day)
+        response = self.client.get('/accounting/{}/cash-flow/data/'.format(year.pk))
+        reference_serie, serie = response.json()['series']
+        self.assertEqual((serie[30], serie[31], serie[58], serie[59], serie[-1]), (0, '1.00', '1.00', '3.00', '3.00'))
+        self.assertEqual((reference_serie[58], reference_serie[59]), (0, '5.00'))
+
+    def test_conditional(self):
+        bank = AccountFactory.create(number='5120000')
+        YearFactory.create(start=datetime.date(2013, 1, 1), end=datetime.date(2013, 12, 31))
+        year = YearFactory.create(start=datetime.date(2014, 1, 1), end=datetime.date(2014, 12, 31))
+        transaction = TransactionFactory.create(entry__year=year, account=bank, expense='1.00',
+                                                reconciliation=datetime.date(2014, 2, 1))
+        url = '/accounting/{}/cash-flow/data/'.format(year.pk)
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        transaction.reconciliation = None
+        transaction.save()
+        self.assertFalse(CashFlowBalance.objects.exists())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class BalanceViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+
+    def test_debit(self):
+        year = YearFactory.create(opened=True)
+        purchase = PurchaseFactory.create(year=year, transactions__amount=1.11)
+        response = self.client.get('/accounting/{}/balance/?balance=D'.format(year.pk))
+        account = purchase.transaction_set.get(account__number__startswith='6').account
+        self.assertEqual([row['account__id'] for row in response.context['data']], [account.pk])
+        self.assertEqual(response.context['balance'], Decimal('-1.11'))
+
+
+class CarryForwardTests(TestCase):
+    def setUp(self):
+        self.old_year = YearFactory.create(start=datetime.date(2013, 1, 1), end=datetime.date(2013, 12, 31))
+        self.new_year = YearFactory.create(start=datetime.date(2014, 1, 1), end=datetime.date(2014, 12, 31),
+                                           opened=True)
+        AccountFactory.create(number='1200000')
+        AccountFactory.create(number='1290000')
+        self.bank = AccountFactory.create(number='5120000')
+        self.purchase = PurchaseFactory.create(year=self.old_year, transactions__amount=Decimal('1.11'))
+        TransactionFactory.create(entry=self.purchase, account=self.bank, revenue='0.11')
+        TransactionFactory.create(entry=self.purchase, account=self.bank, revenue='1.00')
+
+    def test_dry_run(self):
+        transactions = self.old_year.carry_forward(self.new_year, commit=False)
+        self.assertEqual([(t.account.number, t.expense, t.revenue) for t in transactions], [
+            ('5120000', 0, Decimal('1.11')),
+            (self.purchase.transaction_set.get(account__number__startswith='4').account.number, 0, Decimal('1.11')),
+            ('1290000', Decimal('1.11'), 0),
+        ])
+        self.assertFalse(Transaction.objects.filter(entry__year=self.new_year).exists())
+
+    def test_idempotent(self):
+        self.old_year.carry_forward(self.new_year)
+        self.old_year.carry_forward(self.new_year)
+        entry = self.new_year.entry_set.get()
+        self.assertEqual(entry.transaction_set.count(), 3)
+        self.assertEqual(AccountBalance.objects.get(year=self.new_year, account=self.bank).balance, Decimal('1.11'))
+
+
+class LetteringTests(TestCase):
+    def test_exact(self):
+        self.assertEqual(match_zero_sum([(1, 100), (2, 50), (3, -100), (4, -100)]), [[1, 3]])
+
+    def test_subset(self):
+        lines = [(1, 100), (2, -30), (3, -20), (4, -50), (5, 7), (6, -3)]
+        self.assertEqual(match_zero_sum(lines), [[1, 3, 2, 4]])
+        self.assertEqual(match_zero_sum(lines, size=3), [])
+
+    def test_size(self):
+        # The unbalanced remainder is left unlettered
+        lines = [(1, -5), (2, 2), (3, 3), (4, 1)]
+        self.assertEqual(match_zero_sum(lines, size=2), [])
+        self.assertEqual(match_zero_sum(lines, size=3), [[1, 2, 3]])
+        self.assertIsNone(find_subset([2, 3], 5, 1))
+        self.assertEqual(find_subset([2, 3, 5], 5, 1), [2])
+        self.assertEqual(find_subset([2, 3, 5], 5, 2, skip={2}), [0, 1])
+
+    def test_remainder(self):
+        self.assertEqual(match_zero_sum([(1, 1), (2, 1), (3, 1), (4, 1), (5, -4)], size=2), [[1, 2, 3, 4, 5]])
+
+    def test_auto_letter(self):
+        year = YearFactory.create()
+        thirdparty = ThirdPartyFactory.create()
+        for amount in ('1.50', '-0.50', '-1.00', '2.00'):
+            TransactionFactory.create(entry__year=year, account=thirdparty.account, thirdparty=thirdparty,
+                                      revenue=max(Decimal(amount), 0), expense=max(-Decimal(amount), 0))
+        self.assertEqual(Transaction.objects.auto_letter(), 1)
+        self.assertEqual(Transaction.objects.filter(letter=None).get().revenue, Decimal('2.00'))
+        self.assertEqual(Transaction.objects.values('letter').distinct().count(), 2)
+
+    def test_auto_letter_view(self):
+        year = YearFactory.create(opened=False)
+        thirdparty = ThirdPartyFactory.create()
+        for amount in ('1.00', '-1.00'):
+            TransactionFactory.create(entry__year=year, account=thirdparty.account, thirdparty=thirdparty,
+                                      revenue=max(Decimal(amount), 0), expense=max(-Decimal(amount), 0))
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        url = '/accounting/{}/account/'.format(year.pk)
+        # Closed years are not lettered
+        self.assertEqual(self.client.post(url, {'auto': ''}).status_code, 403)
+        self.assertFalse(Letter.objects.exists())
+        year.opened = True
+        year.save()
+        self.assertRedirects(self.client.post(url, {'auto': ''}), url, fetch_redirect_response=False)
+        self.assertEqual(Letter.objects.count(), 1)
+
+    def test_codes(self):
+        self.assertEqual([letter_code(number) for number in (0, 1, 26, 675, 676, 677)],
+                         ['AA', 'AB', 'BA', 'ZZ', 'AAA', 'AAB'])
+        year = YearFactory.create()
+        thirdparties = [ThirdPartyFactory.create(), ThirdPartyFactory.create()]
+        for thirdparty in thirdparties + thirdparties[:1]:
+            for amount in ('1.00', '-1.00'):
+                TransactionFactory.create(entry__year=year, account=thirdparty.account, thirdparty=thirdparty,
+                                          revenue=max(Decimal(amount), 0), expense=max(-Decimal(amount), 0))
+        Transaction.objects.auto_letter(size=2)
+        self.assertEqual(sorted(Letter.objects.values_list('thirdparty', 'code')), [
+            (thirdparties[0].pk, 'AA'), (thirdparties[0].pk, 'AB'), (thirdparties[1].pk, 'AA'),
+        ])
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        response = self.client.get('/accounting/{}/account/'.format(year.pk),
+                                   {'thirdparty': thirdparties[0].pk, 'letter': 'ab'})
+        self.assertEqual([row['letter__code'] for row in response.context['object_list']], ['AB', 'AB'])
+
+
+@override_settings(IBAN='FR7630006000011234567890189', HOLDER="Becours")
+class TransferOrderTests(TestCase):
+    def setUp(self):
+        self.year = YearFactory.create()
+        self.bank = AccountFactory.create(number='5120000')
+        self.expenditures = [self.create_expenditure(amount) for amount in ('1.00', '2.00', '4.00')]
+        self.expenditures[2].transaction_set.filter(account=self.bank).update(reconciliation=datetime.date.today())
+        cache.clear()
+
+    def create_expenditure(self, amount, iban='DE89370400440532013000'):
+        expenditure = Expenditure.objects.create(year=self.year, journal=Journal.objects.get(number='BQ'), method=5,
+                                                 title="Virement {}".format(amount))
+        TransactionFactory.create(entry=expenditure, account=self.bank, revenue=amount)
+        TransactionFactory.create(entry=expenditure, thirdparty=ThirdPartyFactory.create(iban=iban), expense=amount)
+        return expenditure
+
+    def test_batch(self):
+        expenditures = Expenditure.objects.unpaid_transfers()
+        self.assertEqual(set(expenditures), set(self.expenditures[:2]))
+        content = expenditures.sepa()
+        self.assertEqual(content.count('<PmtInf>'), 1)
+        self.assertIn('<CtrlSum>3.00</CtrlSum>', content)
+        self.assertEqual(expenditures.sepa(), content)
+        self.expenditures[0].transaction_set.filter(expense__gt=0).update(expense='1.50')
+        self.assertNotEqual(expenditures.sepa(), content)
+
+    def test_invalid_ibans(self):
+        invalid = [self.create_expenditure(amount, iban='FR76') for amount in ('8.00', '16.00')]
+        with self.assertRaises(ValueError) as context:
+            Expenditure.objects.unpaid_transfers().sepa()
+        for expenditure in invalid:
+            self.assertIn(str(expenditure.transaction_set.get(expense__gt=0).thirdparty), str(context.exception))
+
+    def test_view(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        url = '/accounting/{}/transfer-order/download/'.format(self.year.pk)
+        self.assertContains(self.client.get(url), '<NbOfTxs>2</NbOfTxs>')
+        # An empty selection is reported on the list of expenditures
+        response = self.client.get(url, {'start': datetime.date.today() + datetime.timedelta(days=1)}, follow=True)
+        self.assertRedirects(response, '/accounting/{}/expenditure/'.format(self.year.pk))
+        self.assertContains(response, "Aucun virement à ordonner")
+        url = '/accounting/{}/transfer-order/{}/download/'.format(self.year.pk, self.expenditures[0].pk)
+        self.assertContains(self.client.get(url), '<NbOfTxs>1</NbOfTxs>')
+
+
+class ImporterTests(TestCase):
+    FEC = (
+        "JournalCode\tJournalLib\tEcritureNum\tEcritureDate\tCompteNum\tCompteLib\tCompAuxNum\tCompAuxLib\t"
+        "PieceRef\tPieceDate\tEcritureLib\tDebit\tCredit\tEcritureLet\tDateLet\tValidDate\tMontantdevise\tIdevise\n"
+        "HA\tAchats\t12\t20140105\t6060000\tAchats\t\t\t12\t20140105\tFournitures\t10,50\t0,00\t\t\t20140105\t\t\n"
+        "HA\tAchats\t12\t20140105\t4010000\tFournisseurs\tF001\tPapeterie\t12\t20140105\tFournitures\t0,00\t"
+        "10,50\t\t\t20140105\t\t\n"
+        "HA\tAchats\t13\t20140106\t6060000\tAchats\t\t\t13\t20140106\tBancal\t1,00\t0,00\t\t\t20140106\t\t\n"
+        "BQ\tBanque\t14\t20150101\t5120000\tBanque\t\t\t14\t20150101\tHors exercice\t1,00\t0,00\t\t\t20150101\t\t\n"
+        "BQ\tBanque\t14\t20150101\t6060000\tAchats\t\t\t14\t20150101\tHors exercice\t0,00\t1,00\t\t\t20150101\t\t\n"
+    )
+
+    def setUp(self):
+        self.year = YearFactory.create(start=datetime.date(2014, 1, 1), end=datetime.date(2014, 12, 31))
+
+    def test_fec(self):
+        importer = Importer(self.year)
+        self.assertEqual(importer.run(read_rows(StringIO(self.FEC))), 1)
+        self.assertEqual(importer.errors, [
+            ('4', "Écriture non équilibrée"),
+            ('5', "Date hors de l'exercice : 2015-01-01"),
+        ])
+        entry = Entry.objects.get()
+        self.assertEqual((entry.title, entry.date, entry.revenue, entry.import_ref), (
+            "Fournitures", datetime.date(2014, 1, 5), Decimal('10.50'), '12'
+        ))
+        provider = entry.transaction_set.get(thirdparty__isnull=False)
+        self.assertEqual((provider.account.number, provider.account.role, provider.thirdparty.title),
+                         ('4010000', Account.PROVIDER, "Papeterie"))
+        self.assertEqual(ThirdPartyBalance.objects.get().balance, Decimal('10.50'))
+        # Importing again skips the entries already imported
+        importer = Importer(self.year)
+        self.assertEqual(importer.run(read_rows(StringIO(self.FEC))), 0)
+        self.assertEqual((importer.skipped, Entry.objects.count()), (1, 1))
+
+    def test_scattered(self):
+        header, *rows = self.FEC.splitlines(keepends=True)
+        # The rows of entry 12 separated by other entries, entry 14 moved into the year but at two dates
+        data = header + rows[0] + rows[2] + rows[3].replace('20150101', '20140110') + rows[1] + \
+            rows[4].replace('20150101', '20140111')
+        importer = Importer(self.year)
+        self.assertEqual(importer.run(read_rows(StringIO(data))), 1)
+        self.assertEqual(importer.errors, [
+            ('3', "Écriture non équilibrée"),
+            ('4, 6', "Dates différentes dans l'écriture : 2014-01-10, 2014-01-11"),
+        ])
+        self.assertEqual((importer.skipped, Entry.objects.get().transaction_set.count()), (0, 2))
+        self.assertEqual(ThirdParty.objects.get().type, ThirdParty.OTHER)
+
+    def test_limits(self):
+        existing = TransactionFactory.create(entry__year=self.year, entry__date=datetime.date(2014, 1, 5),
+                                             account=AccountFactory.create(number='6060000'), expense='2.00')
+        modified = Entry.objects.values_list('modified', flat=True).get(pk=existing.entry_id)
+        header, *rows = self.FEC.splitlines(keepends=True)
+        data = header + rows[0] + rows[1] + ''.join(
+            row.replace('\t12\t', '\t{}\t'.format(number))
+            for number, row in (
+                ('20', rows[0].replace('10,50', '1000000,00')), ('20', rows[1]),
+                ('21', rows[0]), ('21', rows[1].replace('Papeterie', 'P' * 101).replace('F001', 'F002')),
+            )
+        )
+        importer = Importer(self.year)
+        self.assertEqual(importer.run(read_rows(StringIO(data))), 1)
+        self.assertEqual(importer.errors, [
+            ('4', "Montant invalide : 1000000.00"),
+            ('7', "Intitulé de tiers trop long : " + 'P' * 101),
+        ])
+        # The balances add up with the existing transactions, which are left alone
+        ledger = LedgerBalance.objects.filter(account__number='6060000').aggregate(expense=Sum('expense'))
+        self.assertEqual(ledger['expense'], Decimal('12.50'))
+        self.assertEqual(ThirdPartyBalance.objects.get().balance, Decimal('10.50'))
+        self.assertEqual(Entry.objects.get(import_ref='12').revenue, Decimal('10.50'))
+        self.assertEqual(Entry.objects.values_list('modified', flat=True).get(pk=existing.entry_id), modified)
+
+    def test_csv(self):
+        AccountFactory.create(number='6060000')
+        data = (
+            '"journal_number";"date_dmy";"account_number";"entry_id";"thirdparty_number";"__str__";'
+            '"expense";"revenue"\n'
+            '"OD";"010214";"6060000";"3";"";"Transfert";1.00;0.00\n'
+            '"OD";"010214";"6070000";"3";"";"Transfert";0.00;1.00\n'
+        )
+        out = StringIO()
+        with mock.patch('builtins.open', mock.mock_open(read_data=data)):
+            call_command('import_accounting_entries', self.year.pk, 'entries.csv', stdout=out, stderr=StringIO())
+        self.assertIn("1 entries imported", out.getvalue())
+        self.assertEqual(Entry.objects.get().transaction_set.count(), 2)
+
+
+class LetterInvalidationTests(TestCase):
+    def setUp(self):
+        year = YearFactory.create()
+        thirdparty = ThirdPartyFactory.create()
+        self.transactions = [
+            TransactionFactory.create(entry__year=year, account=thirdparty.account, thirdparty=thirdparty,
+                                      revenue=revenue, expense=expense)
+            for revenue, expense in (('1.00', '0'), ('0', '1.00'), ('2.00', '0'), ('0', '2.00'))
+        ]
+        Transaction.objects.auto_letter()
+        self.transactions = list(Transaction.objects.order_by('pk'))
+
+    def test_save(self):
+        transaction = self.transactions[0]
+        with CaptureQueriesContext(connection) as queries:
+            transaction.revenue = '1.00'
+            transaction.save()
+        # The stored amounts come from the load snapshot, not from a query
+        selects = [query for query in queries if query['sql'].startswith('SELECT "accounting_transaction"."id"')]
+        self.assertEqual(selects, [])
+        self.assertEqual(Transaction.objects.filter(letter=None).count(), 0)
+        transaction.revenue = '1.50'
+        transaction.save()
+        self.assertIsNone(transaction.letter)
+        self.assertEqual(Transaction.objects.filter(letter=None).count(), 2)
+        self.assertEqual(ThirdPartyBalance.objects.get().not_lettered, 2)
+
+    def test_update(self):
+        Transaction.objects.filter(revenue__gt=0).update(revenue=Decimal('2.00'))
+        self.assertEqual(Letter.objects.count(), 1)
+        Transaction.objects.bulk_update([Transaction(pk=self.transactions[3].pk, expense=3)], ['expense'])
+        self.assertFalse(Letter.objects.exists())
+
+
+class BankStatementTests(TestCase):
+    CAMT = b"""<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02"><BkToCstmrStmt><Stmt>
+<Ntry><Amt Ccy="EUR">12.50</Amt><CdtDbtInd>DBIT</CdtDbtInd><BookgDt><Dt>2014-06-03</Dt></BookgDt>
+<AddtlNtryInf>PRLV FOO</AddtlNtryInf></Ntry>
+</Stmt></BkToCstmrStmt></Document>"""
+    OFX = b"<OFX><STMTTRN>\n<TRNTYPE>CREDIT\n<DTPOSTED>20140603\n<TRNAMT>7.00\n<NAME>VIR BAR\n</STMTTRN></OFX>"
+    CSV = "Date;Libellé;Montant\n03/06/2014;CB BAZ;-1 000,10\n".encode()
+
+    def test_parse(self):
+        day = datetime.date(2014, 6, 3)
+        self.assertEqual(parse_statement('releve.xml', self.CAMT), [(day, Decimal('-12.50'), "PRLV FOO")])
+        self.assertEqual(parse_statement('releve.OFX', self.OFX), [(day, Decimal('7.00'), "VIR BAR")])
+        self.assertEqual(parse_statement('releve.csv', self.CSV), [(day, Decimal('-1000.10'), "CB BAZ")])
+
+    def test_invalid(self):
+        # Unparsable lines are reported with their content, not skipped as in csv files
+        with self.assertRaisesRegex(ValueError, r"montant '12\.5x'.*12\.5x DBIT 2014-06-03 PRLV FOO"):
+            parse_statement('releve.xml', self.CAMT.replace(b'12.50', b'12.5x'))
+        with self.assertRaisesRegex(ValueError, r"date ''"):
+            parse_statement('releve.xml', self.CAMT.replace(b'<BookgDt><Dt>2014-06-03</Dt></BookgDt>', b''))
+        with self.assertRaisesRegex(ValueError, "illisible"):
+            parse_statement('releve.xml', self.CAMT[:-10])
+        with self.assertRaisesRegex(ValueError, r"date ''.*<TRNAMT>7\.00"):
+            parse_statement('releve.ofx', self.OFX.replace(b'<DTPOSTED>20140603\n', b''))
+        with self.assertRaisesRegex(ValueError, r"montant ''"):
+            parse_statement('releve.ofx', self.OFX.replace(b'<TRNAMT>7.00\n', b''))
+        with self.assertRaisesRegex(ValueError, r"montant 'sept'"):
+            parse_statement('releve.ofx', self.OFX.replace(b'7.00', b'sept'))
+
+    def test_invalid_upload(self):
+        with TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            statement = BankStatement.objects.create(
+                year=YearFactory.create(), date=datetime.date(2014, 6, 30), balance=0,
+                data=ContentFile(self.OFX.replace(b'7.00', b'sept'), name='releve.ofx')
+            )
+            # Reported to the user instead of failing with a server error
+            self.client.force_login(user=PersonFactory.create(is_superuser=True))
+            response = self.client.post('/admin/accounting/bankstatement/', {
+                'action': 'reconcile', '_selected_action': [statement.pk],
+            }, follow=True)
+            self.assertContains(response, "Ligne de relevé invalide")
+            with self.assertRaisesRegex(CommandError, "Ligne de relevé invalide"):
+                call_command('reconcile', statement.pk, stdout=StringIO())
+
+    def test_match_lines(self):
+        day = datetime.date(2014, 6, 10)
+        lines = [StatementLine(day, Decimal(1), ''), StatementLine(day, Decimal(2), '')]
+        transactions = [(1, datetime.date(2014, 6, 1), Decimal(1)), (2, datetime.date(2014, 6, 8), Decimal(1)),
+                        (3, datetime.date(2014, 6, 11), Decimal(1)), (4, datetime.date(2014, 6, 1), Decimal(2))]
+        self.assertEqual(match_lines(lines, transactions), ([(3, lines[0])], [lines[1]]))
+
+    def test_reconcile(self):
+        year = YearFactory.create()
+        bank = AccountFactory.create(number='5120000')
+        transaction = TransactionFactory.create(entry__year=year, entry__date=datetime.date(2014, 6, 1),
+                                                account=bank, revenue='12.50')
+        statement = BankStatement(year=year, date=datetime.date(2014, 6, 30), balance=0,
+                                  data=ContentFile(self.CAMT, name='releve.xml'))
+        with mock.patch.object(CashFlowBalance, 'refresh', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                statement.reconcile()
+        # The reconciliations are rolled back with the failed cash flow refresh
+        transaction.refresh_from_db()
+        self.assertIsNone(transaction.reconciliation)
+        self.assertEqual(statement.reconcile(), [])
+        transaction.refresh_from_db()
+        self.assertEqual(transaction.reconciliation, datetime.date(2014, 6, 3))
+        self.assertEqual(CashFlowBalance.objects.get().date, datetime.date(2014, 6, 3))
+
+
+class ExportViewTests(TestCase):
+    def setUp(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        self.year = YearFactory.create(start=datetime.date(2014, 1, 1), end=datetime.date(2014, 12, 31))
+        thirdparty = ThirdPartyFactory.create(number='FOO', title="Foo")
+        entry = EntryFactory.create(year=self.year, date=datetime.date(2014, 6, 2), title="Bar")
+        TransactionFactory.create(entry=entry, account=thirdparty.account, thirdparty=thirdparty, revenue='1.50')
+
+    def get_lines(self, url):
+        response = self.client.get(url.format(self.year.pk))
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def test_entry_csv(self):
+        header, line = self.get_lines('/accounting/{}/entry.csv')
+        self.assertEqual(header, '"journal_number";"date_dmy";"account_number";"entry_id";'
+                                 '"thirdparty_number";"__str__";"expense";"revenue"')
+        self.assertIn('"020614";', line)
+        self.assertIn(';"FOO";"Bar";0.00;1.50', line)
+
+    def test_fec(self):
+        header, line = self.get_lines('/accounting/{}/fec.txt')
+        self.assertEqual(len(header.split('\t')), 18)
+        fields = line.split('\t')
+        self.assertEqual(fields[3], '20140602')
+        self.assertEqual(fields[6:8], ['FOO', 'Foo'])
+        self.assertEqual(fields[10:13], ['Bar', '0,00', '1,50'])
+
+    def test_fec_letter(self):
+        entry = Entry.objects.get()
+        entry.title = 'Bar\t"baz"\nqux'
+        entry.save()
+        transaction = Transaction.objects.get()
+        letter = Letter.objects.create(account=transaction.account, thirdparty=transaction.thirdparty,
+                                       date=datetime.date(2014, 7, 1))
+        Transaction.objects.update(letter=letter)
+        header, line = self.get_lines('/accounting/{}/fec.txt')
+        fields = line.split('\t')
+        self.assertEqual(len(fields), 18)
+        self.assertEqual(fields[10], 'Bar "baz" qux')
+        self.assertEqual(fields[13:15], ['AA', '20140701'])
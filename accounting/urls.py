@@ -3,13 +3,14 @@ from .views import (
     BalanceView, AnalyticBalanceView, ChecksView, YearListView,
     BankStatementView, AccountView, ReconciliationView, ThirdPartyCsvView,
     NextReconciliationView, ProjectionView, EntryView, EntryListView,
-    CashFlowView, CashFlowJsonView, TransferOrderDownloadView, EntryCsvView,
+    CashFlowView, CashFlowJsonView, TransferOrderDownloadView, TransferOrderBatchView, EntryCsvView, FecView,
     PurchaseListView, PurchaseDetailView, PurchaseCreateView, PurchaseUpdateView, PurchaseDeleteView,
     SaleListView, SaleDetailView, SaleCreateView, SaleUpdateView, SaleDeleteView,
     IncomeListView, IncomeDetailView, IncomeCreateView, IncomeUpdateView, IncomeDeleteView,
     ExpenditureListView, ExpenditureDetailView, ExpenditureCreateView, ExpenditureUpdateView, ExpenditureDeleteView,
     CashingListView, CashingDetailView, CashingCreateView, CashingUpdateView, CashingDeleteView,
     ThirdPartyListView, ThirdPartyDetailView, ThirdPartyCreateView, ThirdPartyUpdateView, ThirdPartyDeleteView,
+    ThirdPartyAutocompleteView,
     EntryToPurchaseView, EntryToSaleView, EntryToIncomeView, EntryToExpenditureView,
 )
 
@@ -20,6 +21,7 @@ urlpatterns = [
     url(r'^(?P<year_pk>\d+)/entry/$', EntryListView.as_view(), name='entry_list'),
     url(r'^(?P<year_pk>\d+)/entry/(?P<pk>\d+)/$', EntryView.as_view(), name='entry'),
     url(r'^(?P<year_pk>\d+)/entry.csv$', EntryCsvView.as_view(), name='entry-csv'),
+    url(r'^(?P<year_pk>\d+)/fec.txt$', FecView.as_view(), name='fec'),
     url(r'^(?P<year_pk>\d+)/projection/$', ProjectionView.as_view(), name='projection'),
     url(r'^(?P<year_pk>\d+)/balance/$', BalanceView.as_view(), name='balance'),
     url(r'^(?P<year_pk>\d+)/account/$', AccountView.as_view(), name='account'),
@@ -28,6 +30,7 @@ urlpatterns = [
     url(r'^(?P<year_pk>\d+)/thirdparty/create/$', ThirdPartyCreateView.as_view(), name='thirdparty_create'),
     url(r'^(?P<year_pk>\d+)/thirdparty/(?P<pk>\d+)/update/$', ThirdPartyUpdateView.as_view(), name='thirdparty_update'),
     url(r'^(?P<year_pk>\d+)/thirdparty/(?P<pk>\d+)/delete/$', ThirdPartyDeleteView.as_view(), name='thirdparty_delete'),
+    url(r'^thirdparty/autocomplete/$', ThirdPartyAutocompleteView.as_view(), name='thirdparty_autocomplete'),
     url(r'^(?P<year_pk>\d+)/thirdparty.csv$', ThirdPartyCsvView.as_view(), name='thirdparty-csv'),
     url(r'^(?P<year_pk>\d+)/analytic-balance/$', AnalyticBalanceView.as_view(), name='analytic-balance'),
     url(r'^(?P<year_pk>\d+)/bank-statement/$', BankStatementView.as_view(), name='bank-statement'),
@@ -37,6 +40,8 @@ urlpatterns = [
     url(r'^(?P<year_pk>\d+)/cash-flow/data/$', CashFlowJsonView.as_view(), name='cash_flow_data'),
     url(r'^(?P<year_pk>\d+)/transfer-order/(?P<pk>\d+)/download/$', TransferOrderDownloadView.as_view(),
         name='transfer_order_download'),
+    url(r'^(?P<year_pk>\d+)/transfer-order/download/$', TransferOrderBatchView.as_view(),
+        name='transfer_order_batch'),
     url(r'^(?P<year_pk>\d+)/checks/$', ChecksView.as_view(), name='checks'),
     url(r'^(?P<year_pk>\d+)/entry/(?P<pk>\d+)/to_purchase/$', EntryToPurchaseView.as_view(), name='entry_to_purchase'),
     url(r'^(?P<year_pk>\d+)/entry/(?P<pk>\d+)/to_sale/$', EntryToSaleView.as_view(), name='entry_to_sale'),
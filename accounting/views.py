@@ -1,23 +1,29 @@
-from csv import DictWriter, QUOTE_NONNUMERIC
+from csv import writer, QUOTE_NONE, QUOTE_NONNUMERIC
 from collections import OrderedDict
-from datetime import date, timedelta
+from operator import itemgetter
+from datetime import date, datetime, timedelta
 from django.conf import settings
+from django.contrib import messages
 from django.contrib.auth.mixins import UserPassesTestMixin
-from django.db.models import F, Q, Min, Max, Sum, Count, Value
-from django.db.models.functions import Coalesce
-from django.http import JsonResponse, HttpResponse, HttpResponseRedirect
+from django.db.models import Count, F, Max, Q, Prefetch, Sum
+from django.http import Http404, JsonResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.urls import reverse, reverse_lazy
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_date
 from django.utils.formats import date_format
+from django.utils.http import http_date, quote_etag
 from django.utils.timezone import now
 from django.shortcuts import get_object_or_404
 from django.views.generic import ListView, DetailView, TemplateView, View, CreateView, UpdateView, DeleteView
 from django.views.generic.detail import SingleObjectMixin
 from django_filters.views import FilterView
+from .checks import CHECKS, run_checks
 from .filters import BalanceFilter, AccountFilter, ThirdPartyFilter
 from .forms import (PurchaseForm, PurchaseFormSet, SaleForm, SaleFormSet, CashingForm,
                     IncomeForm, ExpenditureForm, ExpenditureFormSet, ThirdPartyForm)
-from .models import (BankStatement, Transaction, Entry, ThirdParty, Cashing,
-                     Letter, Purchase, Year, Sale, Income, Expenditure)
+from .models import (Account, AccountBalance, AnalyticBalance, BankStatement, CashFlowBalance, CheckResult,
+                     Transaction, Entry, ThirdParty, Cashing, Letter, LedgerBalance, Purchase, Year, Sale, Income,
+                     Expenditure)
 
 
 class ReadMixin(UserPassesTestMixin):
@@ -45,7 +51,7 @@ class ProjectionView(YearMixin, ReadMixin, ListView):
 
     def get_queryset(self):
         qs = Transaction.objects.filter(entry__year=self.year)
-        qs = qs.filter(account__number__regex=r'^[67]')
+        qs = qs.of_class(6, 7)
         qs = qs.values('account_id', 'account__number', 'account__title', 'analytic__id', 'analytic__title')
         qs = qs.order_by('account__number', 'analytic__title')
         qs = qs.annotate(solde=Sum(F('revenue') - F('expense')))
@@ -63,19 +69,18 @@ class AnalyticBalanceView(YearMixin, ReadMixin, FilterView):
     filterset_class = BalanceFilter
 
     def get_queryset(self):
-        return Transaction.objects.filter(entry__year=self.year)
-
-    def get_filterset_kwargs(self, filterset_class):
-        kwargs = super().get_filterset_kwargs(filterset_class)
-        kwargs['aggregate'] = 'analytic'
-        return kwargs
+        return AnalyticBalance.objects.filter(year=self.year).order_by('analytic__number')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['data'] = self.object_list
-        context['revenues'] = sum([analytic['revenues'] for analytic in self.object_list])
-        context['expenses'] = sum([analytic['expenses'] for analytic in self.object_list])
-        context['balance'] = sum([analytic['balance'] for analytic in self.object_list])
+        totals = self.object_list.totals()
+        context['data'] = self.object_list.values(
+            'analytic__id', 'analytic__number', 'analytic__title', 'balance',
+            revenues=F('revenue'), expenses=F('expense'),
+        )
+        context['revenues'] = totals['revenue']
+        context['expenses'] = totals['expense']
+        context['balance'] = totals['balance']
         return context
 
 
@@ -84,23 +89,13 @@ class ThirdPartyListView(YearMixin, ReadMixin, FilterView):
     filterset_class = ThirdPartyFilter
 
     def get_queryset(self):
-        year_q = Q(transaction__entry__year=self.year)
-        year_qx = year_q & ~Q(transaction__account__number__in=('4090000', '4190000'))
-        qs = ThirdParty.objects.filter(transaction__entry__year=self.year).order_by('number')
+        qs = ThirdParty.objects.filter(thirdpartybalance__year=self.year).order_by('number')
         qs = qs.annotate(
-            revenue=Coalesce(Sum('transaction__revenue', filter=year_q), Value(0)),
-            expense=Coalesce(Sum('transaction__expense', filter=year_q), Value(0)),
-            balance=Coalesce(
-                Sum('transaction__revenue', filter=year_q)
-                - Sum('transaction__expense', filter=year_q),
-                Value(0)
-            ),
-            balancex=Coalesce(
-                Sum('transaction__revenue', filter=year_qx)
-                - Sum('transaction__expense', filter=year_qx),
-                Value(0)
-            ),
-            not_lettered=Count('transaction', filter=Q(transaction__letter__isnull=True))
+            revenue=F('thirdpartybalance__revenue'),
+            expense=F('thirdpartybalance__expense'),
+            balance=F('thirdpartybalance__balance'),
+            balancex=F('thirdpartybalance__balancex'),
+            not_lettered=F('thirdpartybalance__not_lettered'),
         )
         return qs
 
@@ -118,19 +113,15 @@ class ThirdPartyDetailView(YearMixin, ReadMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        transactions = self.object.transaction_set.filter(entry__year=self.year).order_by('entry__date')
-        balance = 0
-        revenue = 0
-        expense = 0
-        for transaction in transactions:
-            balance += transaction.revenue - transaction.expense
-            transaction.accumulator = balance
-            revenue += transaction.revenue
-            expense += transaction.expense
-        context['transactions'] = transactions
-        context['revenue'] = revenue
-        context['expense'] = expense
-        context['balance'] = balance
+        transactions = self.object.transaction_set.filter(entry__year=self.year)
+        totals = transactions.totals()
+        context['transactions'] = transactions.running_balance(
+            'entry_id', 'entry__date', 'entry__title', 'title', 'expense', 'revenue',
+            'account_id', 'account__number', 'account__title', 'analytic_id', 'analytic__number',
+        )
+        context['revenue'] = totals['revenue']
+        context['expense'] = totals['expense']
+        context['balance'] = totals['balance']
         return context
 
 
@@ -157,50 +148,118 @@ class ThirdPartyDeleteView(YearMixin, WriteMixin, DeleteView):
         return reverse_lazy('accounting:thirdparty_list', args=[self.year.pk])
 
 
+class ThirdPartyAutocompleteView(ReadMixin, View):
+    "Third parties matching the q parameter, for the type-ahead of the entry forms"
+    limit = 20
+
+    def get(self, request):
+        q = request.GET.get('q', '').strip()
+        thirdparties = ThirdParty.objects.filter(Q(number__istartswith=q) | Q(title__icontains=q))
+        return JsonResponse({'results': [
+            {'id': pk, 'text': "{} : {}".format(number, title)}
+            for pk, number, title in thirdparties.values_list('pk', 'number', 'title')[:self.limit]
+        ]})
+
+
 class BalanceView(YearMixin, ReadMixin, FilterView):
     template_name = "accounting/balance.html"
     filterset_class = BalanceFilter
 
     def get_queryset(self):
-        return Transaction.objects.filter(entry__year=self.year)
-
-    def get_filterset_kwargs(self, filterset_class):
-        kwargs = super().get_filterset_kwargs(filterset_class)
-        kwargs['aggregate'] = 'account'
-        return kwargs
+        return AccountBalance.objects.filter(year=self.year).order_by('account__number')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['data'] = self.object_list
-        context['revenues'] = sum([account['revenues'] for account in self.object_list])
-        context['expenses'] = sum([account['expenses'] for account in self.object_list])
-        context['balance'] = sum([account['balance'] for account in self.object_list])
+        totals = self.object_list.totals()
+        context['data'] = self.object_list.values(
+            'account__id', 'account__number', 'account__title', 'balance',
+            revenues=F('revenue'), expenses=F('expense'),
+        )
+        context['revenues'] = totals['revenue']
+        context['expenses'] = totals['expense']
+        context['balance'] = totals['balance']
         return context
 
 
 class AccountView(YearMixin, ReadMixin, FilterView):
     template_name = "accounting/account.html"
     filterset_class = AccountFilter
+    page_size = 500
+    fields = (
+        'id', 'entry_id', 'entry__date', 'entry__title', 'title', 'expense', 'revenue', 'letter__code',
+        'account_id', 'account__number', 'account__title', 'thirdparty_id', 'thirdparty__number',
+        'thirdparty__title', 'analytic_id', 'analytic__number',
+    )
 
     def get_queryset(self):
         return Transaction.objects.filter(entry__year=self.year).order_by('entry__date', 'pk')
 
+    def get_cursor(self):
+        "Date and pk of the last transaction of the previous page"
+        try:
+            day, pk = self.request.GET['after'].split('_')
+            return datetime.strptime(day, '%Y-%m-%d').date(), int(pk)
+        except (KeyError, ValueError):
+            return None
+
+    def get_balances(self):
+        "Ledger balances matching the filter, None if the filter is not supported by the store"
+        data = getattr(self.filterset.form, 'cleaned_data', {})
+        if data.get('lettered') is not None or data.get('letter'):
+            return None
+        balances = LedgerBalance.objects.filter(year=self.year)
+        for name in ('account', 'thirdparty', 'analytic'):
+            if data.get(name):
+                balances = balances.filter(**{name: data[name]})
+        return balances
+
+    def get_opening(self, transactions, balances, cursor):
+        "Balance of the transactions before the current page"
+        if cursor is None:
+            return 0
+        day, pk = cursor
+        if balances is None:
+            return transactions.filter(Q(entry__date__lt=day) | Q(entry__date=day, pk__lte=pk)).totals()['balance']
+        return balances.filter(date__lt=day).totals()['balance'] \
+            + transactions.filter(entry__date=day, pk__lte=pk).totals()['balance']
+
     def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        solde = 0
-        revenue = 0
-        expense = 0
-        for transaction in self.object_list:
-            solde += transaction.revenue - transaction.expense
-            transaction.solde = solde
-            revenue += transaction.revenue
-            expense += transaction.expense
-        context['revenue'] = revenue
-        context['expense'] = expense
-        context['solde'] = solde
+        transactions = kwargs.pop('object_list')
+        balances = self.get_balances()
+        cursor = self.get_cursor()
+        opening = self.get_opening(transactions, balances, cursor)
+        page = transactions
+        if cursor:
+            day, pk = cursor
+            page = page.filter(Q(entry__date__gt=day) | Q(entry__date=day, pk__gt=pk))
+        page = list(page.running_balance(*self.fields, opening=opening, limit=self.page_size + 1))
+        next_page = len(page) > self.page_size
+        page = page[:self.page_size]
+        context = super().get_context_data(object_list=page, **kwargs)
+        totals = (transactions if balances is None else balances).totals()
+        query = self.request.GET.copy()
+        query.pop('after', None)
+        if next_page:
+            last = page[-1]
+            query['after'] = '{:%Y-%m-%d}_{}'.format(last['entry__date'], last['id'])
+            context['next_query'] = query.urlencode()
+            query.pop('after')
+        if cursor:
+            context['first_query'] = query.urlencode()
+        context['opening'] = opening
+        context['revenue'] = totals['revenue']
+        context['expense'] = totals['expense']
+        context['solde'] = totals['balance']
         return context
 
     def post(self, request):
+        if 'auto' in request.POST:
+            if not (request.user.is_becours_treasurer and self.year.opened):
+                return self.handle_no_permission()
+            filterset = self.get_filterset(self.get_filterset_class())
+            if not filterset.is_bound or filterset.is_valid():
+                filterset.qs.auto_letter()
+            return HttpResponseRedirect(request.get_full_path())
         ids = [
             key[6:] for key, val in self.request.POST.items()
             if key.startswith('letter') and val == 'on'
@@ -215,7 +274,9 @@ class AccountView(YearMixin, ReadMixin, FilterView):
         if len(set([transaction.thirdparty_id for transaction in transactions])) > 1:
             return HttpResponse("Le lettrage doit concerner un seul tiers")
         if transactions:
-            transactions.update(letter=Letter.objects.create())
+            transaction = transactions[0]
+            transactions.update(letter=Letter.objects.create(account_id=transaction.account_id,
+                                                             thirdparty_id=transaction.thirdparty_id))
         return HttpResponseRedirect(request.get_full_path())
 
 
@@ -264,11 +325,11 @@ class ReconciliationView(YearMixin, ReadMixin, DetailView):
             cond = Q()
         else:
             cond = Q(reconciliation__gt=previous.date)
-        transactions = Transaction.objects.filter(account__number=5120000)
+        transactions = Transaction.objects.of_role(Account.BANK)
         cond = cond & Q(reconciliation__lte=self.object.date) | \
             Q(reconciliation=None, entry__date__lte=self.object.date)
         transactions = transactions.filter(cond)
-        transactions = transactions.order_by('reconciliation', 'entry__date')
+        transactions = transactions.select_related('entry__year').order_by('reconciliation', 'entry__date')
         context['transactions'] = transactions
         return context
 
@@ -283,15 +344,15 @@ class NextReconciliationView(YearMixin, ReadMixin, ListView):
             cond = Q()
         else:
             cond = Q(reconciliation__gt=last.date)
-        qs = Transaction.objects.filter(account__number=5120000)
+        qs = Transaction.objects.of_role(Account.BANK)
         cond = cond & Q(reconciliation__lte=date.today()) | Q(reconciliation=None)
         qs = qs.filter(cond)
-        qs = qs.order_by('reconciliation', 'entry__date')
+        qs = qs.select_related('entry__year').order_by('reconciliation', 'entry__date')
         return qs
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        transactions = Transaction.objects.filter(account__number='5120000', reconciliation__lte=date.today())
+        transactions = Transaction.objects.of_role(Account.BANK).filter(reconciliation__lte=date.today())
         sums = transactions.aggregate(expense=Sum('expense'), revenue=Sum('revenue'))
         context['balance'] = sums['expense'] - sums['revenue']
         return context
@@ -345,27 +406,40 @@ class CashFlowView(YearMixin, ReadMixin, TemplateView):
 
 class CashFlowJsonView(YearMixin, ReadMixin, View):
     def serie(self, year):
-        self.today = (settings.NOW() - timedelta(days=1)).date()
         start = year.start
         end = min(year.end, self.today)
-        qs = Transaction.objects.filter(account__number__in=('5120000', '5300000'))
-        qs = qs.filter(reconciliation__gte=start, reconciliation__lte=end)
-        qs = qs.order_by('-reconciliation').values('reconciliation').annotate(balance=Sum('revenue') - Sum('expense'))
-        qs = list(qs)
+        movements = dict(CashFlowBalance.objects.filter(date__range=(start, end)).values_list('date', 'balance'))
         data = OrderedDict()
-        dates = [start + timedelta(days=n) for n in
-                 range((end - start).days + 1)]
         balance = 0
-        for d in dates:
-            if qs and qs[-1]['reconciliation'] == d:
-                balance += qs.pop()['balance']
+        for n in range((end - start).days + 1):
+            d = start + timedelta(days=n)
+            balance += movements.get(d, 0)
             if d.month == 2 and d.day == 29:
                 continue
             data[d] = -balance
         return data
 
     def get(self, request):
+        self.today = (settings.NOW() - timedelta(days=1)).date()
         reference = Year.objects.filter(start__lt=self.year.start).last()
+        # The series only change with the stored rows of both years and the current day
+        state = CashFlowBalance.objects.filter(
+            Q(date__range=(self.year.start, self.year.end)) | Q(date__range=(reference.start, reference.end))
+        ).aggregate(count=Count('id'), modified=Max('modified'))
+        etag = quote_etag('{}-{}-{}-{}-{}'.format(
+            self.year.pk, reference.pk, self.today, state['count'], state['modified'] and state['modified'].timestamp()
+        ))
+        last_modified = state['modified'] and int(state['modified'].timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = self.render(reference)
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def render(self, reference):
         data = self.serie(self.year)
         ref_data = self.serie(reference)
         date_max = max(data.keys())
@@ -400,87 +474,197 @@ class TransferOrderDownloadView(YearMixin, ReadMixin, DetailView):
     model = Expenditure
 
     def render_to_response(self, context, **response_kwargs):
-        assert self.object.method == 5
+        if self.object.method != 5:
+            raise Http404("Cette dépense n'est pas un virement")
         try:
             content = self.object.sepa()
-        except Exception as e:
-            return HttpResponse(str(e), status=500)
+        except ValueError as e:
+            messages.error(self.request, str(e))
+            return HttpResponseRedirect(reverse('accounting:expenditure_detail', args=[self.year.pk, self.object.pk]))
         filename = 'Virements_Becours_{}.xml'.format(self.object.date.strftime('%d-%m-%Y'))
         response = HttpResponse(content, content_type='application/xml')
         response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
         return response
 
 
-class ThirdPartyCsvView(YearMixin, ReadMixin, ListView):
-    model = ThirdParty
-    fields = ('number', 'title', 'type', 'account_number', 'iban', 'bic')
+class TransferOrderBatchView(YearMixin, ReadMixin, View):
+    "Single transfer order of the unpaid transfers of the year, optionally between start and end dates"
+    def get(self, request, *args, **kwargs):
+        expenditures = Expenditure.objects.filter(year=self.year).unpaid_transfers()
+        start = parse_date(request.GET.get('start') or '')
+        end = parse_date(request.GET.get('end') or '')
+        if start:
+            expenditures = expenditures.filter(date__gte=start)
+        if end:
+            expenditures = expenditures.filter(date__lte=end)
+        try:
+            content = expenditures.sepa()
+        except ValueError as e:
+            messages.error(request, str(e))
+            return HttpResponseRedirect(reverse('accounting:expenditure_list', args=[self.year.pk]))
+        filename = 'Virements_Becours_{}.xml'.format(date.today().strftime('%d-%m-%Y'))
+        response = HttpResponse(content, content_type='application/xml')
+        response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+        return response
+
+
+class Echo:
+    "Pseudo-buffer handing back the lines written by the csv writer"
+    def write(self, value):
+        return value
+
+
+class CsvExportMixin:
+    """
+    Stream the queryset as a csv file, in constant memory.
+
+    `columns` is a sequence of (header, lookups, format): the values of the
+    lookups are fetched with values_list() and passed to format, if any.
+    """
+    columns = ()
+    delimiter = ';'
+    quoting = QUOTE_NONNUMERIC
+    quotechar = '"'
+    chunk_size = 2000
+
+    def get_filename(self):
+        raise NotImplementedError
+
+    def compile_columns(self):
+        "Flat list of lookups and the extractor of each column from a values_list() row"
+        lookups = []
+        extractors = []
+        for header, fields, format in self.columns:
+            if isinstance(fields, str):
+                fields = (fields, )
+            start, end = len(lookups), len(lookups) + len(fields)
+            lookups += fields
+            if format is None:
+                extractors.append(itemgetter(start))
+            else:
+                extractors.append(lambda row, format=format, start=start, end=end: format(*row[start:end]))
+        return lookups, extractors
+
+    def get_rows(self):
+        lookups, extractors = self.compile_columns()
+        csv = writer(Echo(), delimiter=self.delimiter, quoting=self.quoting, quotechar=self.quotechar)
+        yield csv.writerow([header for header, fields, format in self.columns])
+        for row in self.get_queryset().values_list(*lookups).iterator(chunk_size=self.chunk_size):
+            yield csv.writerow([extractor(row) for extractor in extractors])
 
     def render_to_response(self, context):
-        response = HttpResponse(content_type='application/force-download')
-        response['Content-Disposition'] = 'attachment; filename=tiers_becours_{}_le_{}.txt'.format(
-            self.year, now().strftime('%d_%m_%Y_a_%Hh%M')
-        )
-        writer = DictWriter(response, self.fields, delimiter=';', quoting=QUOTE_NONNUMERIC)
-        writer.writeheader()
-        for obj in self.object_list:
-            writer.writerow({field: getattr(obj, field) for field in self.fields})
+        response = StreamingHttpResponse(self.get_rows(), content_type='application/force-download')
+        response['Content-Disposition'] = 'attachment; filename={}'.format(self.get_filename())
         return response
 
 
-class EntryCsvView(YearMixin, ReadMixin, ListView):
-    fields = (
-        'journal_number', 'date_dmy', 'account_number', 'entry_id',
-        'thirdparty_number', '__str__', 'expense', 'revenue'
+class ThirdPartyCsvView(YearMixin, ReadMixin, CsvExportMixin, ListView):
+    columns = (
+        ('number', 'number', None),
+        ('title', 'title', None),
+        ('type', 'type', None),
+        ('account_number', 'account__number', None),
+        ('iban', 'iban', None),
+        ('bic', 'bic', None),
+    )
+
+    def get_queryset(self):
+        return ThirdParty.objects.order_by('number')
+
+    def get_filename(self):
+        return 'tiers_becours_{}_le_{}.txt'.format(self.year, now().strftime('%d_%m_%Y_a_%Hh%M'))
+
+
+class EntryCsvView(YearMixin, ReadMixin, CsvExportMixin, ListView):
+    columns = (
+        ('journal_number', 'entry__journal__number', None),
+        ('date_dmy', 'entry__date', lambda date: date.strftime('%d%m%y')),
+        ('account_number', 'account__number', None),
+        ('entry_id', 'entry_id', None),
+        ('thirdparty_number', 'thirdparty__number', None),
+        ('__str__', ('title', 'entry__title'), lambda title, entry_title: title or entry_title),
+        ('expense', 'expense', None),
+        ('revenue', 'revenue', None),
     )
 
     def get_queryset(self):
         return Transaction.objects \
             .filter(entry__year=self.year, entry__exported=False) \
-            .order_by('entry__id', 'id') \
-            .select_related('entry', 'entry__journal', 'account', 'thirdparty')
-
-    def render_to_response(self, context):
-        response = HttpResponse(content_type='application/force-download')
-        response['Content-Disposition'] = 'attachment; filename=ecritures_becours_{}_le_{}.txt'.format(
-            self.year, now().strftime('%d_%m_%Y_a_%Hh%M')
-        )
-        writer = DictWriter(response, self.fields, delimiter=';', quoting=QUOTE_NONNUMERIC)
-        writer.writeheader()
+            .order_by('entry__id', 'id')
+
+    def get_filename(self):
+        return 'ecritures_becours_{}_le_{}.txt'.format(self.year, now().strftime('%d_%m_%Y_a_%Hh%M'))
+
+
+def fec_date(date):
+    return date and date.strftime('%Y%m%d') or ''
+
+
+def fec_amount(amount):
+    return '{:.2f}'.format(amount).replace('.', ',')
+
+
+def fec_text(text):
+    "Text without the tabs and line breaks the unquoted FEC format cannot hold"
+    return ' '.join((text or '').replace('\t', ' ').splitlines())
+
+
+class FecView(YearMixin, ReadMixin, CsvExportMixin, ListView):
+    "Fichier des Écritures Comptables (article A47 A-1 du livre des procédures fiscales)"
+    columns = (
+        ('JournalCode', 'entry__journal__number', None),
+        ('JournalLib', 'entry__journal__title', fec_text),
+        ('EcritureNum', 'entry_id', None),
+        ('EcritureDate', 'entry__date', fec_date),
+        ('CompteNum', 'account__number', None),
+        ('CompteLib', 'account__title', fec_text),
+        ('CompAuxNum', 'thirdparty__number', lambda number: number or ''),
+        ('CompAuxLib', 'thirdparty__title', fec_text),
+        ('PieceRef', 'entry_id', None),
+        ('PieceDate', 'entry__date', fec_date),
+        ('EcritureLib', ('title', 'entry__title'), lambda title, entry_title: fec_text(title or entry_title)),
+        ('Debit', 'expense', fec_amount),
+        ('Credit', 'revenue', fec_amount),
+        ('EcritureLet', 'letter__code', lambda code: code or ''),
+        ('DateLet', 'letter__date', fec_date),
+        ('ValidDate', 'entry__date', fec_date),
+        # Amounts are all in euros
+        ('Montantdevise', (), lambda: ''),
+        ('Idevise', (), lambda: ''),
+    )
+    delimiter = '\t'
+    quoting = QUOTE_NONE
+    quotechar = None
 
-        def get_value(obj, field):
-            value = getattr(obj, field)
-            if callable(value):
-                value = value()
-            return value
+    def get_queryset(self):
+        return Transaction.objects.filter(entry__year=self.year).order_by('entry__date', 'entry__id', 'id')
 
-        for obj in self.object_list:
-            writer.writerow({field: get_value(obj, field) for field in self.fields})
-        return response
+    def get_filename(self):
+        return '{}FEC{}.txt'.format(getattr(settings, 'SIREN', ''), fec_date(self.year.end))
 
 
 class ChecksView(YearMixin, ReadMixin, TemplateView):
     template_name = 'accounting/checks.html'
 
+    def post(self, request, *args, **kwargs):
+        "Refresh the check results, see also the run_checks command"
+        if not request.user.is_becours_treasurer:
+            return self.handle_no_permission()
+        run_checks(self.year)
+        return HttpResponseRedirect(request.get_full_path())
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        transactions = Transaction.objects.filter(entry__year=self.year)
-        context['missing_analytic'] = transactions.filter(account__number__regex=r'^[67]', analytic__isnull=True)
-        context['extra_analytic'] = transactions.filter(account__number__regex=r'^[^67]', analytic__isnull=False)
-        context['missing_thirdparty'] = transactions.filter(account__number__regex=r'^[4]', thirdparty__isnull=True)
-        context['extra_thirdparty'] = transactions.filter(account__number__regex=r'^[^4]', thirdparty__isnull=False)
-        context['unbalanced_letters'] = Letter.objects.annotate(
-            balance=Sum('transaction__revenue') - Sum('transaction__expense'),
-            account_min=Min(Coalesce('transaction__account_id', 0)),
-            account_max=Max(Coalesce('transaction__account_id', 0)),
-            thirdparty_min=Min(Coalesce('transaction__thirdparty_id', 0)),
-            thirdparty_max=Max(Coalesce('transaction__thirdparty_id', 0)),
-        ).exclude(
-            balance=0,
-            account_min=F('account_max'),
-            thirdparty_min=F('thirdparty_max')
-        )
-        context['pure_entries'] = Entry.objects.filter(year=self.year) \
-            .filter(purchase__id=None, sale__id=None, income__id=None, expenditure__id=None, cashing__id=None)
+        results = CheckResult.objects.filter(year=self.year).select_related(
+            'entry', 'transaction__entry', 'transaction__account', 'transaction__thirdparty',
+            'transaction__analytic', 'transaction__letter', 'letter',
+        ).prefetch_related(Prefetch('letter__transaction_set', queryset=Transaction.objects.select_related(
+            'entry', 'account', 'thirdparty', 'analytic', 'letter',
+        ))).order_by('pk')
+        by_check = {}
+        for result in results:
+            by_check.setdefault(result.check, []).append(result)
+        context['checks'] = [(check, by_check.get(check.code, [])) for check in CHECKS]
         return context
 
 
@@ -491,6 +675,8 @@ class EntryToPurchaseView(YearMixin, WriteMixin, DetailView):
         entry = self.get_object()
         purchase = Purchase(entry_ptr=entry)
         purchase.__dict__.update(entry.__dict__)
+        # The entry row exists, the purchase one is inserted
+        purchase._state.adding = True
         purchase.save()
         return HttpResponseRedirect(reverse('accounting:purchase_detail', args=[self.year.pk, entry.pk]))
 
@@ -502,6 +688,7 @@ class EntryToSaleView(YearMixin, WriteMixin, DetailView):
         entry = self.get_object()
         sale = Sale(entry_ptr=entry)
         sale.__dict__.update(entry.__dict__)
+        sale._state.adding = True
         sale.save()
         return HttpResponseRedirect(reverse('accounting:sale_detail', args=[self.year.pk, entry.pk]))
 
@@ -513,6 +700,7 @@ class EntryToIncomeView(YearMixin, WriteMixin, DetailView):
         entry = self.get_object()
         income = Income(entry_ptr=entry)
         income.__dict__.update(entry.__dict__)
+        income._state.adding = True
         income.save()
         return HttpResponseRedirect(reverse('accounting:income_detail', args=[self.year.pk, entry.pk]))
 
@@ -524,6 +712,7 @@ class EntryToExpenditureView(YearMixin, WriteMixin, DetailView):
         entry = self.get_object()
         expenditure = Expenditure(entry_ptr=entry)
         expenditure.__dict__.update(entry.__dict__)
+        expenditure._state.adding = True
         expenditure.method = 5
         expenditure.save()
         return HttpResponseRedirect(reverse('accounting:expenditure_detail', args=[self.year.pk, entry.pk]))
@@ -553,10 +742,8 @@ class PurchaseDetailView(YearMixin, ReadMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['revenue'] = self.object.transaction_set.get(account__number__startswith='4')
-        expenses = self.object.transaction_set.filter(
-            Q(account__number__startswith='6') | Q(account__number__startswith='21')
-        ).order_by('account__number', 'analytic__title')
+        context['revenue'] = self.object.transaction_set.of_class(4).get()
+        expenses = self.object.transaction_set.of_class(6, 21).order_by('account__number', 'analytic__title')
         context['expenses'] = expenses
         return context
 
@@ -647,7 +834,7 @@ class SaleDetailView(YearMixin, ReadMixin, DetailView):
         try:
             context['client_transaction'] = self.object.transaction_set \
                 .exclude(account__number='4190000') \
-                .get(account__number__startswith='4')
+                .of_class(4).get()
         except Transaction.DoesNotExist:
             pass
         else:
@@ -660,7 +847,7 @@ class SaleDetailView(YearMixin, ReadMixin, DetailView):
         else:
             context['amount'] += context['deposit_transaction'].expense
             context['thirdparty'] = context['deposit_transaction'].thirdparty
-        profit_transactions = self.object.transaction_set.filter(account__number__startswith='7') \
+        profit_transactions = self.object.transaction_set.of_class(7) \
             .order_by('account__number', 'analytic__title')
         context['profit_transactions'] = profit_transactions
         return context
@@ -744,7 +931,7 @@ class IncomeDetailView(YearMixin, ReadMixin, DetailView):
     context_object_name = 'income'
 
     def get_queryset(self):
-        return Income.objects.filter(year=self.year)
+        return Income.objects.filter(year=self.year).with_roles()
 
 
 class IncomeCreateView(YearMixin, WriteMixin, CreateView):
@@ -765,7 +952,7 @@ class IncomeUpdateView(YearMixin, WriteMixin, UpdateView):
     form_class = IncomeForm
 
     def get_queryset(self):
-        return Income.objects.filter(year=self.year)
+        return Income.objects.filter(year=self.year).with_roles()
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
@@ -803,7 +990,7 @@ class ExpenditureDetailView(YearMixin, ReadMixin, DetailView):
     context_object_name = 'expenditure'
 
     def get_queryset(self):
-        return Expenditure.objects.filter(year=self.year)
+        return Expenditure.objects.filter(year=self.year).with_roles()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -839,7 +1026,7 @@ class ExpenditureUpdateView(YearMixin, WriteMixin, UpdateView):
     form_class = ExpenditureForm
 
     def get_queryset(self):
-        return Expenditure.objects.filter(year=self.year)
+        return Expenditure.objects.filter(year=self.year).with_roles()
 
     def get_context_data(self, **kwargs):
         if 'form' not in kwargs:
@@ -891,7 +1078,7 @@ class CashingDetailView(YearMixin, ReadMixin, DetailView):
     context_object_name = 'cashing'
 
     def get_queryset(self):
-        return Cashing.objects.filter(year=self.year)
+        return Cashing.objects.filter(year=self.year).with_roles()
 
 
 class CashingCreateView(YearMixin, WriteMixin, CreateView):
@@ -912,7 +1099,7 @@ class CashingUpdateView(YearMixin, WriteMixin, UpdateView):
     form_class = CashingForm
 
     def get_queryset(self):
-        return Cashing.objects.filter(year=self.year)
+        return Cashing.objects.filter(year=self.year).with_roles()
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
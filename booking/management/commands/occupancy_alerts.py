@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.formats import date_format
+from ...models import BookingItem
+from ...occupancy import Occupancy, capacities
+
+
+class Command(BaseCommand):
+    help = "List the coming nights where the confirmed and potential bookings exceed the BOOKING_CAPACITY setting"
+
+    def handle(self, *args, **options):
+        if not capacities():
+            self.stderr.write("BOOKING_CAPACITY is not set")
+            return
+        today = settings.NOW().date()
+        items = BookingItem.objects.filter(booking__state__income__in=(1, 2, 3), end__gt=today)
+        products = dict(BookingItem.PRODUCT_CHOICES)
+        for day, product, headcount in Occupancy(items, products=tuple(capacities())).alerts():
+            if day >= today:
+                self.stdout.write("{} : {} personnes en {} pour {} places".format(
+                    date_format(day), headcount, products[product], capacities()[product],
+                ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from ...models import Booking
+
+
+class Command(BaseCommand):
+    help = "Recompute the begin, end, headcount, overnights, amount and deposit stored on the bookings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('booking_pk', nargs='*')
+        parser.add_argument('--check', action='store_true',
+                            help="List the stored values differing from the items instead of recomputing them")
+
+    def handle(self, *args, **options):
+        bookings = Booking.objects.all()
+        if options['booking_pk']:
+            bookings = bookings.filter(pk__in=options['booking_pk'])
+        if options['check']:
+            inconsistencies = bookings.inconsistencies()
+            for pk, name, stored, computed in inconsistencies:
+                self.stdout.write("Booking {} {}: {} stored, {} computed".format(pk, name, stored, computed))
+            self.stdout.write("{} inconsistencies".format(len(inconsistencies)))
+        else:
+            self.stdout.write("{} bookings refreshed".format(bookings.refresh_aggregates()))
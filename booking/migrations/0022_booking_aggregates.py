@@ -0,0 +1,81 @@
+# Generated by Django 2.2.13 on 2026-10-18 11:28
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+def item_amount(item, nights, overnights):
+    "Copy of the amount annotation of BookingItemManager at the time of the migration"
+    amount = item.price or 0
+    if overnights is not None and item.price_pppn is not None:
+        amount += overnights * item.price_pppn
+    if item.headcount is not None and item.price_pp is not None:
+        amount += item.headcount * item.price_pp
+    if nights is not None and item.price_pn is not None:
+        amount += nights * item.price_pn
+    if item.cotisation and overnights is not None:
+        amount += overnights
+    return amount
+
+
+def fill_aggregates(apps, schema_editor):
+    Booking = apps.get_model('booking', 'Booking')
+    bookings = list(Booking.objects.prefetch_related('items'))
+    for booking in bookings:
+        items = list(booking.items.all())
+        booking.begin = min((item.begin for item in items if item.begin), default=None)
+        booking.end = max((item.end for item in items if item.end), default=None)
+        headcounts = [item.headcount for item in items if item.headcount is not None]
+        booking.headcount = sum(headcounts) if headcounts else None
+        booking.overnights = None
+        booking.amount = Decimal(0)
+        for item in items:
+            nights = (item.end - item.begin).days if item.begin and item.end else None
+            overnights = nights * item.headcount if nights is not None and item.headcount is not None else None
+            if overnights is not None:
+                booking.overnights = (booking.overnights or 0) + overnights
+            booking.amount += item_amount(item, nights, overnights)
+        booking.deposit = (booking.amount * Decimal('.3')).quantize(Decimal('.01'))
+    Booking.objects.bulk_update(bookings, ('begin', 'end', 'headcount', 'overnights', 'amount', 'deposit'),
+                                batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0021_auto_20190725_1217'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=8, verbose_name='Montant'),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='begin',
+            field=models.DateField(db_index=True, editable=False, null=True, verbose_name='Début'),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='deposit',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=8, verbose_name='Acompte'),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='end',
+            field=models.DateField(db_index=True, editable=False, null=True, verbose_name='Fin'),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='headcount',
+            field=models.PositiveIntegerField(editable=False, null=True, verbose_name='Effectif'),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='overnights',
+            field=models.PositiveIntegerField(editable=False, null=True, verbose_name='Nuitées'),
+        ),
+        migrations.RunPython(fill_aggregates, migrations.RunPython.noop),
+    ]
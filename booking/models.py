@@ -1,8 +1,9 @@
 from datetime import timedelta
+from functools import partial
 from cuser.middleware import CuserMiddleware
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Case, ExpressionWrapper, F, Min, Max, Sum, When, Value
+from django.db import connections, models, router, transaction
+from django.db.models import Case, ExpressionWrapper, F, Min, Max, OuterRef, Subquery, Sum, When, Value
 from django.db.models.functions import Cast, Coalesce, ExtractDay, Concat
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -43,37 +44,157 @@ class TrackingValue(models.Model):
         verbose_name = "Valeur"
 
 
+def write_tracking(records, using):
+    "Bulk create the events and values of (TrackingEvent, [(field, value)]) records"
+    if not records:
+        return
+    events = [event for event, values in records]
+    if connections[using].features.can_return_ids_from_bulk_insert:
+        TrackingEvent.objects.using(using).bulk_create(events)
+    else:
+        for event in events:
+            event.save(using=using)
+    TrackingValue.objects.using(using).bulk_create([
+        TrackingValue(event=event, field=field, value=value) for event, values in records for field, value in values
+    ])
+
+
+def tracking_record(model, operation, pk, values):
+    "(TrackingEvent, [(field, value)]) record of an operation on the object pk of model, by the current user"
+    event = TrackingEvent(operation=operation, user=CuserMiddleware.get_user(), date=now(),
+                          obj_ct=ContentType.objects.get_for_model(model), obj_pk=pk)
+    return event, values
+
+
+def track(records, using):
+    """
+    Write the records of one operation in bulk when the transaction commits, right away outside of a transaction.
+
+    The records are registered as a single on_commit() callback, which is dropped with a rolled back savepoint.
+    """
+    if not records:
+        return
+    if not transaction.get_connection(using).in_atomic_block:
+        write_tracking(records, using)
+        return
+    transaction.on_commit(partial(write_tracking, records, using), using)
+
+
+class TrackingQuerySet(models.QuerySet):
+    "Track the changes made by update(), bulk_create() and delete(), which bypass the model methods"
+    def update(self, **kwargs):
+        fields = [field for field in self.model.tracked_fields() if field.name in kwargs or field.attname in kwargs]
+        if not fields:
+            return super().update(**kwargs)
+        before = {
+            row['pk']: {field.attname: field.to_python(row[field.attname]) for field in fields}
+            for row in self.values('pk', *[field.attname for field in fields])
+        }
+        rows = super().update(**kwargs)
+        related = [field.name for field in fields if field.is_relation]
+        objs = self.model._default_manager.using(self.db).filter(pk__in=list(before)).select_related(*related)
+        records = []
+        for obj in objs:
+            values = obj.tracking_changes(before[obj.pk], fields)
+            if values:
+                records.append(tracking_record(self.model, TrackingEvent.CHANGE, obj.pk, values))
+        track(records, self.db)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        records = []
+        for obj in objs:
+            # Databases not returning the ids of bulk inserts leave the objects without pk
+            if obj.pk is not None:
+                records.append(tracking_record(self.model, TrackingEvent.ADD, obj.pk, obj.tracking_changes()))
+                obj._tracked = obj.tracking_values()
+        track(records, self.db)
+        return objs
+
+    def delete(self):
+        track([tracking_record(self.model, TrackingEvent.DELETE, pk, []) for pk in self.values_list('pk', flat=True)],
+              self.db)
+        return super().delete()
+
+
 class TrackingMixin(object):
+    """
+    Log the additions, changes and deletions of the model as TrackingEvents.
+
+    Changes are found by comparing the values to a snapshot taken when the instance is loaded, and are written in
+    bulk when the transaction commits. The manager should be built on TrackingQuerySet to track its bulk methods too.
+    """
+    @classmethod
+    def tracked_fields(cls):
+        "Fields edited by the users, the stored aggregates being left out"
+        return [field for field in cls._meta.concrete_fields if not field.primary_key and field.editable]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._tracked = instance.tracking_values()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._tracked = self.tracking_values()
+
+    def tracking_values(self):
+        "Loaded values of the tracked fields by attname, converted to their python type"
+        return {
+            field.attname: field.to_python(self.__dict__[field.attname])
+            for field in self.tracked_fields() if field.attname in self.__dict__
+        }
+
+    def tracking_changes(self, stored=None, fields=None):
+        """
+        [(field, value)] of the fields whose value differs from the stored one.
+
+        Without stored values, the instance being new, the fields which have a value.
+        """
+        changes = []
+        for field in fields or self.tracked_fields():
+            value = getattr(self, field.attname)
+            if stored is None:
+                if value is None or value == "":
+                    continue
+            elif field.to_python(value) == stored[field.attname]:
+                continue
+            changes.append((field.name, str(getattr(self, field.name))))
+        return changes
+
+    def stored_tracking_values(self, using):
+        "Values of the tracked fields in the database, from the load snapshot if complete, None if not saved yet"
+        if self.pk is None:
+            return None
+        stored = getattr(self, '_tracked', {})
+        if len(stored) == len(self.tracked_fields()):
+            return stored
+        values = self.__class__._base_manager.using(using).filter(pk=self.pk)
+        values = values.values(*[field.attname for field in self.tracked_fields()]).first()
+        if values is None:
+            return None
+        return {field.attname: field.to_python(values[field.attname]) for field in self.tracked_fields()}
+
     def save(self, *args, **kwargs):
-        change = bool(self.pk)
-        if change:
-            old = self.__class__.objects.get(pk=self.pk)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        stored = self.stored_tracking_values(using)
         super().save(*args, **kwargs)
-        event = TrackingEvent.objects.create(
-            operation=TrackingEvent.CHANGE if self.pk else TrackingEvent.ADD,
-            user=CuserMiddleware.get_user(),
-            date=now(),
-            obj=self,
-        )
-        for field in self._meta.fields:
-            if field.name == 'id':
-                continue
-            value = getattr(self, field.name)
-            if not change and value is not None and value != "" or change and value != getattr(old, field.name):
-                TrackingValue.objects.create(
-                    event=event,
-                    field=field.name,
-                    value=str(value)
-                )
+        fields = self.tracked_fields()
+        if stored is not None and kwargs.get('update_fields') is not None:
+            update_fields = set(kwargs['update_fields'])
+            fields = [field for field in fields if field.name in update_fields or field.attname in update_fields]
+        values = self.tracking_changes(stored, fields)
+        if stored is None or values:
+            operation = TrackingEvent.ADD if stored is None else TrackingEvent.CHANGE
+            track([tracking_record(self.__class__, operation, self.pk, values)], using)
+        self._tracked = self.tracking_values()
 
     def delete(self, *args, **kwargs):
-        TrackingEvent.objects.create(
-            operation=TrackingEvent.DELETE,
-            user=CuserMiddleware.get_user(),
-            date=now(),
-            obj=self,
-        )
-        super().delete(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        track([tracking_record(self.__class__, TrackingEvent.DELETE, self.pk, [])], using)
+        return super().delete(*args, **kwargs)
 
 
 class Agreement(TrackingMixin, models.Model):
@@ -84,6 +205,8 @@ class Agreement(TrackingMixin, models.Model):
     booking = models.ForeignKey('Booking', verbose_name="Réservation", related_name='agreements',
                                 on_delete=models.PROTECT)
 
+    objects = TrackingQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Convention"
         get_latest_by = 'date'
@@ -122,6 +245,8 @@ class BookingState(TrackingMixin, models.Model):
     income = models.IntegerField(verbose_name="Chiffre d'affaire", choices=INCOME_CHOICES)
     color = models.CharField(verbose_name="Couleur", max_length=10, choices=COLOR_CHOICES)
 
+    objects = TrackingQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Statut"
         ordering = ('title',)
@@ -130,40 +255,71 @@ class BookingState(TrackingMixin, models.Model):
         return self.title
 
 
-class BookingManager(models.Manager):
-    def get_queryset(self):
-        qs = super().get_queryset()
-        qs = qs.annotate(begin=Min('items__begin'), end=Max('items__end'))
-        qs = qs.annotate(nights=ExtractDay(F('end') - F('begin')))
-        qs = qs.annotate(headcount=Sum('items__headcount'))
-        overnights = ExtractDay(F('items__end') - F('items__begin')) * F('items__headcount')
-        qs = qs.annotate(overnights=ExpressionWrapper(Sum(overnights), output_field=models.DecimalField()))
-        qs = qs.annotate(price=Coalesce(Sum('items__price'), 0))
-        amount_pppn = ExtractDay(F('items__end') - F('items__begin')) * F('items__headcount') * F('items__price_pppn')
-        qs = qs.annotate(amount_pppn=ExpressionWrapper(Coalesce(Sum(amount_pppn), 0),
-                                                       output_field=models.DecimalField()))
-        amount_pp = F('items__headcount') * F('items__price_pp')
-        qs = qs.annotate(amount_pp=ExpressionWrapper(Coalesce(Sum(amount_pp), 0), output_field=models.DecimalField()))
-        amount_pn = ExtractDay(F('items__end') - F('items__begin')) * F('items__price_pn')
-        qs = qs.annotate(amount_pn=ExpressionWrapper(Coalesce(Sum(amount_pn), 0), output_field=models.DecimalField()))
-        sub_amount_cot = ExpressionWrapper(ExtractDay(F('items__end') - F('items__begin')) * F('items__headcount'),
-                                           output_field=models.DecimalField())
-        amount_cot = Case(When(items__cotisation=True, then=sub_amount_cot))
-        qs = qs.annotate(amount_cot=ExpressionWrapper(Coalesce(Sum(amount_cot), 0), output_field=models.DecimalField()))
-        qs = qs.annotate(amount=Cast(F('price') + F('amount_pppn') + F('amount_pp') + F('amount_pn') + F('amount_cot'),
-                                     output_field=models.DecimalField(max_digits=8, decimal_places=2)))
-        qs = qs.annotate(deposit=Cast(F('amount') * .3,
-                                      output_field=models.DecimalField(max_digits=8, decimal_places=2)))
-        return qs
+def booking_aggregates():
+    "Expressions computing the stored aggregates of a booking from its items"
+    items = BookingItem.objects.filter(booking=OuterRef('pk')).order_by().values('booking')
+
+    def aggregate(function, field, output_field=None):
+        return Subquery(items.annotate(value=function(field)).values('value'), output_field=output_field)
+
+    amount = Cast(Coalesce(aggregate(Sum, 'amount'), 0),
+                  output_field=models.DecimalField(max_digits=8, decimal_places=2))
+    return {
+        'begin': aggregate(Min, 'begin'),
+        'end': aggregate(Max, 'end'),
+        'headcount': aggregate(Sum, 'headcount'),
+        'overnights': aggregate(Sum, 'overnights', models.IntegerField()),
+        'amount': amount,
+        'deposit': Cast(amount * .3, output_field=models.DecimalField(max_digits=8, decimal_places=2)),
+    }
 
 
-class BookingQuerySet(models.QuerySet):
+class BookingQuerySet(TrackingQuerySet):
     def for_user(self, user):
         if user.is_superuser:
             return self
         return self.filter(structure__nomination__adhesion__person=user,
                            structure__nomination__adhesion__season=current_season())
 
+    def with_financials(self):
+        "Annotate the paid amount, the amount due and the pk, order and pdf of the latest agreement"
+        payments = Payment.objects.filter(booking=OuterRef('pk')).order_by().values('booking')
+        payments = payments.annotate(total=Sum('amount')).values('total')
+        agreements = Agreement.objects.filter(booking=OuterRef('pk')).order_by('-date', 'order')
+        return self.annotate(
+            paid=Coalesce(Subquery(payments, output_field=models.DecimalField(max_digits=8, decimal_places=2)), 0),
+            due=ExpressionWrapper(F('amount') - F('paid'), output_field=models.DecimalField()),
+            agreement_pk=Subquery(agreements.values('pk')[:1]),
+            agreement_order=Subquery(agreements.values('order')[:1]),
+            agreement_pdf=Subquery(agreements.values('pdf')[:1]),
+        )
+
+    def financial_totals(self):
+        "Sums of the headcount, overnights, amount and amount due of bookings annotated by with_financials()"
+        totals = self.aggregate(
+            headcount=Sum('headcount'),
+            overnights=Sum('overnights'),
+            amount=Sum('amount'),
+            balance=Sum('due'),
+        )
+        return {name: total or 0 for name, total in totals.items()}
+
+    def refresh_aggregates(self):
+        "Recompute the stored aggregates of the bookings from their items, in one statement"
+        return self.update(**booking_aggregates())
+
+    def inconsistencies(self):
+        "(booking pk, field, stored value, computed value) of the stored aggregates differing from their items"
+        aggregates = booking_aggregates()
+        rows = self.annotate(**{'computed_' + name: expression for name, expression in aggregates.items()})
+        rows = rows.order_by('pk').values_list('pk', *aggregates, *('computed_' + name for name in aggregates))
+        return [
+            (row[0], name, stored, computed)
+            for row in rows
+            for name, stored, computed in zip(aggregates, row[1:], row[1 + len(aggregates):])
+            if stored != Booking.normalize(name, computed)
+        ]
+
 
 class Booking(TrackingMixin, models.Model):
     ORG_TYPE_CHOICES = (
@@ -192,8 +348,17 @@ class Booking(TrackingMixin, models.Model):
     structure = models.ForeignKey(Structure, verbose_name="Structure", on_delete=models.PROTECT)
     preferred_place = models.CharField(verbose_name="Placement souhaité", max_length=1024, blank=True)
     wood = models.CharField(verbose_name="Bois", max_length=1024, blank=True)
+    # Aggregates of the items, see booking_aggregates()
+    begin = models.DateField(verbose_name="Début", null=True, editable=False, db_index=True)
+    end = models.DateField(verbose_name="Fin", null=True, editable=False, db_index=True)
+    headcount = models.PositiveIntegerField(verbose_name="Effectif", null=True, editable=False)
+    overnights = models.PositiveIntegerField(verbose_name="Nuitées", null=True, editable=False)
+    amount = models.DecimalField(verbose_name="Montant", max_digits=8, decimal_places=2, default=0, editable=False)
+    deposit = models.DecimalField(verbose_name="Acompte", max_digits=8, decimal_places=2, default=0, editable=False)
 
-    objects = BookingManager.from_queryset(BookingQuerySet)()
+    AGGREGATE_FIELDS = ('begin', 'end', 'headcount', 'overnights', 'amount', 'deposit')
+
+    objects = BookingQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Réservation"
@@ -203,9 +368,35 @@ class Booking(TrackingMixin, models.Model):
     def __str__(self):
         return "{} - {}".format(self.year, self.title)
 
+    def save(self, *args, **kwargs):
+        """
+        Save the booking without its aggregates, written by refresh_aggregates() only.
+
+        The aggregates may have been loaded before a change of the items, and must not be written back.
+        """
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.AGGREGATE_FIELDS
+            ]
+        return super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('booking:booking_detail', kwargs={'pk': self.pk})
 
+    @classmethod
+    def normalize(cls, name, value):
+        "Value of a field as it would be stored, databases not all converting subquery results"
+        field = cls._meta.get_field(name)
+        value = field.to_python(value)
+        if value is not None and isinstance(field, models.DecimalField):
+            value = round(value, field.decimal_places)
+        return value
+
+    @property
+    def nights(self):
+        return (self.end - self.begin).days if self.begin and self.end else None
+
     @property
     def terrain(self):
         return self.items.filter(product=1).exists()
@@ -216,21 +407,24 @@ class Booking(TrackingMixin, models.Model):
 
     @property
     def agreement(self):
-        agreements = list(self.agreements.all())
-        if not agreements:
-            return None
-        agreements.sort(key=lambda agreement: agreement.date, reverse=True)
-        return agreements[0]
+        "Latest agreement, built from the with_financials() annotations when there are some"
+        if hasattr(self, 'agreement_pk'):
+            if self.agreement_pk is None:
+                return None
+            return Agreement(pk=self.agreement_pk, order=self.agreement_order, pdf=self.agreement_pdf, booking=self)
+        return self.agreements.order_by('-date', 'order').first()
 
     @property
     def payment(self):
-        return sum([payment.amount for payment in self.payments.all()])
+        if hasattr(self, 'paid'):
+            return self.paid
+        return self.payments.aggregate(paid=Coalesce(Sum('amount'), 0))['paid']
 
     @property
     def balance(self):
-        if self.amount is None and self.payment is None:
-            return None
-        return (self.amount or 0) - (self.payment or 0)
+        if hasattr(self, 'due'):
+            return self.due
+        return self.amount - self.payment
 
     @property
     def gone(self):
@@ -276,13 +470,41 @@ class BookingItemManager(models.Manager):
         return qs
 
 
-class BookingItemQuerySet(models.QuerySet):
+class BookingItemQuerySet(TrackingQuerySet):
+    "Refresh the aggregates of the bookings whose items are changed by update(), bulk_create() and delete()"
+    # Fields the booking aggregates are computed from
+    AGGREGATED_FIELDS = {'booking', 'booking_id', 'headcount', 'begin', 'end', 'price_pppn', 'price_pn', 'price_pp',
+                         'price', 'cotisation'}
+
     def for_user(self, user):
         if user.is_superuser:
             return self
         return self.filter(booking__structure__nomination__adhesion__person=user,
                            booking__structure__nomination__adhesion__season=current_season())
 
+    def update(self, **kwargs):
+        if not self.AGGREGATED_FIELDS.intersection(kwargs):
+            return super().update(**kwargs)
+        items = dict(self.values_list('pk', 'booking_id'))
+        rows = super().update(**kwargs)
+        bookings = set(items.values())
+        if 'booking' in kwargs or 'booking_id' in kwargs:
+            # Refresh the bookings the items were moved to as well
+            bookings.update(BookingItem.objects.filter(pk__in=list(items)).values_list('booking_id', flat=True))
+        Booking.objects.filter(pk__in=bookings).refresh_aggregates()
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        Booking.objects.filter(pk__in={obj.booking_id for obj in objs}).refresh_aggregates()
+        return objs
+
+    def delete(self):
+        bookings = set(self.values_list('booking_id', flat=True))
+        result = super().delete()
+        Booking.objects.filter(pk__in=bookings).refresh_aggregates()
+        return result
+
 
 class BookingItem(TrackingMixin, models.Model):
     PRODUCT_CHOICES = (
@@ -309,6 +531,19 @@ class BookingItem(TrackingMixin, models.Model):
     def __str__(self):
         return self.title or self.get_product_display()
 
+    def save(self, *args, **kwargs):
+        "Refresh the aggregates of the booking, and of the former one if the item was moved"
+        bookings = {self.booking_id, getattr(self, '_tracked', {}).get('booking_id')} - {None}
+        result = super().save(*args, **kwargs)
+        Booking.objects.filter(pk__in=bookings).refresh_aggregates()
+        return result
+
+    def delete(self, *args, **kwargs):
+        "Refresh the aggregates of the booking"
+        result = super().delete(*args, **kwargs)
+        Booking.objects.filter(pk=self.booking_id).refresh_aggregates()
+        return result
+
     def clean(self):
         if self.begin.year != self.booking.year:
             raise ValidationError("La réservation doit débuter en {}".format(self.booking.year))
@@ -331,3 +566,5 @@ class Payment(TrackingMixin, models.Model):
     amount = models.DecimalField(verbose_name="Montant", max_digits=8, decimal_places=2)
     booking = models.ForeignKey(Booking, related_name='payments', on_delete=models.CASCADE)
     scan = models.FileField(verbose_name="Scan", upload_to='paiements', blank=True)
+
+    objects = TrackingQuerySet.as_manager()
@@ -0,0 +1,71 @@
+"""
+Occupancy calendar of the booking items.
+
+The items are loaded in a single query, then swept day by day: each item adds
+its headcount to its product and booking on its first night and removes it the
+day it leaves, so that a season costs one query whatever its length.
+"""
+from collections import namedtuple
+from datetime import timedelta
+from django.conf import settings
+
+# Fields of the items the calendar is computed from
+ITEM_FIELDS = ('begin', 'end', 'product', 'headcount', 'booking__title', 'booking__state__color')
+
+# Occupancy of a product for a night, bookings being values() like dicts ordered by title
+ProductOccupancy = namedtuple('ProductOccupancy', ('number', 'headcount', 'bookings'))
+
+
+def capacities():
+    "Maximum headcount by product, from the BOOKING_CAPACITY setting"
+    return getattr(settings, 'BOOKING_CAPACITY', {})
+
+
+class Occupancy:
+    "Nights from the first begin to the last end of the items, with the occupancy of each product"
+    def __init__(self, items, products=(2, 1)):
+        self.products = products
+        rows = [row for row in items.order_by().values_list(*ITEM_FIELDS) if row[0] and row[1]]
+        self.begin = min((row[0] for row in rows), default=None)
+        self.end = max((row[1] for row in rows), default=None)
+        # Headcount and item count variations of each booking by day and product
+        self.changes = {}
+        for begin, end, product, headcount, title, color in rows:
+            if product not in products or headcount is None or begin >= end:
+                continue
+            for day, sign in ((begin, 1), (end, -1)):
+                changes = self.changes.setdefault(day, {}).setdefault(product, {})
+                count, total = changes.get((title, color), (0, 0))
+                changes[(title, color)] = (count + sign, total + sign * headcount)
+
+    def __iter__(self):
+        "(day, {product: ProductOccupancy}) for each night"
+        if self.begin is None:
+            return
+        active = {product: {} for product in self.products}
+        for i in range((self.end - self.begin).days + 1):
+            day = self.begin + timedelta(days=i)
+            for product, changes in self.changes.get(day, {}).items():
+                for key, (count, total) in changes.items():
+                    active_count, active_total = active[product].pop(key, (0, 0))
+                    if count + active_count:
+                        active[product][key] = (count + active_count, total + active_total)
+            yield day, {product: self.product_occupancy(active[product]) for product in self.products}
+
+    @staticmethod
+    def product_occupancy(active):
+        keys = sorted(active, key=lambda key: (key[0], key[1] or ''))
+        bookings = [
+            {'booking__title': title, 'booking__state__color': color, 'headcount': active[(title, color)][1]}
+            for title, color in keys
+        ]
+        return ProductOccupancy(len(bookings), sum(booking['headcount'] for booking in bookings), bookings)
+
+    def alerts(self, capacity=None):
+        "(day, product, headcount) of the nights over capacity, a {product: maximum headcount} dict"
+        capacity = capacities() if capacity is None else capacity
+        return [
+            (day, product, occupancy.headcount)
+            for day, products in self for product, occupancy in products.items()
+            if product in capacity and occupancy.headcount > capacity[product]
+        ]
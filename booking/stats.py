@@ -0,0 +1,86 @@
+"""
+Statistics of the booking items.
+
+The annotated items are fetched in a single values() query and kept as
+columns. Every statistic is then a sum of a column over the rows of a group,
+groups being lists of row indices by product, month, organisation type,
+state or structure.
+"""
+
+# Fields of the annotated items the statistics are computed from
+ITEM_FIELDS = ('product', 'headcount', 'overnights', 'amount', 'amount_cot', 'cotisation', 'begin__month',
+               'booking__org_type', 'booking__state', 'booking__structure')
+
+# Item field of each group-by dimension
+DIMENSIONS = {
+    'product': 'product',
+    'month': 'begin__month',
+    'org_type': 'booking__org_type',
+    'state': 'booking__state',
+    'structure': 'booking__structure',
+}
+
+# Hosting products, whose amount is shared with the cotisation
+HOSTING_PRODUCTS = (1, 2, 5)
+
+
+class Stats:
+    "Sums of the statistics columns over all the items or over groups of them"
+    def __init__(self, items):
+        rows = list(items.order_by().values_list(*ITEM_FIELDS))
+        self.columns = dict(zip(ITEM_FIELDS, zip(*rows) if rows else [()] * len(ITEM_FIELDS)))
+        products = self.columns['product']
+        cotisations = self.columns['cotisation']
+        headcounts = [headcount or 0 for headcount in self.columns['headcount']]
+        overnights = [overnights or 0 for overnights in self.columns['overnights']]
+        overnights_cot = [value if cotisation else 0 for value, cotisation in zip(overnights, cotisations)]
+        amounts = self.columns['amount']
+        self.sums = {
+            'headcount': headcounts,
+            'headcount_cot': [headcount if cotisation else 0 for headcount, cotisation in zip(headcounts, cotisations)],
+            'overnights': overnights,
+            'overnights_cot': overnights_cot,
+            'amount_hosting': [
+                amount - amount_cot if product in HOSTING_PRODUCTS else 0
+                for product, amount, amount_cot in zip(products, amounts, self.columns['amount_cot'])
+            ],
+            # The cotisation is one euro per overnight of the items having one
+            'amount_cot': overnights_cot,
+            'amount_renting': [amount if product == 3 else 0 for product, amount in zip(products, amounts)],
+            'amount_recharge': [amount if product == 4 else 0 for product, amount in zip(products, amounts)],
+            'amount': amounts,
+        }
+        self.total = self.summary()
+
+    def group_by(self, dimension):
+        "Row indices by value of a dimension of DIMENSIONS"
+        groups = {}
+        for i, value in enumerate(self.columns[DIMENSIONS[dimension]]):
+            groups.setdefault(value, []).append(i)
+        return groups
+
+    def summary(self, rows=None):
+        """
+        Sums of the columns over the rows, all of them by default, with the overnight cost.
+
+        A group also gets its share of the overnights and of the hosting amount, and its amount_cot counts all
+        its overnights, with or without cotisation.
+        """
+        if rows is None:
+            stats = {name: sum(column) for name, column in self.sums.items()}
+        else:
+            stats = {name: sum(column[i] for i in rows) for name, column in self.sums.items()}
+            stats['amount_cot'] = stats['overnights']
+            if stats['overnights']:
+                stats['overnights_rate'] = 100 * stats['overnights'] / self.total['overnights']
+            if stats['amount_hosting']:
+                stats['amount_hosting_rate'] = 100 * stats['amount_hosting'] / self.total['amount_hosting']
+        if stats['overnights']:
+            stats['overnight_cost'] = stats['amount_hosting'] / stats['overnights']
+        return stats
+
+    def breakdown(self, dimension):
+        "summary() of the items by value of a dimension"
+        groups = self.group_by(dimension)
+        values = sorted(groups, key=lambda value: (value is None, value))
+        return {value: self.summary(groups[value]) for value in values}
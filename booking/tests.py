@@ -0,0 +1,314 @@
+import datetime
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from members.factories import PersonFactory, StructureFactory
+from .models import Agreement, Booking, BookingItem, BookingState, Payment, TrackingEvent, TrackingValue
+from .occupancy import Occupancy
+from .stats import ITEM_FIELDS, Stats
+
+
+class BookingAggregatesTests(TestCase):
+    def setUp(self):
+        self.bookings = [Booking.objects.create(title=title, year=2020, structure=StructureFactory.create())
+                         for title in ("Camp", "Stage")]
+        self.item = BookingItem.objects.create(
+            booking=self.bookings[0], product=1, headcount=10, price=Decimal('100'),
+            begin=datetime.date(2020, 7, 1), end=datetime.date(2020, 7, 10),
+        )
+
+    def assertAggregates(self, *expected):
+        "Compare the stored (headcount, begin, amount) of the bookings with expected and with the annotations"
+        self.assertEqual(Booking.objects.inconsistencies(), [])
+        bookings = Booking.objects.filter(pk__in=[booking.pk for booking in self.bookings]).order_by('title')
+        self.assertEqual([(booking.headcount, booking.begin, booking.amount) for booking in bookings], list(expected))
+
+    def test_item_save(self):
+        self.assertAggregates((10, datetime.date(2020, 7, 1), 100), (None, None, 0))
+        self.item.booking = self.bookings[1]
+        self.item.save()
+        self.assertAggregates((None, None, 0), (10, datetime.date(2020, 7, 1), 100))
+        self.item.delete()
+        self.assertAggregates((None, None, 0), (None, None, 0))
+
+    def test_queryset_update(self):
+        BookingItem.objects.filter(pk=self.item.pk).update(headcount=12, price=Decimal('50'))
+        self.assertAggregates((12, datetime.date(2020, 7, 1), 50), (None, None, 0))
+        BookingItem.objects.filter(pk=self.item.pk).update(booking=self.bookings[1])
+        self.assertAggregates((None, None, 0), (12, datetime.date(2020, 7, 1), 50))
+        # Fields the aggregates do not depend on leave them alone
+        with CaptureQueriesContext(connection) as context:
+            BookingItem.objects.filter(pk=self.item.pk).update(title="Terrain")
+        self.assertFalse([query for query in context.captured_queries
+                          if query['sql'].startswith('UPDATE "booking_booking"')])
+
+    def test_queryset_bulk_create_delete(self):
+        BookingItem.objects.bulk_create([
+            BookingItem(booking=booking, product=3, headcount=2, price=Decimal('20'),
+                        begin=datetime.date(2020, 6, 30), end=datetime.date(2020, 7, 2))
+            for booking in self.bookings
+        ])
+        self.assertAggregates((12, datetime.date(2020, 6, 30), 120), (2, datetime.date(2020, 6, 30), 20))
+        BookingItem.objects.filter(product=3).delete()
+        self.assertAggregates((10, datetime.date(2020, 7, 1), 100), (None, None, 0))
+
+    def test_booking_save(self):
+        booking = Booking.objects.get(pk=self.bookings[0].pk)
+        BookingItem.objects.create(booking=booking, product=4, price=Decimal('5'))
+        booking.title = "Camp d'été"
+        # The stale aggregates loaded with the booking are not written back, and need no refresh
+        with self.assertNumQueries(1):
+            booking.save()
+        self.assertAggregates((10, datetime.date(2020, 7, 1), 105), (None, None, 0))
+
+
+class BookingFinancialsTests(TestCase):
+    def setUp(self):
+        structure = StructureFactory.create()
+        self.bookings = [Booking.objects.create(title=title, year=2020, structure=structure)
+                         for title in ("Sans convention", "Une convention", "Plusieurs conventions", "Vide")]
+        for booking, price in zip(self.bookings, ('100', '250.50', '80', None)):
+            if price:
+                BookingItem.objects.create(booking=booking, product=4, price=Decimal(price))
+        Payment.objects.create(booking=self.bookings[0], mean=1, date=datetime.date(2020, 5, 1), amount=Decimal('30'))
+        Payment.objects.create(booking=self.bookings[2], mean=2, date=datetime.date(2020, 5, 2), amount=Decimal('50'))
+        Payment.objects.create(booking=self.bookings[2], mean=3, date=datetime.date(2020, 6, 2), amount=Decimal('30'))
+        Agreement.objects.create(booking=self.bookings[1], date=datetime.date(2020, 3, 1), order=1,
+                                 pdf='conventions/1.pdf')
+        # The latest agreement is the one of the latest date, then of the lowest order
+        for date, order in ((datetime.date(2020, 3, 2), 2), (datetime.date(2020, 4, 1), 4),
+                            (datetime.date(2020, 4, 1), 3)):
+            Agreement.objects.create(booking=self.bookings[2], date=date, order=order,
+                                     pdf='conventions/{}.pdf'.format(order))
+
+    def financials(self, booking):
+        "(payment, balance, agreement number, agreement pdf url) of a booking"
+        agreement = booking.agreement
+        return (booking.payment, booking.balance, agreement and agreement.number(), agreement and agreement.pdf.url)
+
+    def test_annotations(self):
+        bookings = Booking.objects.with_financials().order_by('pk')
+        self.assertEqual([self.financials(booking) for booking in bookings], [
+            self.financials(Booking.objects.get(pk=booking.pk)) for booking in self.bookings
+        ])
+        self.assertEqual(self.financials(bookings[2]), (80, 0, "2020-003", '/media/conventions/3.pdf'))
+        self.assertEqual(self.financials(bookings[3]), (0, 0, None, None))
+        self.assertEqual(bookings.financial_totals(), {
+            'headcount': 0,
+            'overnights': 0,
+            'amount': Decimal('430.50'),
+            'balance': Decimal('320.50'),
+        })
+
+    def test_list_view(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        response = self.client.get('/booking/list/', {'year': ''})
+        self.assertEqual(response.context['balance'], Decimal('320.50'))
+        self.assertContains(response, '<a href="/media/conventions/1.pdf">2020-001</a>', html=True)
+        self.assertContains(response, '<a href="/media/conventions/3.pdf">2020-003</a>', html=True)
+        self.assertContains(response, "70,00\xa0€")
+
+
+class TrackingTests(TransactionTestCase):
+    def setUp(self):
+        self.booking = Booking.objects.create(title="Camp", year=2020, structure=StructureFactory.create())
+        self.items = [BookingItem.objects.create(booking=self.booking, product=product, headcount=10)
+                      for product in (1, 2)]
+
+    def events(self):
+        return sorted(TrackingEvent.objects.values_list('obj_pk', 'operation'))
+
+    def test_outside_transaction(self):
+        # Each object is written right away
+        self.assertEqual(self.events(), [(self.booking.pk, TrackingEvent.ADD)] + [
+            (item.pk, TrackingEvent.ADD) for item in self.items
+        ])
+        values = TrackingValue.objects.filter(event__obj_pk=self.items[0].pk).values_list('field', 'value')
+        self.assertEqual(set(values), {
+            ('booking', str(self.booking)), ('product', '1'), ('headcount', '10'), ('cotisation', 'True'),
+        })
+
+    def test_commit(self):
+        TrackingValue.objects.all().delete()
+        TrackingEvent.objects.all().delete()
+        with CaptureQueriesContext(connection) as context:
+            with transaction.atomic():
+                BookingItem.objects.filter(booking=self.booking).update(headcount=12, title="Groupe")
+                self.items[0].refresh_from_db()
+                self.items[0].price = Decimal('10')
+                self.items[0].save()
+                # Nothing is written before the commit
+                self.assertFalse(TrackingEvent.objects.exists())
+        # One batch of values for the update of both items, one for the save
+        inserts = [query for query in context.captured_queries
+                   if query['sql'].startswith('INSERT INTO "booking_trackingvalue"')]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(self.events(), sorted([(item.pk, TrackingEvent.CHANGE) for item in self.items] +
+                                               [(self.items[0].pk, TrackingEvent.CHANGE)]))
+        self.assertEqual(TrackingValue.objects.count(), 5)
+
+    def test_savepoint_rollback(self):
+        TrackingValue.objects.all().delete()
+        TrackingEvent.objects.all().delete()
+        pks = [item.pk for item in self.items]
+        with transaction.atomic():
+            self.items[0].headcount = 12
+            self.items[0].save()
+            try:
+                with transaction.atomic():
+                    self.items[1].delete()
+                    raise ValueError
+            except ValueError:
+                pass
+            BookingItem.objects.filter(pk=pks[1]).update(headcount=14)
+        # The deletion rolled back with its savepoint is not logged
+        self.assertEqual(self.events(), [(pk, TrackingEvent.CHANGE) for pk in pks])
+        self.assertEqual(sorted(TrackingValue.objects.values_list('value', flat=True)), ['12', '14'])
+
+
+class OccupancyTests(TestCase):
+    def setUp(self):
+        structure = StructureFactory.create()
+        confirmed = BookingState.objects.create(title="Confirmé", income=2, color='success')
+        potential = BookingState.objects.create(title="Potentiel", income=1, color='default')
+        bookings = {
+            key: Booking.objects.create(title=title, year=2020, state=state, structure=structure)
+            for key, title, state in (('a', "Alpha", confirmed), ('b', "Bravo", potential), ('c', "Alpha", potential))
+        }
+        for key, product, headcount, begin, end in (
+            # Overlapping items of the same booking
+            ('a', 2, 10, (7, 1), (7, 5)),
+            ('a', 2, 5, (7, 3), (7, 4)),
+            ('a', 1, 8, (7, 5), (7, 8)),
+            # Without headcount, or without end
+            ('a', 2, None, (7, 2), (7, 10)),
+            ('a', 2, 2, (7, 1), None),
+            # Arriving the day Alpha leaves, then leaving and coming back the same day
+            ('b', 2, 6, (7, 5), (7, 7)),
+            ('b', 2, 6, (7, 7), (7, 9)),
+            ('b', 3, 3, (6, 28), (6, 29)),
+            # Same title as another booking, with another color
+            ('c', 1, 4, (7, 6), (7, 7)),
+        ):
+            BookingItem.objects.create(
+                booking=bookings[key], product=product, headcount=headcount,
+                begin=datetime.date(2020, *begin), end=end and datetime.date(2020, *end),
+            )
+
+    def reference(self, products=(2, 1)):
+        "Occupancy computed night by night, as the calendar did with one query per night and product"
+        items = [item for item in BookingItem.objects.select_related('booking__state') if item.begin and item.end]
+        begin, end = min(item.begin for item in items), max(item.end for item in items)
+        nights = []
+        for i in range((end - begin).days + 1):
+            day = begin + datetime.timedelta(days=i)
+            occupancy = {}
+            for product in products:
+                bookings = {}
+                for item in items:
+                    if item.product == product and item.begin <= day < item.end and item.headcount is not None:
+                        key = (item.booking.title, item.booking.state.color)
+                        bookings[key] = bookings.get(key, 0) + item.headcount
+                bookings = [key + (bookings[key], ) for key in sorted(bookings)]
+                occupancy[product] = (len(bookings), sum(booking[2] for booking in bookings), bookings)
+            nights.append((day, occupancy))
+        return nights
+
+    def test_sweep(self):
+        nights = [
+            (day, {
+                product: (occupancy.number, occupancy.headcount, [
+                    (booking['booking__title'], booking['booking__state__color'], booking['headcount'])
+                    for booking in occupancy.bookings
+                ])
+                for product, occupancy in products.items()
+            })
+            for day, products in Occupancy(BookingItem.objects.all())
+        ]
+        self.assertEqual(nights, self.reference())
+        self.assertEqual((nights[0][0], nights[-1][0]), (datetime.date(2020, 6, 28), datetime.date(2020, 7, 10)))
+        self.assertEqual(dict(nights)[datetime.date(2020, 7, 6)][1],
+                         (2, 12, [("Alpha", 'default', 4), ("Alpha", 'success', 8)]))
+
+    def test_alerts(self):
+        occupancy = Occupancy(BookingItem.objects.all())
+        # A headcount equal to the capacity raises no alert
+        self.assertEqual(occupancy.alerts({2: 14, 1: 12}), [(datetime.date(2020, 7, 3), 2, 15)])
+        self.assertEqual(occupancy.alerts({1: 11}), [(datetime.date(2020, 7, 6), 1, 12)])
+        self.assertEqual(occupancy.alerts({2: 15}), [])
+        with override_settings(BOOKING_CAPACITY={2: 14}):
+            self.assertEqual(occupancy.alerts(), [(datetime.date(2020, 7, 3), 2, 15)])
+        self.assertEqual(Occupancy(BookingItem.objects.none()).alerts({2: 0}), [])
+
+    @override_settings(BOOKING_CAPACITY={2: 14})
+    def test_json_view(self):
+        self.client.force_login(user=PersonFactory.create(is_superuser=True))
+        data = self.client.get('/booking/occupancy/data/', {'year': ''}).json()
+        self.assertEqual(data['alerts'], [{'day': '2020-07-03', 'product': 2, 'headcount': 15}])
+        night = next(night for night in data['occupancy'] if night['day'] == '2020-07-05')
+        self.assertEqual(night['products']['2'], {
+            'number': 1,
+            'headcount': 6,
+            'bookings': [{'booking__title': "Bravo", 'booking__state__color': 'default', 'headcount': 6}],
+        })
+
+    @override_settings(BOOKING_CAPACITY={2: 14, 1: 11}, NOW=lambda: datetime.datetime(2020, 7, 4))
+    def test_command(self):
+        out = StringIO()
+        call_command('occupancy_alerts', stdout=out)
+        # The nights before today are left out
+        self.assertEqual(out.getvalue().count("\n"), 1)
+        self.assertIn("12 personnes en Hébergement Terrain pour 11 places", out.getvalue())
+
+
+class StatsTests(SimpleTestCase):
+    # product, headcount, overnights, amount, amount_cot, cotisation, month, org_type, state, structure
+    ROWS = [
+        (1, 10, 30, Decimal('150'), 30, True, 7, 1, 1, 1),
+        (2, 5, 20, Decimal('120'), 0, False, 7, 1, 1, 1),
+        (5, 4, 8, Decimal('48'), 8, True, 8, 2, 1, 2),
+        (3, None, None, Decimal('60'), 0, True, 8, 2, 1, 2),
+        (4, 2, None, Decimal('15'), 0, False, 8, 2, 1, 2),
+    ]
+
+    def stats(self, rows):
+        items = mock.Mock()
+        items.order_by.return_value.values_list.return_value = rows
+        return Stats(items)
+
+    def test_total(self):
+        stats = self.stats(self.ROWS)
+        self.assertEqual(stats.total, {
+            'headcount': 21,
+            'headcount_cot': 14,
+            'overnights': 58,
+            'overnights_cot': 38,
+            'amount_hosting': Decimal('280'),
+            # Overnights of the items with a cotisation only
+            'amount_cot': 38,
+            'amount_renting': Decimal('60'),
+            'amount_recharge': Decimal('15'),
+            'amount': Decimal('393'),
+            'overnight_cost': Decimal('280') / 58,
+        })
+
+    def test_groups(self):
+        stats = self.stats(self.ROWS)
+        products = stats.group_by('product')
+        village = stats.summary(products[2] + products[5])
+        # All the overnights of the group, with or without cotisation
+        self.assertEqual(village['amount_cot'], 28)
+        self.assertEqual((village['overnights'], village['overnights_cot']), (28, 8))
+        self.assertEqual(village['overnights_rate'], 100 * 28 / 58)
+        self.assertEqual(village['amount_hosting_rate'], 100 * Decimal('160') / Decimal('280'))
+        self.assertEqual(stats.breakdown('month')[8]['amount'], Decimal('123'))
+
+    def test_empty(self):
+        stats = self.stats([])
+        self.assertEqual(stats.columns, {field: () for field in ITEM_FIELDS})
+        self.assertEqual((stats.total['amount'], stats.total['amount_cot']), (0, 0))
+        self.assertNotIn('overnight_cost', stats.total)
@@ -11,6 +11,7 @@ urlpatterns = [
     url(r'^create/$', views.BookingCreateView.as_view(), name='create'),
     url(r'^google_sync/(?P<pk>\d+)/$', views.BookingGoogleSyncView.as_view(), name='booking_google_sync'),
     url(r'^occupancy/$', views.OccupancyView.as_view(), name='occupancy'),
+    url(r'^occupancy/data/$', views.OccupancyJsonView.as_view(), name='occupancy_data'),
     url(r'^stats/$', views.StatsView.as_view(), name='stats'),
     url(r'^cotisations/$', views.CotisationsView.as_view(), name='cotisations'),
 ]
@@ -1,13 +1,13 @@
-from datetime import timedelta
 from django.contrib.auth.mixins import UserPassesTestMixin, PermissionRequiredMixin
-from django.db.models import Sum, Min, Max
-from django.http import HttpResponseRedirect, HttpResponseForbidden
+from django.http import HttpResponseRedirect, HttpResponseForbidden, JsonResponse
 from django.urls import reverse
 from django.views.generic import TemplateView, DetailView, CreateView
 from django_filters.views import FilterView
 from .filters import BookingFilter, BookingItemFilter, StatsFilter, CotisationsFilter
 from .forms import BookingForm
 from .models import Booking, BookingItem
+from .occupancy import Occupancy
+from .stats import Stats
 
 
 class UserMixin(UserPassesTestMixin):
@@ -41,14 +41,11 @@ class BookingListView(UserMixin, FilterView):
     filterset_class = BookingFilter
 
     def get_queryset(self):
-        return Booking.objects.for_user(self.request.user)
+        return Booking.objects.for_user(self.request.user).with_financials()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['overnights'] = sum([booking.overnights for booking in self.object_list if booking.overnights])
-        context['headcount'] = sum([booking.headcount for booking in self.object_list if booking.headcount])
-        context['amount'] = sum([booking.amount for booking in self.object_list if booking.amount])
-        context['balance'] = sum([booking.balance for booking in self.object_list if booking.balance])
+        context.update(self.object_list.financial_totals())
         return context
 
 
@@ -76,77 +73,48 @@ class OccupancyView(UserMixin, FilterView):
     template_name = 'booking/occupancy.html'
     filterset_class = BookingItemFilter
 
-    def occupancy_for(self, day, product):
-        items = self.object_list.filter(begin__lte=day, end__gt=day, product=product)
-        items = items.filter(headcount__isnull=False)
-        items = items.order_by('booking__title')
-        items = items.values('booking__title', 'booking__state__color')
-        items = items.annotate(headcount=Sum('headcount'))
-        return len(items), sum([item['headcount'] for item in items]), items
-
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        occupancy = []
-        range_qs = self.object_list.aggregate(begin=Min('begin'), end=Max('end'))
-        if range_qs['begin'] and range_qs['end']:
-            begin = range_qs['begin']
-            end = range_qs['end']
-            for i in range((end - begin).days + 1):
-                day = begin + timedelta(days=i)
-                occupancy.append((day, ) + self.occupancy_for(day, 2) + self.occupancy_for(day, 1))
-        context['occupancy'] = occupancy
+        self.occupancy = Occupancy(self.object_list)
+        context['occupancy'] = [(day, ) + products[2] + products[1] for day, products in self.occupancy]
+        context['alerts'] = {day for day, product, headcount in self.occupancy.alerts()}
         return context
 
 
+class OccupancyJsonView(OccupancyView):
+    def render_to_response(self, context, **response_kwargs):
+        return JsonResponse({
+            'occupancy': [
+                {
+                    'day': day.isoformat(),
+                    'products': {product: occupancy._asdict() for product, occupancy in products.items()},
+                }
+                for day, products in self.occupancy
+            ],
+            'alerts': [
+                {'day': day.isoformat(), 'product': product, 'headcount': headcount}
+                for day, product, headcount in self.occupancy.alerts()
+            ],
+        })
+
+
 class StatsView(UserMixin, TemplateView):
     template_name = 'booking/stats.html'
 
     def get_context_data(self, **kwargs):
         filter = StatsFilter(self.request.GET or None, request=self.request,
                              queryset=Booking.objects.for_user(self.request.user))
-        items = BookingItem.objects.filter(booking__in=filter.qs)
+        stats = Stats(BookingItem.objects.filter(booking__in=filter.qs))
         kwargs['filter'] = filter
-        kwargs['stats'] = {
-            'headcount': sum([item.headcount for item in items if item.headcount]),
-            'headcount_cot': sum([item.headcount for item in items if item.headcount and item.cotisation]),
-            'overnights': sum([item.overnights for item in items if item.overnights]),
-            'overnights_cot': sum([item.overnights for item in items if item.overnights and item.cotisation]),
-            'amount_hosting': sum([item.amount - item.amount_cot for item in items if item.product in (1, 2, 5)]),
-            'amount_cot': sum([item.overnights for item in items if item.overnights and item.cotisation]),
-            'amount_renting': sum([item.amount for item in items if item.product == 3]),
-            'amount_recharge': sum([item.amount for item in items if item.product == 4]),
-            'amount': sum([item.amount for item in items]),
-        }
-        if kwargs['stats']['overnights']:
-            kwargs['stats']['overnight_cost'] = kwargs['stats']['amount_hosting'] / kwargs['stats']['overnights']
-
-        stats = [
-            ('Village', items.filter(product__in=(2, 5))),
-            ('Terrain', items.filter(product=1)),
+        kwargs['stats'] = stats.total
+        products = stats.group_by('product')
+        months = stats.group_by('month')
+        groups = [
+            ('Village', products.get(2, []) + products.get(5, [])),
+            ('Terrain', products.get(1, [])),
         ]
-        stats += [(str(month), items.filter(begin__month=month)) for month in range(1, 13)]
-        kwargs['detailed_stats'] = {}
-        for (name, subitems) in stats:
-            substats = {
-                'headcount': sum([item.headcount for item in subitems if item.headcount]),
-                'overnights': sum([item.overnights for item in subitems if item.overnights]),
-                'amount_hosting': sum([item.amount - item.amount_cot
-                                       for item in subitems if item.product in (1, 2, 5)]),
-                'amount_cot': sum([item.overnights for item in subitems if item.overnights]),
-                'amount_renting': sum([item.amount for item in subitems if item.product == 3]),
-                'amount_recharge': sum([item.amount for item in subitems if item.product == 4]),
-                'amount': sum([item.amount for item in subitems]),
-            }
-            if substats['overnights']:
-                substats['overnights_rate'] = (100 * substats['overnights'] / kwargs['stats']['overnights'])
-            if substats['amount_hosting']:
-                substats['amount_hosting_rate'] = (100 * substats['amount_hosting'] /
-                                                   kwargs['stats']['amount_hosting'])
-            if substats['overnights']:
-                substats['overnight_cost'] = (substats['amount_hosting'] / substats['overnights'])
-
-            kwargs['detailed_stats'][name] = substats
-
+        groups += [(str(month), months.get(month, [])) for month in range(1, 13)]
+        kwargs['detailed_stats'] = {name: stats.summary(rows) for name, rows in groups}
         return kwargs
 
 